@@ -0,0 +1,108 @@
+"""
+Regex backend benchmark of value search.
+
+Usage:
+    python benchmarks/bench_regex.py --values 20000 --output bench_regex.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from hsettings import Settings
+from consul_utils.filters import SearchFilter
+from consul_utils.regex import REGEX_BACKENDS
+
+
+PATTERNS = {
+    'literal': r'feature_flag_beta',
+    'alternation': r'(prod|staging|canary)-db-\d+',
+    'wildcard': r'timeout.*[0-9]{5}',
+    'anchored': r'^\{"service"',
+}
+# nested quantifier backtracks exponentially in re on a run of 'a' not followed by the end
+EVIL_PATTERN = r'(a+)+$'
+
+
+def make_values(count, seed=1):
+    """
+    Representative key values: small scalars, json configs of a few KB and large blobs.
+    """
+    rnd = random.Random(seed)
+    values = []
+    for i in range(count):
+        kind = i % 10
+        if kind < 6:
+            values.append(str(rnd.randint(0, 100000)))
+        elif kind < 9:
+            values.append(json.dumps({
+                'service': 'svc-{}'.format(i),
+                'hosts': ['{}-db-{}'.format(rnd.choice(['prod', 'dev', 'test']), rnd.randint(0, 99))
+                          for _ in range(40)],
+                'timeout_ms': rnd.choice([300, 5000, 30000]),
+                'flags': ['flag_{}'.format(rnd.randint(0, 1000)) for _ in range(80)],
+            }))
+        else:
+            values.append(''.join(rnd.choice('abcdefghij0123456789 \n') for _ in range(16384)))
+    return values
+
+
+def bench_search(backend, pattern, values, max_value_size=0, repeat=3):
+    settings = Settings({'search': {'fields': 'values', 'query': pattern, 'regex': True, 'limit': len(values),
+                                    'regex_backend': backend, 'max_value_size': max_value_size}})
+    fil = SearchFilter(settings)
+    keys = ['bench/{}'.format(i) for i in range(len(values))]
+    compiled = fil.get_query()
+    best = None
+    matched = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matched = sum(fil.filter_many(keys, values))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'backend': backend,
+        # backend actually used after fall back
+        'compiled': type(compiled).__name__,
+        'values': len(values),
+        'bytes': sum(len(v) for v in values),
+        'max_value_size': max_value_size,
+        'matched': matched,
+        'seconds': round(best, 4),
+        'mb_per_second': round(sum(len(v) for v in values) / best / 1e6, 2) if best else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark regex backends of value search')
+    parser.add_argument('--values', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-value-size', type=int, default=4096, help='Size cap also benchmarked')
+    parser.add_argument('--evil-size', type=int, default=20, help='Length of the run backtracked by evil pattern')
+    parser.add_argument('--output', help='Write results as json to file')
+    args = parser.parse_args()
+    values = make_values(args.values)
+    evil_values = ['a' * args.evil_size + '!'] * 10
+    results = []
+    for backend in REGEX_BACKENDS:
+        for name, pattern in PATTERNS.items():
+            for cap in [0, args.max_value_size]:
+                res = bench_search(backend, pattern, values, cap, args.repeat)
+                res['pattern'] = name
+                results.append(res)
+        res = bench_search(backend, EVIL_PATTERN, evil_values, 0, 1)
+        res['pattern'] = 'evil'
+        results.append(res)
+    out = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(out)
+    sys.stderr.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Reporter output throughput benchmark.
+
+Usage:
+    python benchmarks/bench_reporter.py --records 1000000 --output bench_reporter.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from hsettings import Settings
+from consul_utils.reporter import OUT_ALL_KEY, OUT_FILTERED_KEY, OUT_NON_FILTERED_KEY, OUT_FLAG_KEY, \
+    TextReporter, JsonReporter, CsvReport
+
+
+REPORTERS = {
+    'text': TextReporter,
+    'json': JsonReporter,
+    'csv': CsvReport,
+}
+
+
+def make_data(records, value_size):
+    value = 'v' * value_size
+    filtered = [{'key': 'bench/{}/{}'.format(i % 100, i), 'value': value} for i in range(records)]
+    return {OUT_ALL_KEY: [], OUT_FILTERED_KEY: filtered, OUT_NON_FILTERED_KEY: [], OUT_FLAG_KEY: {}}
+
+
+def bench_reporter(rtype, data, output_file, repeat=3):
+    settings = Settings({'reporter': {'output_file': output_file, 'show_filtered': True}})
+    best = None
+    for _ in range(repeat):
+        reporter = REPORTERS[rtype](settings)
+        start = time.perf_counter()
+        reporter.report(dict(data))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'reporter': rtype,
+        'output': os.path.basename(output_file) if output_file else 'console',
+        'records': len(data[OUT_FILTERED_KEY]),
+        'seconds': round(best, 4),
+        'records_per_second': int(len(data[OUT_FILTERED_KEY]) / best) if best else None,
+        'bytes': os.path.getsize(output_file) if output_file else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reporter output throughput')
+    parser.add_argument('--records', type=int, default=200000)
+    parser.add_argument('--value-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--console', action='store_true', help='Also benchmark console output, redirect stdout to a pipe')
+    parser.add_argument('--output', help='Write results as json to file')
+    args = parser.parse_args()
+    data = make_data(args.records, args.value_size)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rtype in REPORTERS:
+            for ext in ['.txt', '.txt.gz']:
+                output_file = os.path.join(tmpdir, 'out_' + rtype + ext)
+                results.append(bench_reporter(rtype, data, output_file, args.repeat))
+        if args.console:
+            results.append(bench_reporter('text', data, '', args.repeat))
+    out = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(out)
+    sys.stderr.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
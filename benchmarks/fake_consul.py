@@ -0,0 +1,240 @@
+"""
+A local in-process stand-in for the Consul KV HTTP API.
+
+Only the endpoints used by consul_utils are implemented: ``/v1/kv`` (get with recurse, keys, separator and
+blocking index/wait, put, delete) and ``/v1/txn``.
+"""
+import json
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+def parse_wait(wait):
+    """
+    Parse consul wait duration like ``10s``, ``5m`` or ``100ms`` to seconds.
+    """
+    if not wait:
+        return 300
+    units = [('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600)]
+    for unit, factor in units:
+        if wait.endswith(unit):
+            return float(wait[:-len(unit)]) * factor
+    return float(wait)
+
+
+class FakeKvStore:
+    """
+    In memory key value store with consul like indexes.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.index = 1
+        self.cond = threading.Condition()
+
+    def _entry(self, key, value, flags=0):
+        old = self.data.get(key)
+        self.index += 1
+        self.data[key] = {
+            'Key': key,
+            'Value': value,
+            'Flags': flags,
+            'LockIndex': 0,
+            'CreateIndex': old['CreateIndex'] if old else self.index,
+            'ModifyIndex': self.index,
+        }
+
+    def put(self, key, value, flags=0):
+        with self.cond:
+            self._entry(key, value, flags)
+            self.cond.notify_all()
+        return True
+
+    def put_many(self, items):
+        with self.cond:
+            for key, value in items:
+                self._entry(key, value)
+            self.cond.notify_all()
+
+    def delete(self, key, recurse=False):
+        with self.cond:
+            if recurse:
+                keys = [k for k in self.data if k.startswith(key)]
+            else:
+                keys = [key] if key in self.data else []
+            for k in keys:
+                del self.data[k]
+            self.index += 1
+            self.cond.notify_all()
+        return True
+
+    def wait(self, index, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.index > index, timeout=timeout)
+            return self.index
+
+    def get(self, key, recurse=False):
+        with self.cond:
+            if recurse:
+                return [dict(self.data[k]) for k in sorted(self.data) if k.startswith(key)]
+            if key in self.data:
+                return [dict(self.data[key])]
+            return []
+
+    def keys(self, key, separator=None):
+        with self.cond:
+            res = []
+            for k in sorted(self.data):
+                if not k.startswith(key):
+                    continue
+                if separator:
+                    pos = k.find(separator, len(key))
+                    if pos >= 0:
+                        k = k[:pos + len(separator)]
+                if not res or res[-1] != k:
+                    res.append(k)
+            return res
+
+
+class FakeConsulHandler(BaseHTTPRequestHandler):
+    """
+    Http handler for the fake consul.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _send(self, code, body=None, index=None):
+        data = json.dumps(body).encode('utf8') if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Consul-Index', str(index or self.store.index))
+        self.send_header('X-Consul-Knownleader', 'true')
+        self.send_header('X-Consul-Lastcontact', '0')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _parse(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        self.server.requests.append((self.command, url.path, sorted(params)))
+        return unquote(url.path), params
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    @staticmethod
+    def _encode(entry):
+        entry = dict(entry)
+        if entry['Value'] is not None:
+            entry['Value'] = base64.b64encode(entry['Value']).decode('ascii')
+        return entry
+
+    def do_GET(self):
+        path, params = self._parse()
+        if not path.startswith('/v1/kv/'):
+            return self._send(404)
+        key = path[len('/v1/kv/'):]
+        if 'index' in params:
+            index = int(params['index'][0])
+            self.store.wait(index, parse_wait(params.get('wait', [None])[0]))
+        if 'keys' in params:
+            keys = self.store.keys(key, params.get('separator', [None])[0])
+            if not keys:
+                return self._send(404)
+            return self._send(200, keys)
+        entries = self.store.get(key, recurse='recurse' in params)
+        if not entries:
+            return self._send(404)
+        return self._send(200, [self._encode(e) for e in entries])
+
+    def do_PUT(self):
+        path, params = self._parse()
+        body = self._body()
+        if path == '/v1/txn':
+            return self._txn(json.loads(body.decode('utf8')))
+        if not path.startswith('/v1/kv/'):
+            return self._send(404)
+        self.store.put(path[len('/v1/kv/'):], body)
+        return self._send(200, True)
+
+    def do_DELETE(self):
+        path, params = self._parse()
+        if not path.startswith('/v1/kv/'):
+            return self._send(404)
+        self.store.delete(path[len('/v1/kv/'):], recurse='recurse' in params)
+        return self._send(200, True)
+
+    def _txn(self, ops):
+        if len(ops) > 64:
+            return self._send(413, {'Errors': [{'OpIndex': 64, 'What': 'too many operations'}]})
+        results = []
+        for op in ops:
+            kv = op['KV']
+            verb = kv['Verb']
+            if verb == 'set':
+                self.store.put(kv['Key'], base64.b64decode(kv.get('Value') or ''))
+            elif verb == 'delete':
+                self.store.delete(kv['Key'])
+            elif verb == 'delete-tree':
+                self.store.delete(kv['Key'], recurse=True)
+            elif verb == 'get':
+                for e in self.store.get(kv['Key']):
+                    results.append({'KV': self._encode(e)})
+        return self._send(200, {'Results': results, 'Errors': None})
+
+
+class ThreadingHttpServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeConsulServer:
+    """
+    Fake consul server running in a background thread.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.store = FakeKvStore()
+        self._server = ThreadingHttpServer((host, port), FakeConsulHandler)
+        self._server.store = self.store
+        self._server.requests = []
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
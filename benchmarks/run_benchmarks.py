@@ -0,0 +1,174 @@
+"""
+End to end command benchmarks against a local fake consul.
+
+Usage:
+    python benchmarks/run_benchmarks.py --size 100000 --depth 4 --output bench.json
+    python benchmarks/run_benchmarks.py --size 100000 --depth 4 --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from hsettings import Settings
+from consul_utils.commands import DumpCommand, SearchCommand, DiffCommand, CopyCommand
+from fake_consul import FakeConsulServer
+
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'timeout', 'server', 'client', 'retry', 'host', 'port', 'enabled',
+         'config', 'cache', 'limit', 'region', 'service']
+
+
+def generate_tree(root, size, depth, value_size, seed=0):
+    """
+    Generate synthetic key values, keys are spread under depth levels of directories.
+
+    :return: list of (key, value bytes)
+    """
+    rnd = random.Random(seed)
+    fanout = max(int(round(size ** (1.0 / depth))), 2) if depth > 0 else size
+    items = []
+    for i in range(size):
+        parts = ['{}{}'.format(WORDS[j % len(WORDS)], (i // (fanout ** j)) % fanout) for j in range(depth)]
+        key = root + '/'.join(parts + ['key{}'.format(i)])
+        fields = {}
+        while len(json.dumps(fields)) < value_size:
+            fields[rnd.choice(WORDS) + str(len(fields))] = rnd.randint(0, 10000)
+        items.append((key, json.dumps(fields).encode('utf8')))
+    return items
+
+
+def make_settings(server, cache_dir, output_file, **kwargs):
+    conf = {
+        'consul': {'host': server.host, 'port': server.port, 'scheme': 'http', 'token': '', 'root': ''},
+        'cache': {'cache_enabled': True, 'cache_dir': cache_dir, 'cache_ttl': 3600},
+        'reporter': {'output_type': 'text', 'output_file': output_file, 'show_all_scan': False,
+                     'show_filtered': True, 'show_flags': False},
+        'log': {'log_level': 'ERROR', 'log_formatter': '[%(levelname)s] %(asctime)s : %(message)s'},
+        'search': {'limit': 1000000000, 'fields': 'keys', 'regex': False},
+    }
+    for k, v in kwargs.items():
+        conf.setdefault(k, {}).update(v)
+    return Settings(conf)
+
+
+def run_case(name, command_cls, args, server, cache_dir, output_file, warm, repeat, **conf):
+    """
+    Run command and report, cold runs clear the cache before each run.
+    """
+    timings = []
+    stats = None
+    for _ in range(repeat):
+        run_args = dict(args, clear_cache=not warm)
+        if warm:
+            # fill the cache before the timed run
+            command_cls(settings=make_settings(server, cache_dir, output_file, **conf), args=dict(args)).run()
+        cmd = command_cls(settings=make_settings(server, cache_dir, output_file, **conf), args=run_args)
+        start = time.perf_counter()
+        cmd.run_and_report()
+        timings.append(time.perf_counter() - start)
+        stats = cmd.stats.to_dict()
+    return {
+        'name': name,
+        'cache': 'warm' if warm else 'cold',
+        'seconds': round(min(timings), 4),
+        'mean_seconds': round(sum(timings) / len(timings), 4),
+        'timers': stats['timers'],
+        'counters': stats['counters'],
+    }
+
+
+def get_cases(args):
+    root1 = 'bench/source/'
+    root2 = 'bench/changed/'
+    query = WORDS[4]
+    return [
+        ('dump', DumpCommand, {'root': root1}, {}),
+        ('search_keys_substring', SearchCommand, {'root': root1, 'query': 'key1'}, {}),
+        ('search_keys_regex', SearchCommand, {'root': root1, 'query': r'key\d*7$', 'regex': True}, {}),
+        ('search_values_substring', SearchCommand, {'root': root1, 'query': query}, {'search': {'fields': 'values'}}),
+        ('search_values_regex', SearchCommand, {'root': root1, 'query': r'"timeout\d+": \d*99', 'regex': True},
+         {'search': {'fields': 'values'}}),
+        ('search_values_regex_parallel', SearchCommand, {'root': root1, 'query': r'"timeout\d+": \d*99', 'regex': True},
+         {'search': {'fields': 'values'}, 'filter': {'workers': 0, 'parallel_min_size': 0}}),
+        ('diff', DiffCommand, {'root1': root1, 'root2': root2}, {}),
+        ('copy', CopyCommand, {'root': root1, 'target_root': 'bench/copy/'}, {}),
+    ]
+
+
+def run_benchmarks(args):
+    results = []
+    with FakeConsulServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        items = generate_tree('bench/source/', args.size, args.depth, args.value_size)
+        server.store.put_many(items)
+        # changed tree for diff, change every 10th value and drop every 50th key
+        changed = []
+        for i, (key, value) in enumerate(items):
+            if i % 50 == 0:
+                continue
+            if i % 10 == 0:
+                value = value + b' '
+            changed.append(('bench/changed/' + key[len('bench/source/'):], value))
+        server.store.put_many(changed)
+        cache_dir = os.path.join(tmpdir, 'cache')
+        output_file = os.path.join(tmpdir, 'out.txt')
+        for name, command_cls, cmd_args, conf in get_cases(args):
+            if args.only and name not in args.only:
+                continue
+            for warm in [False, True]:
+                if name == 'copy' and warm and not args.warm_copy:
+                    continue
+                res = run_case(name, command_cls, cmd_args, server, cache_dir, output_file, warm, args.repeat, **conf)
+                sys.stderr.write('{} ({}): {}s\n'.format(res['name'], res['cache'], res['seconds']))
+                results.append(res)
+    return {
+        'params': {'size': args.size, 'depth': args.depth, 'value_size': args.value_size, 'repeat': args.repeat},
+        'python': sys.version.split()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare(current, baseline):
+    """
+    Compare results with baseline, yield (name, cache, baseline seconds, current seconds, change ratio).
+    """
+    base = {(r['name'], r['cache']): r['seconds'] for r in baseline['results']}
+    for r in current['results']:
+        key = (r['name'], r['cache'])
+        if key in base and base[key]:
+            yield r['name'], r['cache'], base[key], r['seconds'], (r['seconds'] - base[key]) / base[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark consul_utils commands against a local fake consul')
+    parser.add_argument('--size', type=int, default=10000, help='Number of keys')
+    parser.add_argument('--depth', type=int, default=3, help='Directory depth of keys')
+    parser.add_argument('--value-size', type=int, default=256, help='Approximate value size in bytes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='Only run these cases')
+    parser.add_argument('--warm-copy', action='store_true', help='Also run copy with warm cache')
+    parser.add_argument('--output', help='Write results as json to file')
+    parser.add_argument('--compare', help='Compare with results json file')
+    args = parser.parse_args()
+    res = run_benchmarks(args)
+    out = json.dumps(res, indent=4)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(out)
+    else:
+        print(out)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        for name, cache, before, after, ratio in compare(res, baseline):
+            print('{:<28} {:<5} {:>10.4f}s -> {:>10.4f}s {:+.1%}'.format(name, cache, before, after, ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,11 +30,20 @@ def run_command(command_cls, ctx, args):
 @click.option('-h', '--host', help='Consul host')
 @click.option('-p', '--port', help='Consul port', type=int)
 @click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
 @click.option('-t', '--token', help='Consul ACL token')
 @click.option('-r', '--root', help='Search root for consul')
-@click.option('-x', '--output-type', help='Output type, text, csv or json', type=click.Choice(['text', 'json', 'csv']))
+@click.option('--roots', help='Comma separated roots in place of root, overlapping roots are read once')
+@click.option('--snapshot', help='Read key values from snapshot file in place of consul host')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
 @click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
 @click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
 @click.pass_context
 def dump(ctx, **kwargs):
     """
@@ -49,12 +58,24 @@ def dump(ctx, **kwargs):
 @click.option('-h', '--host', help='Consul host')
 @click.option('-p', '--port', help='Consul port', type=int)
 @click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
 @click.option('-t', '--token', help='Consul ACL token')
 @click.option('-r', '--root', help='Search root for consul', required=True)
-@click.option('-x', '--output-type', help='Output type, text, csv or json', type=click.Choice(['text', 'json', 'csv']))
+@click.option('--snapshot', help='Copy key values from snapshot file in place of source consul host')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
 @click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
 @click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
 @click.option('--target-root', help='Target copy root for consul', required=True)
+@click.option('--delta/--no-delta', help='Only copy keys that are missing or different in target', default=None)
+@click.option('--delete-extra/--no-delete-extra', help='Delete target keys that not exist in source, only for delta copy', default=None)
+@click.option('--checkpoint-file', help='Record copied keys to checkpoint file')
+@click.option('--resume', help='Resume copy from checkpoint file', default=None, is_flag=True)
 @click.pass_context
 def copy(ctx, **kwargs):
     """
@@ -69,15 +90,32 @@ def copy(ctx, **kwargs):
 @click.option('-h', '--host', help='Consul host')
 @click.option('-p', '--port', help='Consul port', type=int)
 @click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
 @click.option('-t', '--token', help='Consul ACL token')
 @click.option('-r', '--root', help='Search root for consul')
-@click.option('-x', '--output-type', help='Output type, text, csv or json', type=click.Choice(['text', 'json', 'csv']))
+@click.option('--roots', help='Comma separated roots in place of root, overlapping roots are read once')
+@click.option('--snapshot', help='Read key values from snapshot file in place of consul host')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
 @click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
 @click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
 @click.option('-q', '--query', help='Search query string', required=True)
 @click.option('-e/ ', '--regex/--no-regex', help='Search query using regex or not', default=False)
+@click.option('--regex-backend', help='Regex backend, re, re2 or hyperscan, fall back to re if not installed', type=click.Choice(['re', 're2', 'hyperscan']))
+@click.option('--max-value-size', help='Only search the first characters of each value, 0 means no cap', type=int)
+@click.option('--time-budget', help='Max seconds spent searching, results found by then are reported', type=float)
 @click.option('-f', '--fields', help='Search fields, keys or values', type=click.Choice(['keys', 'values']))
+@click.option('-s/ ', '--structured/--no-structured', help='Query json or yaml values by path and predicate, e.g. "server.timeout_ms > 5000"', default=None)
 @click.option('-l', '--limit', help='Search output result limit')
+@click.option('--decode/--no-decode', help='Search inside gzip, zlib, zstd or base64 encoded values', default=None)
+@click.option('--ranked/--no-ranked', help='Rank key values by fuzzy match with query and output the best limit of them', default=None)
+@click.option('--min-score', help='Min fuzzy match score of ranked search, 1 for exact token match', type=float)
+@click.option('-w', '--workers', help='Number of worker processes to search, 0 means cpu count', type=int)
 @click.pass_context
 def search(ctx, **kwargs):
     """
@@ -86,31 +124,206 @@ def search(ctx, **kwargs):
     run_command(SearchCommand, ctx, kwargs)
 
 
+@cli.command(short_help='Delete keys found by search or listed in file')
+@click.option('--log-level', help='log level')
+@click.option('-c', '--config-file', help='Config file path', type=click.File('r'))
+@click.option('-h', '--host', help='Consul host')
+@click.option('-p', '--port', help='Consul port', type=int)
+@click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
+@click.option('-t', '--token', help='Consul ACL token')
+@click.option('-r', '--root', help='Search root for consul')
+@click.option('--roots', help='Comma separated roots in place of root, overlapping roots are read once')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
+@click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
+@click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
+@click.option('-q', '--query', help='Search query string, keys found are deleted')
+@click.option('-e/ ', '--regex/--no-regex', help='Search query using regex or not', default=False)
+@click.option('--regex-backend', help='Regex backend, re, re2 or hyperscan, fall back to re if not installed', type=click.Choice(['re', 're2', 'hyperscan']))
+@click.option('--max-value-size', help='Only search the first characters of each value, 0 means no cap', type=int)
+@click.option('--time-budget', help='Max seconds spent searching, results found by then are reported', type=float)
+@click.option('-f', '--fields', help='Search fields, keys or values', type=click.Choice(['keys', 'values']))
+@click.option('-s/ ', '--structured/--no-structured', help='Query json or yaml values by path and predicate, e.g. "server.timeout_ms > 5000"', default=None)
+@click.option('-l', '--limit', help='Max keys deleted, all keys found are deleted if not set')
+@click.option('-w', '--workers', help='Number of worker processes to search, 0 means cpu count', type=int)
+@click.option('-k', '--keys-file', help='Delete keys listed in file, one key per line, instead of search')
+@click.option('--dry-run/--no-dry-run', help='Output keys to delete without deleting', default=None)
+@click.option('--batch-size', help='Keys deleted in one transaction, at most 64', type=int)
+@click.pass_context
+def delete(ctx, **kwargs):
+    """
+    Delete consul keys found by search or listed in keys file.
+    """
+    run_command(DeleteCommand, ctx, kwargs)
+
+
+@cli.command(short_help='Summarize key count and size per prefix')
+@click.option('--log-level', help='log level')
+@click.option('-c', '--config-file', help='Config file path', type=click.File('r'))
+@click.option('-h', '--host', help='Consul host')
+@click.option('-p', '--port', help='Consul port', type=int)
+@click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
+@click.option('-t', '--token', help='Consul ACL token')
+@click.option('-r', '--root', help='Search root for consul')
+@click.option('--snapshot', help='Read key values from snapshot file in place of consul host')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
+@click.option('-o', '--output-file', help='Output file path')
+@click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
+@click.option('-d', '--depth', help='Summarize prefixes up to depth under root', type=int)
+@click.option('--top', help='Number of largest keys per prefix', type=int)
+@click.option('--keys-only/--no-keys-only', help='Only list keys to count, value sizes are not counted', default=None)
+@click.option('--sort', help='Sort prefixes by prefix, keys or bytes', type=click.Choice(['prefix', 'keys', 'bytes']))
+@click.pass_context
+def tree(ctx, **kwargs):
+    """
+    Summarize key count, value bytes and largest keys per prefix under root.
+    """
+    run_command(TreeCommand, ctx, kwargs)
+
+
+@cli.command(name='export-changes', short_help='Export key value changes as json lines')
+@click.option('--log-level', help='log level')
+@click.option('-c', '--config-file', help='Config file path', type=click.File('r'))
+@click.option('-h', '--host', help='Consul host')
+@click.option('-p', '--port', help='Consul port', type=int)
+@click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
+@click.option('-t', '--token', help='Consul ACL token')
+@click.option('-r', '--root', help='Search root for consul')
+@click.option('-o', '--output-file', help='Output file path')
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
+@click.option('--wait', help='Max wait time of each blocking query, e.g. 5m')
+@click.option('--initial/--no-initial', help='Export all keys as created if there is no saved state', default=None)
+@click.option('--once/--no-once', help='Export changes since saved state once and exit', default=None)
+@click.option('--with-values/--without-values', help='Add values to created and updated events', default=None)
+@click.pass_context
+def export_changes(ctx, **kwargs):
+    """
+    Export created, updated and deleted keys under root as json lines, until interrupted.
+    """
+    run_command(ExportChangesCommand, ctx, kwargs)
+
+
 @cli.command(short_help='Diff between two consul key values.')
 @click.option('--log-level', help='log level')
 @click.option('-c', '--config-file', help='Config file path', type=click.File('r'))
 @click.option('-h', '--host', help='Consul host')
 @click.option('-p', '--port', help='Consul port', type=int)
 @click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
 @click.option('-t', '--token', help='Consul ACL token')
 @click.option('-r', '--root', help='Search root for consul')
-@click.option('-x', '--output-type', help='Output type, text, csv or json', type=click.Choice(['text', 'json', 'csv']))
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
 @click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
 @click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
 @click.option('--host1', help='Consul host for group1, use --host if not specified')
 @click.option('--port1', help='Consul port for group1, use --port if not specified', type=int)
 @click.option('--scheme1', help='Consul scheme for group1, use --scheme if not specified')
 @click.option('--token1', help='Consul ACL token for group1, use --token if not specified')
 @click.option('--root1', help='Search root for consul for group1, use --root if not specified')
+@click.option('--snapshot1', help='Read key values for group1 from snapshot file in place of consul host')
 @click.option('--host2', help='Consul host for group2, use --host if not specified')
 @click.option('--port2', help='Consul port for group2, use --port if not specified', type=int)
 @click.option('--scheme2', help='Consul scheme for group2, use --scheme if not specified')
 @click.option('--token2', help='Consul ACL token for group2, use --token if not specified')
 @click.option('--root2', help='Search root for consul for group2, use --root if not specified')
+@click.option('--snapshot2', help='Read key values for group2 from snapshot file in place of consul host')
 @click.option('--with-same/--without-same', help='Output same values or not', default=False)
+@click.option('--semantic/--no-semantic', help='Compare json or yaml values by fields and report field level changes', default=None)
+@click.option('--decode/--no-decode', help='Compare gzip, zlib, zstd or base64 encoded values decoded', default=None)
+@click.option('--stream/--no-stream', help='Merge join sorted key values and stream results, '
+              'constant memory for snapshots only, live consul trees are read in memory', default=None)
 @click.pass_context
 def diff(ctx, **kwargs):
     """
     Compare consul key values between two consul locations.
     """
     run_command(DiffCommand, ctx, kwargs)
+
+
+@cli.group(short_help='Save or load snapshot file')
+def snapshot():
+    """
+    Save key values to snapshot file or load key values from snapshot file.
+    """
+    pass
+
+
+@snapshot.command(short_help='Save key values to snapshot file')
+@click.option('--log-level', help='log level')
+@click.option('-c', '--config-file', help='Config file path', type=click.File('r'))
+@click.option('-h', '--host', help='Consul host')
+@click.option('-p', '--port', help='Consul port', type=int)
+@click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
+@click.option('-t', '--token', help='Consul ACL token')
+@click.option('-r', '--root', help='Search root for consul')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
+@click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
+@click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
+@click.option('-f', '--file', help='Snapshot file path', required=True)
+@click.option('--block-size', help='Key values per compressed block', type=int)
+@click.pass_context
+def save(ctx, **kwargs):
+    """
+    Save consul key values under root to snapshot file.
+    """
+    run_command(SnapshotSaveCommand, ctx, kwargs)
+
+
+@snapshot.command(short_help='Load key values from snapshot file')
+@click.option('--log-level', help='log level')
+@click.option('-c', '--config-file', help='Config file path', type=click.File('r'))
+@click.option('-h', '--host', help='Consul host')
+@click.option('-p', '--port', help='Consul port', type=int)
+@click.option('--scheme', help='Consul scheme')
+@click.option('--consistency', help='Read consistency mode, default, consistent or stale', type=click.Choice(['default', 'consistent', 'stale']))
+@click.option('--servers', help='Comma separated consul server or agent addresses to spread reads across')
+@click.option('-t', '--token', help='Consul ACL token')
+@click.option('-r', '--root', help='Root in snapshot to load, use the root snapshot saved from if not specified')
+@click.option('-x', '--output-type', help='Output type, text, csv, json or parquet', type=click.Choice(['text', 'json', 'csv', 'parquet']))
+@click.option('-o', '--output-file', help='Output file path')
+@click.option('--memory-budget', help='Max memory of results, e.g. 512M, results over it are spilled to disk')
+@click.option('--clear-cache', help='Clear cache before search', default=False, is_flag=True)
+@click.option('--stats', help='Output phase timers and counters', default=None, is_flag=True)
+@click.option('--stats-format', help='Stats format, json or prometheus', type=click.Choice(['json', 'prometheus']))
+@click.option('--stats-file', help='Stats output file, leave empty to output to stderr')
+@click.option('--profile', help='Profile run by cProfile and write to file')
+@click.option('-f', '--file', help='Snapshot file path', required=True)
+@click.option('--target-root', help='Target root for consul, use root if not specified')
+@click.option('--delta/--no-delta', help='Only load keys that are missing or different in target', default=None)
+@click.option('--delete-extra/--no-delete-extra', help='Delete target keys that not exist in snapshot, only for delta load', default=None)
+@click.pass_context
+def load(ctx, **kwargs):
+    """
+    Load key values from snapshot file to consul.
+    """
+    run_command(SnapshotLoadCommand, ctx, kwargs)
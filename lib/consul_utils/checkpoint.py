@@ -0,0 +1,107 @@
+import os
+import json
+import logging
+from .exceptions import ConsulException
+
+
+class CopyCheckpoint:
+    """
+    Append-only checkpoint log for copy command.
+
+    The first line records source and target roots, each following line records one copied source key with its
+    ModifyIndex as json list [key, index]. Lines are flushed every flush_every keys, so at most flush_every keys
+    will be copied again after an interruption.
+    """
+
+    def __init__(self, filepath, source, target, flush_every=1000):
+        self._filepath = filepath
+        self._source = source
+        self._target = target
+        self._flush_every = flush_every
+        self._fp = None
+        self._pending = 0
+
+    def load(self):
+        """
+        Load copied keys from checkpoint file.
+
+        :return: dict of copied key to ModifyIndex
+        """
+        done = {}
+        if not os.path.exists(self._filepath):
+            return done
+        with open(self._filepath, 'r', encoding='utf8') as fp:
+            header = fp.readline()
+            if not header:
+                return done
+            header = json.loads(header)
+            if header.get('source') != self._source or header.get('target') != self._target:
+                raise ConsulException('Checkpoint {} is for copy from {} to {}'.format(
+                    self._filepath, header.get('source'), header.get('target')))
+            for line in fp:
+                try:
+                    key, index = json.loads(line)
+                except ValueError:
+                    # last line may be truncated by interruption
+                    logging.warning('Skip invalid checkpoint line {}'.format(line.strip()))
+                    continue
+                done[key] = index
+        return done
+
+    def open(self, resume=False):
+        """
+        Open checkpoint file to append, a new file is created if not resume.
+        """
+        if resume and os.path.exists(self._filepath):
+            with open(self._filepath, 'rb') as fp:
+                size = fp.seek(0, os.SEEK_END)
+                if size:
+                    fp.seek(-1, os.SEEK_END)
+                truncated = size > 0 and fp.read(1) != b'\n'
+            self._fp = open(self._filepath, 'a', encoding='utf8')
+            if truncated:
+                # terminate the line truncated by interruption
+                self._fp.write('\n')
+        else:
+            self._fp = open(self._filepath, 'w', encoding='utf8')
+            self._fp.write(json.dumps({'source': self._source, 'target': self._target}) + '\n')
+            self._fp.flush()
+        return self
+
+    def done(self, key, index):
+        """
+        Record a copied key.
+
+        :param key: source key
+        :param index: source ModifyIndex
+        """
+        self._fp.write(json.dumps([key, index]) + '\n')
+        self._pending += 1
+        if self._pending >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._fp:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+        self._pending = 0
+
+    def close(self):
+        if self._fp:
+            self.flush()
+            self._fp.close()
+            self._fp = None
+
+    def remove(self):
+        """
+        Remove checkpoint file after copy finished.
+        """
+        self.close()
+        if os.path.exists(self._filepath):
+            os.remove(self._filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
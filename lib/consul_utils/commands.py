@@ -1,16 +1,136 @@
 import os
+import sys
+import json
+import time
+import pickle
+import signal
+import cProfile
+import itertools
+import threading
+import collections
 import logging
-from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 import yaml
 from colorama import Fore, Back, Style
+from requests.exceptions import RequestException
 from hsettings import Settings
 from hsettings.loaders import DictLoader, YamlLoader
 from .search import ConsulKvSearch
-from .filters import BaseFilter, PairedFilter, SkipDirectoryFilter, SearchFilter, DiffFilter
-from .reporter import OUT_ALL_KEY, OUT_FILTERED_KEY, OUT_NON_FILTERED_KEY, OUT_FLAG_KEY, TextReporter, JsonReporter, CsvReport
+from .servers import CONSISTENCY_MODES
+from .filters import BaseFilter, PairedFilter, ChainFilter, NoFilter, SkipDirectoryFilter, SearchFilter, StructuredFilter, \
+    RankedSearchFilter, DiffFilter, build_filter_chain
+from .reporter import OUT_ALL_KEY, OUT_FILTERED_KEY, OUT_NON_FILTERED_KEY, OUT_FLAG_KEY, OUT_AGE_KEY, RecordStream, \
+    RecordTee, TextReporter, JsonReporter, CsvReport, ParquetReporter, to_str
+from .checkpoint import CopyCheckpoint
+from .snapshot import SnapshotWriter, SnapshotReader, SnapshotKvSearch
+from .tree import KeyTree, value_size
+from .stats import Stats
+from .spill import MemoryBudget, parse_size
 from .exceptions import ConsulException, FilterStop
 
 
+def join_key_values(vals1, root1, vals2, root2):
+    """
+    Join two key value lists by the key path relative to their roots.
+
+    :param vals1: key values under root1
+    :param root1:
+    :param vals2: key values under root2
+    :param root2:
+    :return: tuple of (key values only in vals1, key values only in vals2, paired (kv1, kv2) in both sides)
+    """
+    dt1 = {kv['key'][len(root1):]: kv for kv in vals1}
+    dt2 = {kv['key'][len(root2):]: kv for kv in vals2}
+    only1 = [kv for k, kv in dt1.items() if k not in dt2]
+    only2 = [kv for k, kv in dt2.items() if k not in dt1]
+    both = [(kv, dt2[k]) for k, kv in dt1.items() if k in dt2]
+    return only1, only2, both
+
+
+def merge_key_values(vals1, root1, vals2, root2):
+    """
+    Merge join two key value iterables sorted by key, by the key path relative to their roots.
+
+    Only the current key value of each side is held, so memory is constant however large the inputs are.
+
+    :param vals1: key values under root1 sorted by key
+    :param root1:
+    :param vals2: key values under root2 sorted by key
+    :param root2:
+    :return: generator of (kv1, kv2) in key order, kv1 or kv2 is None if the key only exists in the other side
+    """
+    it1 = iter(vals1)
+    it2 = iter(vals2)
+    kv1 = next(it1, None)
+    kv2 = next(it2, None)
+    while kv1 is not None or kv2 is not None:
+        if kv2 is None or (kv1 is not None and kv1['key'][len(root1):] < kv2['key'][len(root2):]):
+            yield kv1, None
+            kv1 = next(it1, None)
+        elif kv1 is None or kv2['key'][len(root2):] < kv1['key'][len(root1):]:
+            yield None, kv2
+            kv2 = next(it2, None)
+        else:
+            yield kv1, kv2
+            kv1 = next(it1, None)
+            kv2 = next(it2, None)
+
+
+def key_changes(state, vals, index, with_values=True):
+    """
+    Compare key values with the last known state of keys.
+
+    :param state: dict of key to ModifyIndex
+    :param vals: current key values with ModifyIndex as index
+    :param index: consul index of vals, used as index of deleted keys
+    :param with_values: add value to created and updated events
+    :return: tuple of (events sorted by index, new state), event op is created, updated or deleted
+    """
+    new_state = {}
+    events = []
+    for kv in vals:
+        key = kv['key']
+        new_state[key] = kv['index']
+        old = state.get(key)
+        if old is None:
+            op = 'created'
+        elif old != kv['index']:
+            op = 'updated'
+        else:
+            continue
+        event = {'op': op, 'key': key, 'index': kv['index']}
+        if with_values:
+            event['value'] = to_str(kv['value'])
+        events.append(event)
+    for key in state:
+        if key not in new_state:
+            events.append({'op': 'deleted', 'key': key, 'index': index})
+    events.sort(key=lambda e: (e['index'], e['key']))
+    return events, new_state
+
+
+def filter_chunk(fil, chunk, start):
+    """
+    Evaluate filter on a chunk of (key, value) in worker process.
+
+    :param fil: filter
+    :param chunk: list of (key, value, ModifyIndex)
+    :param start: index of the first key value
+    :return: tuple of (list of passed or not, filter results, memo updates), list is shorter than chunk if filter
+        stopped
+    """
+    mask = []
+    if not chunk:
+        return mask, fil.get_results(), fil.get_memo_updates()
+    keys, values, modify_indexes = zip(*chunk)
+    try:
+        for passed in fil.filter_many(keys, values, modify_indexes, start=start):
+            mask.append(fil.count(passed))
+    except FilterStop:
+        pass
+    return mask, fil.get_results(), fil.get_memo_updates()
+
+
 class BaseConsulCommand:
     """
     Base command class.
@@ -22,19 +142,32 @@ class BaseConsulCommand:
             'port': 8500,
             'scheme': 'http',
             'token': '',
-            'root': ''
+            'root': '',
+            'roots': [],
+            'snapshot': '',
+            'consistency': 'default',
+            'servers': [],
+            'server_cooldown': 30
         },
         'cache': {
             'cache_enabled': True,
             'cache_dir': '.consul_cache',
-            'cache_ttl': 600
+            'cache_ttl': 600,
+            'memo_ttl': 604800,
+            'mmap': False,
+            'stale_grace': 0,
+            'refresh_timeout': 60,
+            'lease_ttl': 60
         },
         'reporter': {
             'output_type': 'text',
             'output_file': '',
             'show_all_scan': False,
             'show_filtered': True,
-            'show_flags': False
+            'show_flags': False,
+            'show_age': False,
+            'memory_budget': 0,
+            'spill_dir': ''
         },
         'log': {
             'log_level': 'ERROR',
@@ -42,8 +175,68 @@ class BaseConsulCommand:
         },
         'search': {
             'limit': 10,
-            'fields': 'key',
-            'regex': False
+            'fields': 'keys',
+            'regex': False,
+            'regex_backend': 're',
+            'max_value_size': 0,
+            'time_budget': 0,
+            'ranked': False,
+            'min_score': 0.5
+        },
+        'decode': {
+            'enabled': False,
+            'auto': True,
+            'prefixes': [],
+            'max_size': 67108864,
+            'memo_max_size': 1048576,
+            'memo_max_total': 67108864
+        },
+        'diff': {
+            'semantic': False,
+            'stream': False
+        },
+        'filter': {
+            'workers': 1,
+            'chunk_size': 2000,
+            'parallel_min_size': 10000
+        },
+        'stats': {
+            'enabled': False,
+            'format': 'json',
+            'output_file': '',
+            'profile_file': ''
+        },
+        'copy': {
+            'delta': False,
+            'delete_extra': False,
+            'checkpoint_file': '',
+            'checkpoint_interval': 1000,
+            'resume': False
+        },
+        'delete': {
+            'keys_file': '',
+            'dry_run': False,
+            'batch_size': 64,
+            'limit': 0
+        },
+        'tree': {
+            'depth': 2,
+            'top': 3,
+            'keys_only': False,
+            'sort': 'prefix'
+        },
+        'export': {
+            'wait': '5m',
+            'initial': False,
+            'once': False,
+            'with_values': True,
+            'save_interval': 10,
+            'retry_interval': 5
+        },
+        'snapshot': {
+            'file': '',
+            'block_size': 1000,
+            'compress_level': 6
         }
     }
 
@@ -52,9 +245,12 @@ class BaseConsulCommand:
         self._ctx = ctx
         self.args = args
         self._client = None
+        self._clients = []
         self._console_handlers = []
+        self._memory_budget = None
         self.parse_config()
         self._init_logger()
+        self.stats = Stats(command=str(self))
 
     def get_consul_search_client(self, **kwargs):
         conf = {
@@ -65,12 +261,113 @@ class BaseConsulCommand:
             'root': self.settings.get('consul.root'),
             'cache_enabled': self.settings.get('cache.cache_enabled'),
             'cache_dir': self.settings.get('cache.cache_dir'),
-            'cache_ttl': self.settings.get('cache.cache_ttl')
+            'cache_ttl': self.settings.get('cache.cache_ttl'),
+            'memo_ttl': self.settings.get('cache.memo_ttl', None),
+            'mmap_enabled': self.settings.get('cache.mmap', False),
+            'stale_grace': self.settings.get('cache.stale_grace', 0),
+            'lease_ttl': self.settings.get('cache.lease_ttl', 0),
+            'snapshot': self.settings.get('consul.snapshot', ''),
+            'consistency': self.settings.get('consul.consistency', 'default'),
+            'servers': self.get_servers(),
+            'server_cooldown': self.settings.get('consul.server_cooldown', 30),
+            'stats': self.stats
         }
+        if conf['consistency'] not in CONSISTENCY_MODES:
+            raise ConsulException('Invalid consistency {}, must be one of {}'.format(
+                conf['consistency'], ', '.join(CONSISTENCY_MODES)))
+        if kwargs.get('host') and kwargs['host'] != conf['host']:
+            # servers are of the configured consul, not of other hosts like diff or copy target
+            conf['servers'] = []
         if kwargs:
             conf.update(kwargs)
         conf = {k: v for k, v in conf.items() if v is not None}
-        return ConsulKvSearch(**conf)
+        snapshot = conf.pop('snapshot', '')
+        if snapshot:
+            # read key values from snapshot file in place of consul host
+            client = SnapshotKvSearch(snapshot=snapshot, **conf)
+        else:
+            client = ConsulKvSearch(**conf)
+        self._clients.append(client)
+        return client
+
+    def get_servers(self):
+        """
+        Get consul server or agent addresses to spread reads across, in config list or comma separated.
+
+        :return: list of addresses
+        """
+        servers = self.settings.get('consul.servers', [])
+        if isinstance(servers, str):
+            servers = servers.split(',')
+        return [s.strip() for s in servers or [] if s and s.strip()]
+
+    def get_roots(self):
+        """
+        Get roots to read, consul.roots in config list or comma separated replaces consul.root if set.
+
+        :return: list of roots
+        """
+        roots = self.settings.get('consul.roots', [])
+        if isinstance(roots, str):
+            roots = roots.split(',')
+        roots = [r.strip() for r in roots or [] if r and r.strip()]
+        return roots or [self.settings.get('consul.root', '')]
+
+    def get_root(self):
+        """
+        Get the root of commands reading one root.
+
+        :raise ConsulException: if multiple roots are set
+        """
+        roots = self.get_roots()
+        if len(roots) > 1:
+            raise ConsulException('{} takes one root, found {}'.format(self, ', '.join(roots)))
+        return roots[0]
+
+    @property
+    def memory_budget(self):
+        """
+        Memory budget of result lists, None if reporter.memory_budget is not set.
+        """
+        if self._memory_budget is None:
+            max_bytes = parse_size(self.settings.get('reporter.memory_budget', 0) or 0)
+            if max_bytes > 0:
+                self._memory_budget = MemoryBudget(max_bytes, spill_dir=self.settings.get('reporter.spill_dir', ''),
+                                                   stats=self.stats)
+        return self._memory_budget
+
+    def new_results(self):
+        """
+        New list of results, spilled to disk when memory budget is exceeded if set.
+        """
+        budget = self.memory_budget
+        return budget.new_list() if budget is not None else []
+
+    def get_ages(self):
+        """
+        Get age of key values got by all clients of this command.
+
+        :return: list of key and age in seconds, stale if older than cache_ttl
+        """
+        ages = []
+        for client in self._clients:
+            for key, age in client.ages.items():
+                ages.append({
+                    'key': key,
+                    'value': None if age is None else int(age),
+                    'stale': age is not None and client.cache_ttl is not None and age > client.cache_ttl
+                })
+        return ages
+
+    def wait_refresh(self):
+        """
+        Wait for background cache refreshes of all clients, at most cache.refresh_timeout seconds.
+        """
+        timeout = self.settings.get('cache.refresh_timeout', 60)
+        deadline = time.time() + float(timeout)
+        for client in self._clients:
+            if not client.wait_refresh(max(deadline - time.time(), 0)):
+                logging.warning('Background cache refresh is not finished in {}s'.format(timeout))
 
     def run(self):
         """
@@ -97,7 +394,7 @@ class BaseConsulCommand:
             if isinstance(self.args['config_file'], str) and os.path.exists(self.args['config_file']):
                 d = YamlLoader.load(self.args['config_file'])
             else:
-                d = yaml.load(self.args['config_file'])
+                d = yaml.safe_load(self.args['config_file'])
             if not isinstance(d, (dict, Settings)):
                 raise ConsulException('Invalid config file {}'.format(self.args['config_file']))
             self._settings.merge(d)
@@ -111,15 +408,61 @@ class BaseConsulCommand:
             self._settings.merge(d)
             if self._ctx:
                 self._ctx.obj['setting'] = self._settings
+        roots = self.get_roots()
+        if len(roots) == 1:
+            # one root in roots is the root, so every command reads it
+            self._settings.set('consul.root', roots[0])
 
     def run_and_report(self):
         """
         Run command and report.
+
+        Run is profiled by cProfile if stats.profile_file is set, stats are reported if stats.enabled is set.
         """
-        res = self.run()
-        out_type = self.settings.get('reporter.output_type', 'text')
-        reporter = self.get_reporter(out_type)
-        return reporter.report(res)
+        profile_file = self.settings.get('stats.profile_file', '')
+        if profile_file:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                res = self._run_and_report()
+            finally:
+                profiler.disable()
+                profiler.dump_stats(profile_file)
+                logging.info('Write profile to {}'.format(profile_file))
+        else:
+            res = self._run_and_report()
+        # results are already reported, refresh stale cache for later runs
+        self.wait_refresh()
+        if self.settings.get('stats.enabled', False):
+            self.report_stats()
+        return res
+
+    def _run_and_report(self):
+        try:
+            with self.stats.timer('run'):
+                res = self.run()
+            if isinstance(res, dict):
+                res[OUT_AGE_KEY] = self.get_ages()
+            out_type = self.settings.get('reporter.output_type', 'text')
+            reporter = self.get_reporter(out_type)
+            with self.stats.timer('report'):
+                return reporter.report(res)
+        finally:
+            if self._memory_budget is not None:
+                # remove spilled results
+                self._memory_budget.close()
+
+    def report_stats(self):
+        """
+        Output stats to stats.output_file or stderr.
+        """
+        out = self.stats.format(self.settings.get('stats.format', 'json'))
+        filepath = self.settings.get('stats.output_file', '')
+        if filepath:
+            with open(filepath, 'w', encoding='utf8') as fp:
+                fp.write(out + '\n')
+        else:
+            sys.stderr.write(out + '\n')
 
     def get_reporter(self, rtype):
         """
@@ -132,9 +475,10 @@ class BaseConsulCommand:
             'text': TextReporter,
             'json': JsonReporter,
             'csv': CsvReport,
+            'parquet': ParquetReporter,
         }
         if rtype in types:
-            return types[rtype](self.settings)
+            return types[rtype](self.settings, stats=self.stats)
         raise ConsulException('Invalid output type {}'.format(rtype))
 
     def get_config_mapping(self):
@@ -149,9 +493,20 @@ class BaseConsulCommand:
             'scheme': 'consul.scheme',
             'token': 'consul.token',
             'root': 'consul.root',
+            'roots': 'consul.roots',
+            'snapshot': 'consul.snapshot',
+            'consistency': 'consul.consistency',
+            'servers': 'consul.servers',
             'log_level': 'log.log_level',
             'output_type': 'reporter.output_type',
             'output_file': 'reporter.output_file',
+            'stats': 'stats.enabled',
+            'stats_format': 'stats.format',
+            'stats_file': 'stats.output_file',
+            'profile': 'stats.profile_file',
+            'memory_budget': 'reporter.memory_budget',
+            'workers': 'filter.workers',
+            'decode': 'decode.enabled',
         }
 
     def _init_logger(self):
@@ -216,6 +571,8 @@ class FilterCommand(BaseConsulCommand):
 
     filter_class = None
     filter = None
+    # setting of filter chain which replaces filter_class if set
+    chain_setting = 'filter.chain'
 
     def run(self):
         """
@@ -233,29 +590,28 @@ class FilterCommand(BaseConsulCommand):
         if 'clear_cache' in self.args and self.args['clear_cache']:
             logging.info('Clear all cache')
             consul.clear_cache()
-        root = self.settings.get('consul.root', '')
+        roots = self.get_roots()
+        # memo of filter is kept for roots read together
+        root = ','.join(roots)
+        # init filter
+        if self.filter is None:
+            self.filter = self.create_filter()
         # get consul kv
-        vals = consul.get(root)
-        filtered = []
-        no_filtered = []
+        vals = self.get_values(consul, root)
         flags = {}
-        # init filter
-        if self.filter is None and self.filter_class:
-            self.filter = self.filter_class(self.settings)
         if isinstance(self.filter, BaseFilter):
-            try:
-                if vals is None:
-                    logging.warning('There is no keys in Consul.')
-                    return
-                for i in range(len(vals)):
-                    val = vals[i]
-                    # pass filter
-                    if self.filter.filter(key=val['key'], value=val['value'], index=i):
-                        filtered.append(val)
-                    else:
-                        no_filtered.append(val)
-            except FilterStop as e:
-                logging.debug(e)
+            if vals is None:
+                logging.warning('There is no keys in Consul.')
+                return
+            self.filter.prepare(consul, root)
+            with self.stats.timer('filter'):
+                filtered, no_filtered = self.filter_values(vals)
+            self.filter.finish(consul, root)
+            self.stats.incr('filter_evaluations', len(filtered) + len(no_filtered))
+            if isinstance(self.filter, ChainFilter):
+                self.stats.incr('chain_evaluations', self.filter.total_evaluations())
+            if getattr(self.filter, 'decoder', None) is not None:
+                self.stats.incr('values_decoded', self.filter.decoder.decoded)
             # get other filter results
             res = self.filter.get_results()
             if res:
@@ -263,10 +619,150 @@ class FilterCommand(BaseConsulCommand):
         else:
             logging.warning('Invalid filter {}'.format(self.filter))
             return self.parse_output({})
+        if self.memory_budget is not None:
+            # key values got from consul are released before reporting, all key values are only kept if reported
+            scan = self.new_results()
+            if self.settings.get('reporter.show_all_scan', False):
+                scan.extend(vals)
+            vals = scan
         # build and parse data to reporter
         data = {OUT_ALL_KEY: vals, OUT_FILTERED_KEY: filtered, OUT_NON_FILTERED_KEY: no_filtered, OUT_FLAG_KEY: flags}
         return self.parse_output(data)
 
+    def create_filter(self):
+        """
+        Create filter chain from config if set, otherwise filter of filter_class.
+
+        :return: filter or None
+        """
+        spec = self.settings.get(self.chain_setting, None) if self.chain_setting else None
+        if spec:
+            return build_filter_chain(self.settings, spec, limit=self.filter_limit())
+        return self.filter_class(self.settings) if self.filter_class else None
+
+    def filter_limit(self):
+        """
+        Limit of key values passed filter chain, None means no limit.
+        """
+        return None
+
+    def get_values(self, consul, root):
+        """
+        Get key values under root to filter.
+
+        Key values of multiple roots are labelled by root, in order of roots.
+
+        :param consul: ConsulKvSearch
+        :param root:
+        :return: key values
+        """
+        with_index = bool(getattr(self.filter, 'with_index', False))
+        roots = self.get_roots()
+        if len(roots) > 1:
+            vals = []
+            for r, kvs in consul.get_roots(roots, with_index=with_index):
+                vals.extend(dict(kv, root=r) for kv in kvs)
+            return vals
+        return consul.get(root, with_index=with_index)
+
+    def filter_values(self, vals):
+        """
+        Pass key values through filter.
+
+        :param vals: key values
+        :return: tuple of (filtered, non-filtered)
+        """
+        filtered = self.new_results()
+        no_filtered = self.new_results()
+        try:
+            for val, passed in self.filter_passes(vals):
+                if passed:
+                    filtered.append(val)
+                else:
+                    no_filtered.append(val)
+        except FilterStop as e:
+            logging.debug(e)
+        return filtered, no_filtered
+
+    def filter_passes(self, vals):
+        """
+        Evaluate filter on key values in worker processes if set and worth it, otherwise in this process.
+
+        :param vals: key values
+        :return: generator of (key value, passed or not) in order
+        """
+        workers = self.get_workers(len(vals))
+        if workers > 1:
+            return self._filter_parallel(vals, workers)
+        return self._filter_serial(vals)
+
+    def get_workers(self, size):
+        """
+        Get number of worker processes to filter size key values, 0 means cpu count.
+        """
+        workers = int(self.settings.get('filter.workers', 1))
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        if workers > 1:
+            if size < int(self.settings.get('filter.parallel_min_size', 10000)):
+                return 1
+            try:
+                pickle.dumps(self.filter)
+            except Exception as e:
+                logging.warning('Filter {} can not be sent to worker processes: {}'.format(self.filter, e))
+                return 1
+        return workers
+
+    def _filter_serial(self, vals):
+        """
+        Evaluate filter on chunks of key values by filter_many, results are passed through filter count in order.
+        """
+        chunk_size = max(int(self.settings.get('filter.chunk_size', 2000)), 1)
+        for start in range(0, len(vals), chunk_size):
+            chunk = vals[start:start + chunk_size]
+            mask = self.filter.filter_many([val['key'] for val in chunk], [val['value'] for val in chunk],
+                                           [val.get('index') for val in chunk], start=start)
+            for val, passed in zip(chunk, mask):
+                yield val, self.filter.count(passed)
+
+    def _filter_parallel(self, vals, workers):
+        """
+        Evaluate filter on chunks of key values in worker processes, results are replayed in order through
+        filter count, so limit of filter still works.
+
+        Chunks are submitted in a window of two chunks per worker ahead of the chunk replayed, so chunks after the
+        filter stopped are never evaluated.
+        """
+        chunk_size = max(int(self.settings.get('filter.chunk_size', 2000)), 1)
+        window = workers * 2
+        results = []
+        memo_updates = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            starts = iter(range(0, len(vals), chunk_size))
+            try:
+                while True:
+                    for start in itertools.islice(starts, window - len(pending)):
+                        chunk = [(val['key'], val['value'], val.get('index')) for val in vals[start:start + chunk_size]]
+                        pending.append((start, executor.submit(filter_chunk, self.filter, chunk, start)))
+                    if not pending:
+                        break
+                    start, future = pending.popleft()
+                    mask, res, memo = future.result()
+                    results.append(res)
+                    memo_updates.append(memo)
+                    for i, passed in enumerate(mask):
+                        yield vals[start + i], self.filter.count(passed)
+                    if start + len(mask) < min(start + chunk_size, len(vals)):
+                        raise FilterStop('Filter stopped in worker process')
+            finally:
+                for start, future in pending:
+                    future.cancel()
+                if sys.version_info >= (3, 9):
+                    executor.shutdown(cancel_futures=True)
+                self.filter.merge_results(results)
+                self.filter.merge_memo_updates(memo_updates)
+
 
 class PairedFilterCommand(BaseConsulCommand):
     """
@@ -275,6 +771,8 @@ class PairedFilterCommand(BaseConsulCommand):
 
     filter_class = None
     filter = None
+    # setting of paired filter chain which replaces filter_class if set
+    chain_setting = None
 
     def run(self):
         """
@@ -298,42 +796,57 @@ class PairedFilterCommand(BaseConsulCommand):
         if 'clear_cache' in self.args and self.args['clear_cache']:
             logging.info('Clear all cache')
             consul2.clear_cache()
-        root1 = self._get_conf_n(1, 'root')
-        root2 = self._get_conf_n(2, 'root')
+        root1 = self._get_conf_n(1, 'root') or self.get_root()
+        root2 = self._get_conf_n(2, 'root') or self.get_root()
+        if self.stream_enabled():
+            return self.run_stream(consul1, root1, consul2, root2)
+        # init filter
+        if self.filter is None:
+            self.filter = self.create_filter()
         # get consul kv
-        vals1 = consul1.get(root1)
+        vals1 = consul1.get(root1, with_index=bool(getattr(self.filter, 'with_index', False)))
         vals2 = consul2.get(root2)
-        vals = []
-        filtered = []
-        no_filtered = []
+        vals = self.new_results()
+        filtered = self.new_results()
+        no_filtered = self.new_results()
         flags = {}
-        # init filter
-        if self.filter is None and self.filter_class:
-            self.filter = self.filter_class(self.settings)
+        # with memory budget, all pairs are only kept if reported
+        keep_scan = self.memory_budget is None or self.settings.get('reporter.show_all_scan', False)
         # add data that only exists in one side
-        dt1 = {kv['key'][len(root1):]: kv['value'] for kv in vals1}
-        dt2 = {kv['key'][len(root2):]: kv['value'] for kv in vals2}
-        for k, v in dt1.items():
-            if k not in dt2:
-                vals.append(({'key': k, 'value': v}, {'key': None, 'value': None}))
-                filtered.append(({'key': k, 'value': v}, {'key': None, 'value': None}))
-        for k, v in dt2.items():
-            if k not in dt1:
-                vals.append(({'key': None, 'value': None}, {'key': k, 'value': v}))
-                filtered.append(({'key': None, 'value': None}, {'key': k, 'value': v}))
+        only1, only2, both = join_key_values(vals1 or [], root1, vals2 or [], root2)
+        for kv in only1:
+            k = kv['key'][len(root1):]
+            pair = ({'key': k, 'value': kv['value']}, {'key': None, 'value': None})
+            if keep_scan:
+                vals.append(pair)
+            filtered.append(pair)
+        for kv in only2:
+            k = kv['key'][len(root2):]
+            pair = ({'key': None, 'value': None}, {'key': k, 'value': kv['value']})
+            if keep_scan:
+                vals.append(pair)
+            filtered.append(pair)
         # filter data that exists in both sides
-        if isinstance(self.filter, PairedFilter):
-            for kv1, kv2 in product(vals1, vals2):
-                k1 = kv1['key'][len(root1):]
-                k2 = kv2['key'][len(root2):]
-                if k1 != k2:
-                    continue
-                vals.append((kv1, kv2))
+        if isinstance(self.filter, (PairedFilter, ChainFilter)):
+            self.filter.prepare(consul1, '{}|{}'.format(root1, root2))
+            with self.stats.timer('filter'):
                 # pass filter
-                if self.filter.filter(key1=kv1['key'], value1=kv1['value'], key2=kv2['key'], value2=kv2['value'], index=(len(vals) - 1)):
-                    filtered.append((kv1, kv2))
-                else:
-                    no_filtered.append((kv1, kv2))
+                mask = self.filter.filter_many([kv1['key'] for kv1, _ in both], [kv1['value'] for kv1, _ in both],
+                                               [kv2['key'] for _, kv2 in both], [kv2['value'] for _, kv2 in both],
+                                               [kv1.get('index') for kv1, _ in both], start=len(only1) + len(only2))
+                for pair, passed in zip(both, mask):
+                    if keep_scan:
+                        vals.append(pair)
+                    if self.filter.count(passed):
+                        filtered.append(pair)
+                    else:
+                        no_filtered.append(pair)
+            self.filter.finish(consul1, '{}|{}'.format(root1, root2))
+            self.stats.incr('filter_evaluations', len(both))
+            if isinstance(self.filter, ChainFilter):
+                self.stats.incr('chain_evaluations', self.filter.total_evaluations())
+            if getattr(self.filter, 'decoder', None) is not None:
+                self.stats.incr('values_decoded', self.filter.decoder.decoded)
             res = self.filter.get_results()
             if res:
                 flags[self.filter.flag] = res
@@ -344,10 +857,102 @@ class PairedFilterCommand(BaseConsulCommand):
         data = {OUT_ALL_KEY: vals, OUT_FILTERED_KEY: filtered, OUT_NON_FILTERED_KEY: no_filtered, OUT_FLAG_KEY: flags}
         return self.parse_output(data)
 
+    def create_filter(self):
+        """
+        Create paired filter chain from config if set, otherwise filter of filter_class.
+
+        :return: filter or None
+        """
+        spec = self.settings.get(self.chain_setting, None) if self.chain_setting else None
+        if spec:
+            return build_filter_chain(self.settings, spec, paired=True)
+        return self.filter_class(self.settings) if self.filter_class else None
+
+    def stream_enabled(self) -> bool:
+        """
+        Merge join sorted key values and stream results to reporter instead of joining lists in memory.
+        """
+        return False
+
+    def run_stream(self, consul1, root1, consul2, root2):
+        """
+        Run command by merge join of two sorted key value streams.
+
+        Both sides are merged and filtered once. Records of the first reported section are streamed, so memory is
+        constant if only one section is output, records of other output sections are kept in results until reported.
+        Filter results are set to flags after the pass, flags are reported after other sections.
+        """
+        if self.filter is None:
+            self.filter = self.create_filter()
+        if not isinstance(self.filter, (PairedFilter, ChainFilter)):
+            logging.warning('Invalid filter {}'.format(self.filter))
+            return self.parse_output({})
+        flags = {}
+        sections = {
+            OUT_ALL_KEY: 'reporter.show_all_scan',
+            OUT_FILTERED_KEY: 'reporter.show_filtered',
+            OUT_NON_FILTERED_KEY: 'reporter.show_no_filtered',
+        }
+        shown = [k for k, v in sections.items() if self.settings.get(v, k == OUT_FILTERED_KEY)]
+        tee = RecordTee(self.iter_merged(consul1, root1, consul2, root2, flags), shown, self.new_results)
+        data = {k: tee.stream(k) for k in sections}
+        data[OUT_FLAG_KEY] = flags
+        if not shown:
+            # only flags are reported, run the pass to get filter results
+            tee.drain()
+        return self.parse_output(data)
+
+    def iter_merged(self, consul1, root1, consul2, root2, flags):
+        """
+        Merge join key values of two sides, pass pairs in both sides through filter and yield pairs with their sections.
+
+        :return: generator of (pair, sections of pair)
+        """
+        fil = self.filter
+        memo_root = '{}|{}'.format(root1, root2)
+        fil.prepare(consul1, memo_root)
+        chunk_size = max(int(self.settings.get('filter.chunk_size', 2000)), 1)
+        index = 0
+        evaluations = 0
+        with_index = bool(getattr(fil, 'with_index', False))
+        merged = merge_key_values(consul1.iter_key_values(root1, with_index=with_index), root1,
+                                  consul2.iter_key_values(root2), root2)
+        while True:
+            # pairs in both sides of each chunk are filtered at once
+            chunk = list(itertools.islice(merged, chunk_size))
+            if not chunk:
+                break
+            both = [(kv1, kv2) for kv1, kv2 in chunk if kv1 is not None and kv2 is not None]
+            mask = iter(fil.filter_many([kv1['key'] for kv1, _ in both], [kv1['value'] for kv1, _ in both],
+                                        [kv2['key'] for _, kv2 in both], [kv2['value'] for _, kv2 in both],
+                                        [kv1.get('index') for kv1, _ in both], start=index))
+            evaluations += len(both)
+            for kv1, kv2 in chunk:
+                if kv2 is None:
+                    pair = ({'key': kv1['key'][len(root1):], 'value': kv1['value']}, {'key': None, 'value': None})
+                    passed = True
+                elif kv1 is None:
+                    pair = ({'key': None, 'value': None}, {'key': kv2['key'][len(root2):], 'value': kv2['value']})
+                    passed = True
+                else:
+                    pair = (kv1, kv2)
+                    passed = fil.count(next(mask))
+                index += 1
+                yield pair, (OUT_ALL_KEY, OUT_FILTERED_KEY if passed else OUT_NON_FILTERED_KEY)
+        fil.finish(consul1, memo_root)
+        self.stats.incr('filter_evaluations', evaluations)
+        if isinstance(fil, ChainFilter):
+            self.stats.incr('chain_evaluations', fil.total_evaluations())
+        if getattr(fil, 'decoder', None) is not None:
+            self.stats.incr('values_decoded', fil.decoder.decoded)
+        res = fil.get_results()
+        if res:
+            flags[fil.flag] = res
+
     def get_consul_client(self, n):
         n = str(n)
         conf = {}
-        keys = ['host', 'port', 'scheme', 'token', 'root']
+        keys = ['host', 'port', 'scheme', 'token', 'root', 'snapshot']
         for k in keys:
             v = self._get_conf_n(n, k)
             if v:
@@ -355,7 +960,7 @@ class PairedFilterCommand(BaseConsulCommand):
         return self.get_consul_search_client(**conf)
 
     def _get_conf_n(self, n, key):
-        newkey = key + n
+        newkey = key + str(n)
         if newkey in self.args and self.args[newkey]:
             return self.args[newkey]
         return None
@@ -370,13 +975,96 @@ class SearchCommand(FilterCommand):
 
     filter_class = SearchFilter
 
+    def __init__(self, settings=None, ctx=None, args=None):
+        super().__init__(settings, ctx, args)
+        if self.settings.get('search.structured', False):
+            self.filter_class = StructuredFilter
+        elif self.settings.get('search.ranked', False):
+            self.filter_class = RankedSearchFilter
+
+    def run(self):
+        if self.settings.get('cache.mmap', False) and not ('clear_cache' in self.args and self.args['clear_cache']):
+            res = self.run_mmap()
+            if res is not None:
+                return res
+        return super().run()
+
+    def filter_values(self, vals):
+        """
+        Pass key values through filter, ranked search reports the best limit key values by score.
+        """
+        if not isinstance(self.filter, RankedSearchFilter):
+            return super().filter_values(vals)
+        try:
+            for _ in self.filter_passes(vals):
+                pass
+        except FilterStop as e:
+            logging.debug(e)
+        ranked = self.filter.ranked()
+        filtered = [dict(vals[i], score=round(score, 4)) for score, i in ranked]
+        kept = set(i for _, i in ranked)
+        no_filtered = self.new_results()
+        no_filtered.extend(val for i, val in enumerate(vals) if i not in kept)
+        # ranked key values are reported as filtered, not as filter results
+        self.filter.reset()
+        return filtered, no_filtered
+
+    def run_mmap(self):
+        """
+        Search key values in memory mapped cache file, keys or values are scanned as bytes and only results are
+        decoded.
+
+        :return: data to report or None if search can not run on memory mapped cache file
+        """
+        if self.filter is None:
+            self.filter = self.create_filter()
+        if type(self.filter) is not SearchFilter or self.filter.time_budget > 0 or self.filter.decoder is not None \
+                or (self.filter.max_value_size and self.filter.fields != 'keys') or len(self.get_roots()) > 1:
+            # time budget is checked by filter between batches of key values, decoded values are not in the file,
+            # value size cap counts characters of decoded values, each file is of one root
+            return None
+        consul = self.get_consul_search_client()
+        root = self.get_root()
+        kvfile = consul.get_mmap(root)
+        if kvfile is None:
+            return None
+        matched = []
+        stop = len(kvfile)
+        i = None
+        try:
+            with self.stats.timer('filter'):
+                for i in kvfile.search(self.filter.get_bytes_query(), fields=self.filter.fields, regex=self.filter.regex):
+                    self.filter.count(True)
+                    matched.append(i)
+        except FilterStop as e:
+            logging.debug(e)
+            stop = i
+        self.stats.incr('filter_evaluations', stop)
+        matched_set = set(matched)
+        data = {
+            OUT_ALL_KEY: RecordStream(kvfile.iter_records),
+            OUT_FILTERED_KEY: [kvfile.record(i) for i in matched],
+            OUT_NON_FILTERED_KEY: RecordStream(lambda: (kvfile.record(i) for i in range(stop) if i not in matched_set)),
+            OUT_FLAG_KEY: {}
+        }
+        return self.parse_output(data)
+
+    def filter_limit(self):
+        return int(self.settings.get('search.limit', 10))
+
     def get_config_mapping(self):
         m = super().get_config_mapping()
         m.update({
             'regex': 'search.regex',
+            'regex_backend': 'search.regex_backend',
+            'max_value_size': 'search.max_value_size',
+            'time_budget': 'search.time_budget',
             'fields': 'search.fields',
             'limit': 'search.limit',
             'query': 'search.query',
+            'structured': 'search.structured',
+            'ranked': 'search.ranked',
+            'min_score': 'search.min_score',
         })
         return m
 
@@ -386,30 +1074,132 @@ class CopyCommand(FilterCommand):
     filter_class = SkipDirectoryFilter
 
     COPY_FLAG = 'copy'
+    SKIP_FLAG = 'skip'
+    DELETE_FLAG = 'delete'
+    CHECKPOINT_FLAG = 'checkpoint'
+
+    def run(self):
+        self.get_root()
+        return super().run()
+
+    def get_values(self, consul, root):
+        # ModifyIndex is recorded in checkpoint, get fresh values to find stale keys when resume
+        if self.settings.get('copy.checkpoint_file', ''):
+            return consul.get(root, refresh=bool(self.settings.get('copy.resume', False)), with_index=True)
+        return super().get_values(consul, root)
 
     def parse_output(self, data):
         root = self.args['root']
         troot = self.args['target_root']
         target_consul = self._get_target_client()
         copy_keys = []
+        skip_keys = []
+        delete_keys = []
+        checkpoint_keys = []
         if 'filtered' in data:
+            sources = []
             for d in data['filtered']:
                 if 'key' in d and 'value' in d:
-                    newkey = troot + d['key'][len(root):]
-                    target_consul.put(key=newkey, value=d['value'])
-                    copy_keys.append({'key': newkey, 'value': d['value']})
-                    logging.info('Copy key from {} to {}'.format(d['key'], newkey))
+                    sources.append(d)
                 else:
                     logging.warning('Skip invalid data to put {}'.format(d))
+            extra = []
+            if self.settings.get('copy.delta', False):
+                # only put keys that are missing or different in the target
+                sources, skip_keys, extra = self._get_delta(target_consul, sources, root, troot)
+            checkpoint = self._get_checkpoint(root, troot)
+            if checkpoint:
+                sources, checkpoint_keys = self._skip_checkpoint(checkpoint, sources)
+                checkpoint.open(resume=bool(self.settings.get('copy.resume', False)))
+            try:
+                with self.stats.timer('copy'):
+                    for d in sources:
+                        newkey = troot + d['key'][len(root):]
+                        target_consul.put(key=newkey, value=d['value'])
+                        copy_keys.append({'key': newkey, 'value': d['value']})
+                        if checkpoint:
+                            checkpoint.done(d['key'], d.get('index'))
+                        logging.info('Copy key from {} to {}'.format(d['key'], newkey))
+            finally:
+                if checkpoint:
+                    checkpoint.close()
+            self.stats.incr('keys_copied', len(copy_keys))
+            if self.settings.get('copy.delete_extra', False):
+                for d in extra:
+                    target_consul.delete(key=d['key'])
+                    delete_keys.append(d)
+                    logging.info('Delete extra key {}'.format(d['key']))
+            if copy_keys or delete_keys:
+                target_consul.del_cache(troot)
+            if checkpoint:
+                # copy finished, next copy will start from beginning
+                checkpoint.remove()
         else:
             logging.warning('No filtered data!')
         data[OUT_FLAG_KEY][self.COPY_FLAG] = copy_keys
+        if self.settings.get('copy.delta', False):
+            data[OUT_FLAG_KEY][self.SKIP_FLAG] = skip_keys
+            if self.settings.get('copy.delete_extra', False):
+                data[OUT_FLAG_KEY][self.DELETE_FLAG] = delete_keys
+        if self.settings.get('copy.checkpoint_file', ''):
+            data[OUT_FLAG_KEY][self.CHECKPOINT_FLAG] = checkpoint_keys
         return data
 
+    def _get_checkpoint(self, root, troot):
+        filepath = self.settings.get('copy.checkpoint_file', '')
+        if not filepath:
+            if self.settings.get('copy.resume', False):
+                raise ConsulException('Checkpoint file is required to resume copy')
+            return None
+        return CopyCheckpoint(filepath, root, troot, flush_every=int(self.settings.get('copy.checkpoint_interval', 1000)))
+
+    def _skip_checkpoint(self, checkpoint, sources):
+        """
+        Skip source key values already copied, keys modified after copied will be copied again.
+
+        :return: tuple of (source key values to copy, source key values skipped)
+        """
+        if not self.settings.get('copy.resume', False):
+            return sources, []
+        done = checkpoint.load()
+        todo = []
+        skipped = []
+        for d in sources:
+            if d['key'] in done and done[d['key']] == d.get('index'):
+                skipped.append(d)
+            else:
+                todo.append(d)
+        logging.info('Resume copy from checkpoint: {} copied, {} to copy'.format(len(skipped), len(todo)))
+        return todo, skipped
+
+    def _get_delta(self, target_consul, sources, root, troot):
+        """
+        Compare source key values with target key values.
+
+        :return: tuple of (source key values to copy, target key values already same, target key values not in source)
+        """
+        targets = target_consul.get(troot, refresh=True) or []
+        targets = [kv for kv in targets if self.filter is None or self.filter.filter(key=kv['key'], value=kv['value'], index=0)]
+        only_source, only_target, both = join_key_values(sources, root, targets, troot)
+        changed = []
+        same = []
+        for kv1, kv2 in both:
+            if kv1['value'] == kv2['value']:
+                same.append(kv2)
+            else:
+                changed.append(kv1)
+        logging.info('Delta copy: {} new, {} changed, {} same, {} extra'.format(
+            len(only_source), len(changed), len(same), len(only_target)))
+        return only_source + changed, same, only_target
+
     def get_config_mapping(self):
         m = super().get_config_mapping()
         m.update({
             'target_root': 'target_root',
+            'delta': 'copy.delta',
+            'delete_extra': 'copy.delete_extra',
+            'checkpoint_file': 'copy.checkpoint_file',
+            'resume': 'copy.resume',
         })
         return m
 
@@ -424,14 +1214,322 @@ class CopyCommand(FilterCommand):
                 v = None
             if v:
                 conf[k] = v
+        # target is always consul even if source is a snapshot
+        conf['snapshot'] = ''
         return self.get_consul_search_client(**conf)
 
 
 class DiffCommand(PairedFilterCommand):
 
     filter_class = DiffFilter
+    chain_setting = 'diff.chain'
 
     def __init__(self, settings=None, ctx=None, args=None):
         super().__init__(settings, ctx, args)
         if 'with_same' in args and args['with_same']:
             self.settings.set('reporter.show_no_filtered', True)
+        if self.settings.get('diff.semantic', False):
+            # show field level changes
+            self.settings.set('reporter.show_flags', True)
+
+    def stream_enabled(self) -> bool:
+        return bool(self.settings.get('diff.stream', False))
+
+    def get_config_mapping(self):
+        m = super().get_config_mapping()
+        m.update({
+            'semantic': 'diff.semantic',
+            'stream': 'diff.stream',
+        })
+        return m
+
+
+class DeleteCommand(SearchCommand):
+    """
+    Delete keys found by search or listed in keys file, in batched transactions.
+    """
+
+    DELETE_FLAG = 'delete'
+    DRY_RUN_FLAG = 'dry_run'
+
+    def __init__(self, settings=None, ctx=None, args=None):
+        super().__init__(settings, ctx, args)
+        self.settings.set('reporter.show_flags', True)
+        if self.filter_class is RankedSearchFilter:
+            # fuzzy matches are never deleted
+            self.filter_class = SearchFilter
+        # all keys found are deleted unless delete.limit is set, search.limit of search command does not apply
+        self.settings.set('search.limit', self.filter_limit() or sys.maxsize)
+
+    def run(self):
+        keys_file = self.settings.get('delete.keys_file', '')
+        if keys_file:
+            vals = [{'key': key, 'value': None} for key in self.read_keys(keys_file)]
+            data = {OUT_ALL_KEY: vals, OUT_FILTERED_KEY: vals, OUT_NON_FILTERED_KEY: [], OUT_FLAG_KEY: {}}
+            return self.parse_output(data)
+        if not self.settings.get('search.query', '') and not self.settings.get(self.chain_setting, None):
+            raise ConsulException('Search query, filter chain or keys file is required to delete')
+        return super().run()
+
+    def read_keys(self, filepath):
+        """
+        Read keys to delete from file, one key per line, keys not under any root are skipped.
+        """
+        roots = [r for r in self.get_roots() if r]
+        keys = []
+        with open(filepath, 'r', encoding='utf8') as fp:
+            for line in fp:
+                key = line.rstrip('\r\n')
+                if not key:
+                    continue
+                if roots and not any(key.startswith(r) for r in roots):
+                    logging.warning('Skip key {} not under root {}'.format(key, ', '.join(roots)))
+                    continue
+                keys.append(key)
+        return keys
+
+    def parse_output(self, data):
+        if OUT_FILTERED_KEY not in data:
+            logging.warning('No filtered data!')
+            return data
+        vals = data[OUT_FILTERED_KEY]
+        if self.settings.get('delete.dry_run', False):
+            logging.info('Dry run, {} keys will be deleted'.format(len(vals)))
+            data[OUT_FLAG_KEY][self.DRY_RUN_FLAG] = vals
+            return data
+        consul = self.get_consul_search_client()
+        # a key under overlapping roots is found once for each root
+        deleted = set(consul.delete_many(list(dict.fromkeys(d['key'] for d in vals)),
+                                         batch_size=self.settings.get('delete.batch_size', 64)))
+        logging.info('Delete {} keys'.format(len(deleted)))
+        data[OUT_FLAG_KEY][self.DELETE_FLAG] = [d for d in vals if d['key'] in deleted]
+        return data
+
+    def filter_limit(self):
+        limit = int(self.settings.get('delete.limit', 0) or 0)
+        return limit if limit > 0 else None
+
+    def get_config_mapping(self):
+        m = super().get_config_mapping()
+        m.update({
+            'keys_file': 'delete.keys_file',
+            'dry_run': 'delete.dry_run',
+            'batch_size': 'delete.batch_size',
+            'limit': 'delete.limit',
+        })
+        return m
+
+
+class TreeCommand(BaseConsulCommand):
+    """
+    Summarize key count, value bytes and largest keys per prefix under root.
+    """
+
+    def run(self):
+        consul = self.get_consul_search_client()
+        if 'clear_cache' in self.args and self.args['clear_cache']:
+            logging.info('Clear all cache')
+            consul.clear_cache()
+        root = self.get_root()
+        keys_only = bool(self.settings.get('tree.keys_only', False))
+        tree = KeyTree(root, depth=self.settings.get('tree.depth', 2), top=self.settings.get('tree.top', 3),
+                       sizes=not keys_only)
+        with self.stats.timer('tree'):
+            if keys_only:
+                # keys listing is much smaller than key values, sizes are not counted
+                for key in consul.get_key(root, keys=True) or []:
+                    tree.add(key)
+            else:
+                for kv in consul.iter_key_values(root):
+                    tree.add(kv['key'], value_size(kv['value']))
+        self.stats.incr('keys_scanned', tree.count)
+        records = [node.to_dict() for node in tree.summaries(self.settings.get('tree.sort', 'prefix'))]
+        data = {OUT_ALL_KEY: [], OUT_FILTERED_KEY: records, OUT_NON_FILTERED_KEY: [], OUT_FLAG_KEY: {}}
+        return self.parse_output(data)
+
+    def get_config_mapping(self):
+        m = super().get_config_mapping()
+        m.update({
+            'depth': 'tree.depth',
+            'top': 'tree.top',
+            'keys_only': 'tree.keys_only',
+            'sort': 'tree.sort',
+        })
+        return m
+
+
+class ExportChangesCommand(BaseConsulCommand):
+    """
+    Export changes of key values under root as json lines, until interrupted.
+
+    Blocking queries wait for changes under root, each round is compared with the last known ModifyIndex of each
+    key, which is kept in the cache, so export resumes from the last saved state after restart.
+    """
+
+    memo_namespace = 'export_changes'
+
+    def run(self):
+        events = []
+        self.export(events.append)
+        data = {OUT_ALL_KEY: [], OUT_FILTERED_KEY: events, OUT_NON_FILTERED_KEY: [], OUT_FLAG_KEY: {}}
+        return self.parse_output(data)
+
+    def _run_and_report(self):
+        # events are written as json lines once found instead of reported after run
+        reporter = self.get_reporter('json')
+        with reporter.get_stream() as stream:
+            with self.stats.timer('run'):
+                self.export(lambda e: stream.append(json.dumps(e, ensure_ascii=False)), sync=stream.sync)
+
+    def export(self, emit, sync=None):
+        """
+        Watch key values under root and emit change events.
+
+        :param emit: function to emit one event
+        :param sync: function called after events of each round emitted
+        """
+        consul = self.get_consul_search_client()
+        root = self.get_root()
+        wait = self.settings.get('export.wait', '5m')
+        once = bool(self.settings.get('export.once', False))
+        with_values = bool(self.settings.get('export.with_values', True))
+        save_interval = float(self.settings.get('export.save_interval', 10))
+        retry_interval = float(self.settings.get('export.retry_interval', 5))
+        saved = consul.get_memo(self.memo_namespace, root) or {}
+        state = saved.get('state')
+        index = saved.get('index', 0)
+        watch_index = None
+        saved_at = time.time()
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            # stop by SIGTERM like ctrl-c, so state is saved
+            handler = signal.signal(signal.SIGTERM, self._interrupt)
+        try:
+            while True:
+                try:
+                    new_index, vals = consul.watch_key(root, index=watch_index, wait=wait)
+                except RequestException as e:
+                    logging.warning('Watch {} failed, retry in {}s: {}'.format(root, retry_interval, e))
+                    time.sleep(retry_interval)
+                    continue
+                if watch_index is not None and new_index == watch_index:
+                    # wait timeout without changes
+                    continue
+                # consul index may go backwards, e.g. after snapshot restore, watch from beginning
+                watch_index = new_index if new_index >= (watch_index or 0) else 0
+                if state is None:
+                    logging.info('No saved state of {}, start from index {}'.format(root, new_index))
+                    events, state = key_changes({}, vals, new_index, with_values)
+                    if not self.settings.get('export.initial', False):
+                        events = []
+                else:
+                    events, state = key_changes(state, vals, new_index, with_values)
+                index = new_index
+                now = time.time()
+                for event in events:
+                    event['time'] = int(now)
+                    emit(event)
+                self.stats.incr('changes_exported', len(events))
+                if sync:
+                    sync()
+                # watched key values are the latest, keep them in the cache
+                consul.set_cache(key=root, value=vals, expire=consul.cache_ttl)
+                if once:
+                    break
+                if now - saved_at >= save_interval:
+                    consul.set_memo(self.memo_namespace, root, {'index': index, 'state': state})
+                    saved_at = now
+        except KeyboardInterrupt:
+            logging.info('Export interrupted')
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGTERM, handler)
+            if state is not None:
+                consul.set_memo(self.memo_namespace, root, {'index': index, 'state': state})
+
+    @staticmethod
+    def _interrupt(signum, frame):
+        raise KeyboardInterrupt()
+
+    def get_config_mapping(self):
+        m = super().get_config_mapping()
+        m.update({
+            'wait': 'export.wait',
+            'initial': 'export.initial',
+            'once': 'export.once',
+            'with_values': 'export.with_values',
+        })
+        return m
+
+
+class SnapshotSaveCommand(FilterCommand):
+    """
+    Save key values under root to snapshot file.
+    """
+
+    filter_class = NoFilter
+    # snapshot is a backup of all key values
+    chain_setting = None
+
+    SNAPSHOT_FLAG = 'snapshot'
+
+    def __init__(self, settings=None, ctx=None, args=None):
+        super().__init__(settings, ctx, args)
+        if not self.settings.get('snapshot.file', ''):
+            raise ConsulException('Snapshot file is required')
+        self.get_root()
+        # report the saved snapshot instead of all key values
+        self.settings.set('reporter.show_filtered', False)
+        self.settings.set('reporter.show_flags', True)
+
+    def get_values(self, consul, root):
+        # snapshot is a backup, always get fresh values
+        return consul.get(root, refresh=True, with_index=True)
+
+    def parse_output(self, data):
+        filepath = self.settings.get('snapshot.file', '')
+        root = self.get_root()
+        source = self.settings.get('consul.snapshot', '') or '{}:{}'.format(
+            self.settings.get('consul.host', ''), self.settings.get('consul.port', ''))
+        writer = SnapshotWriter(filepath, root=root, source=source,
+                                block_size=self.settings.get('snapshot.block_size', 1000),
+                                compress_level=self.settings.get('snapshot.compress_level', 6))
+        with self.stats.timer('snapshot'):
+            with writer:
+                writer.write_many(sorted(data.get(OUT_FILTERED_KEY) or [], key=lambda kv: kv['key']))
+        self.stats.incr('keys_saved', writer.count)
+        logging.info('Save {} keys under {} to snapshot {}'.format(writer.count, root, filepath))
+        data[OUT_FLAG_KEY][self.SNAPSHOT_FLAG] = [{'key': filepath, 'value': writer.count}]
+        return data
+
+    def get_config_mapping(self):
+        m = super().get_config_mapping()
+        m.update({
+            'file': 'snapshot.file',
+            'block_size': 'snapshot.block_size',
+        })
+        return m
+
+
+class SnapshotLoadCommand(CopyCommand):
+    """
+    Load key values from snapshot file to consul, keys are copied from snapshot root to target root.
+    """
+
+    def __init__(self, settings=None, ctx=None, args=None):
+        super().__init__(settings, ctx, args)
+        filepath = self.settings.get('consul.snapshot', '')
+        if not filepath:
+            raise ConsulException('Snapshot file is required')
+        # root and target root default to the root snapshot saved from
+        root = self.args.get('root') or SnapshotReader(filepath).meta.get('root', '')
+        self.args['root'] = root
+        self.args['target_root'] = self.args.get('target_root') or root
+        self.settings.set('consul.root', root)
+
+    def get_config_mapping(self):
+        m = super().get_config_mapping()
+        m.update({
+            'file': 'consul.snapshot',
+        })
+        return m
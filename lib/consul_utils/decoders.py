@@ -0,0 +1,297 @@
+import zlib
+import base64
+import binascii
+import logging
+from .structured import value_hash
+
+
+# content decoders, base64 has no magic bytes and is only detected if decoded to a compressed payload
+DECODERS = ['base64', 'gzip', 'zlib', 'zstd']
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# base64 of gzip, zstd and zlib payloads of each compression level starts with these
+BASE64_MAGIC = ('H4sI', 'KLUv', 'eA', 'eF', 'eJ', 'eN')
+# max nested encodings decoded, e.g. gzip in base64
+MAX_DEPTH = 4
+# min length of str detected as base64
+MIN_BASE64_SIZE = 16
+
+
+def detect(data):
+    """
+    Detect compression of data by magic bytes.
+
+    :param data: bytes
+    :return: gzip, zlib, zstd or None
+    """
+    if data[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if data[:4] == ZSTD_MAGIC:
+        return 'zstd'
+    # zlib header is deflate method with 32K window and a check sum making the first two bytes a multiple of 31
+    if len(data) >= 2 and data[0] == 0x78 and (data[0] * 256 + data[1]) % 31 == 0:
+        return 'zlib'
+    return None
+
+
+def decode_base64(data):
+    if isinstance(data, bytes):
+        data = data.decode('ascii')
+    data = ''.join(data.split()).replace('-', '+').replace('_', '/')
+    return base64.b64decode(data + '=' * (-len(data) % 4), validate=True)
+
+
+def decompress(data, name, max_size):
+    """
+    Decompress data, at most max_size bytes.
+
+    :raise ValueError: if decompressed data is larger than max_size
+    """
+    if name == 'zstd':
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(data)
+        chunks = []
+        size = 0
+        while size <= max_size:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        res = b''.join(chunks)
+    else:
+        # 16 + MAX_WBITS reads gzip header and trailer
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if name == 'gzip' else zlib.MAX_WBITS)
+        res = decompressor.decompress(data, max_size + 1)
+    if len(res) > max_size:
+        raise ValueError('Decoded value is larger than {} bytes'.format(max_size))
+    return res
+
+
+def decode_once(data, name, max_size):
+    """
+    Decode data by one decoder.
+
+    :param data: str or bytes
+    :param name: base64, gzip, zlib or zstd
+    :return: bytes
+    """
+    if name == 'base64':
+        return decode_base64(data)
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return decompress(data, name, max_size)
+
+
+def to_text(data):
+    try:
+        return data.decode('utf8')
+    except UnicodeDecodeError:
+        return data
+
+
+class ContentDecoder:
+    """
+    Decode compressed and encoded values to search or compare their content.
+
+    Values under configured prefixes are decoded by their decoders in order, other values are decoded if
+    compression is detected by magic bytes, also inside base64. Decoded values are memoized by key and ModifyIndex,
+    or by hash of raw value if ModifyIndex is not known, and saved in the cache, so each payload is decoded once
+    across runs. Memo entries not used in a run are dropped when saved, and memo holds at most memo_max_total bytes
+    of decoded values. Values failed to decode are used as is.
+    """
+
+    memo_namespace = 'decoded'
+
+    def __init__(self, auto=True, prefixes=None, max_size=64 * 1024 * 1024, memo_max_size=1024 * 1024,
+                 memo_max_total=64 * 1024 * 1024):
+        """
+        :param auto: detect compression by magic bytes
+        :param prefixes: list of (key prefix, list of decoders)
+        :param max_size: max bytes of decoded value, larger values are not decoded
+        :param memo_max_size: max bytes of decoded value memoized
+        :param memo_max_total: max bytes of all decoded values memoized
+        """
+        self.auto = auto
+        self.prefixes = sorted(prefixes or [], key=lambda p: -len(p[0]))
+        for prefix, decoders in self.prefixes:
+            for name in decoders:
+                if name not in DECODERS:
+                    raise ValueError('Invalid decoder {} for {}, must be one of {}'.format(
+                        name, prefix, ', '.join(DECODERS)))
+        self.max_size = max_size
+        self.memo_max_size = memo_max_size
+        self.memo_max_total = memo_max_total
+        self.memo = {}
+        self._memo_seen = set()
+        self._memo_size = 0
+        self._memo_changed = False
+        # values decoded, not got from memo
+        self.decoded = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Create decoder from decode settings.
+
+        :return: ContentDecoder or None if decode is disabled
+        """
+        if not settings.get('decode.enabled', False):
+            return None
+        prefixes = []
+        for item in settings.get('decode.prefixes', []) or []:
+            if not isinstance(item, dict) or 'prefix' not in item:
+                raise ValueError('Invalid decode prefix {}, prefix and decoders are required'.format(item))
+            decoders = item.get('decoders') or []
+            if isinstance(decoders, str):
+                decoders = decoders.split(',')
+            prefixes.append((item['prefix'], [d.strip() for d in decoders]))
+        return cls(auto=bool(settings.get('decode.auto', True)), prefixes=prefixes,
+                   max_size=int(settings.get('decode.max_size', 64 * 1024 * 1024)),
+                   memo_max_size=int(settings.get('decode.memo_max_size', 1024 * 1024)),
+                   memo_max_total=int(settings.get('decode.memo_max_total', 64 * 1024 * 1024)))
+
+    def decoders_for(self, key):
+        for prefix, decoders in self.prefixes:
+            if key.startswith(prefix):
+                return decoders
+        return None
+
+    def maybe_encoded(self, key, value) -> bool:
+        """
+        Cheap check whether value may be decoded, by prefix of key, magic bytes or base64 magic.
+        """
+        if value is None:
+            return False
+        if self.prefixes and self.decoders_for(key or '') is not None:
+            return True
+        if not self.auto:
+            return False
+        if isinstance(value, str):
+            return len(value) >= MIN_BASE64_SIZE and value.startswith(BASE64_MAGIC)
+        return detect(value) is not None
+
+    def decode(self, key, value):
+        """
+        Decode value without memo.
+
+        :return: decoded str, or bytes if not utf8, None if value is not decoded
+        """
+        if value is None:
+            return None
+        decoders = self.decoders_for(key or '')
+        try:
+            if decoders:
+                data = value
+                for name in decoders:
+                    data = decode_once(data, name, self.max_size)
+                return to_text(data)
+            if not self.auto:
+                return None
+            data = value
+            for _ in range(MAX_DEPTH):
+                if isinstance(data, str):
+                    raw = self._detect_base64(data)
+                else:
+                    name = detect(data)
+                    raw = decompress(data, name, self.max_size) if name else None
+                if raw is None:
+                    break
+                data = to_text(raw)
+            return None if data is value else data
+        except ImportError:
+            logging.warning('Package zstandard is required to decode {}'.format(key))
+        except Exception as e:
+            # corrupted or too large payload, e.g. zlib.error, binascii.Error or zstandard.ZstdError
+            logging.debug('Decode {} failed: {}'.format(key, e))
+        return None
+
+    @staticmethod
+    def _detect_base64(data):
+        """
+        Decode base64 str if it is a compressed payload.
+        """
+        if len(data) < MIN_BASE64_SIZE or not data.startswith(BASE64_MAGIC):
+            return None
+        try:
+            raw = decode_base64(data)
+        except (ValueError, binascii.Error):
+            return None
+        return raw if detect(raw) else None
+
+    def decode_value(self, key, value, modify_index=None):
+        """
+        Get decoded value from memo or decode it, memoized by key and ModifyIndex or by raw value hash.
+
+        :return: decoded value, or value if not decoded
+        """
+        if not self.maybe_encoded(key, value):
+            return value
+        if modify_index is not None:
+            memo_key, version = key, modify_index
+        else:
+            memo_key, version = value_hash(value), None
+        self._memo_seen.add(memo_key)
+        entry = self.memo.get(memo_key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        decoded = self.decode(key, value)
+        if decoded is None:
+            return value
+        self.decoded += 1
+        self.memoize(memo_key, version, decoded)
+        return decoded
+
+    def memoize(self, memo_key, version, decoded):
+        """
+        Memoize decoded value if it fits in memo_max_size and memo_max_total.
+        """
+        if len(decoded) > self.memo_max_size:
+            return
+        old = self.memo.pop(memo_key, None)
+        if old is not None:
+            self._memo_size -= len(old[1])
+            self._memo_changed = True
+        if self._memo_size + len(decoded) <= self.memo_max_total:
+            self.memo[memo_key] = (version, decoded)
+            self._memo_size += len(decoded)
+            self._memo_changed = True
+
+    def decode_many(self, keys, values, modify_indexes=None):
+        if modify_indexes is None:
+            modify_indexes = [None] * len(keys)
+        decode_value = self.decode_value
+        return [decode_value(key, value, modify_index)
+                for key, value, modify_index in zip(keys, values, modify_indexes)]
+
+    def merge_memo(self, memo):
+        """
+        Merge memo entries decoded in a worker process.
+        """
+        for memo_key, (version, decoded) in memo.items():
+            self._memo_seen.add(memo_key)
+            entry = self.memo.get(memo_key)
+            if entry is None or entry[0] != version:
+                self.memoize(memo_key, version, decoded)
+
+    def load(self, consul, root):
+        self.memo = consul.get_memo(self.memo_namespace, root) or {}
+        self._memo_seen = set()
+        self._memo_size = sum(len(entry[1]) for entry in self.memo.values())
+        self._memo_changed = False
+
+    def save(self, consul, root):
+        if self._memo_changed or not self.memo.keys() <= self._memo_seen:
+            # only keep values decoded or read in this run
+            self.memo = {k: v for k, v in self.memo.items() if k in self._memo_seen}
+            self._memo_size = sum(len(entry[1]) for entry in self.memo.values())
+            consul.set_memo(self.memo_namespace, root, self.memo)
+            self._memo_changed = False
+
+    def __getstate__(self):
+        # memo is not sent to worker processes, entries decoded there are merged back by merge_memo
+        state = dict(self.__dict__)
+        state['memo'] = {}
+        state['_memo_seen'] = set()
+        state['_memo_size'] = 0
+        return state
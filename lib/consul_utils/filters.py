@@ -1,5 +1,13 @@
 import re
+import json
+import time
+import logging
+from hsettings import Settings
 from .exceptions import FilterStop
+from .regex import compile_regex
+from .ranking import FuzzyScorer, TopK
+from .decoders import ContentDecoder
+from .structured import StructuredQuery, parse_value, canonical, value_hash, diff_objects
 
 
 class BaseFilter:
@@ -8,18 +16,59 @@ class BaseFilter:
     """
 
     filter_flag = 'default'
+    # filter needs ModifyIndex of key values as modify_index
+    with_index = False
+    # relative cost of one evaluation, filter chains evaluate cheap filters first
+    cost = 1
 
-    def __init__(self, settings, flag='default'):
+    def __init__(self, settings, flag=None):
         self._settings = settings
         self.flag = flag or self.filter_flag
         self.results = None
 
+    def prepare(self, consul, root):
+        """
+        Prepare filter before filtering key values under root, e.g. load memoized data from cache.
+
+        :param consul: ConsulKvSearch
+        :param root:
+        """
+        pass
+
+    def finish(self, consul, root):
+        """
+        Finish filter after filtering key values under root, e.g. save memoized data to cache.
+
+        :param consul: ConsulKvSearch
+        :param root:
+        """
+        pass
+
     def filter(self, **kwargs) -> bool:
         """
         Filter data, return true if data passed filter.
         """
         return False
 
+    def evaluate(self, **kwargs) -> bool:
+        """
+        Evaluate filter without accounting the result, used by filter chains.
+        """
+        return self.filter(**kwargs)
+
+    def filter_many(self, *columns, start=0) -> list:
+        """
+        Evaluate filter on a batch of data given as columns, without accounting the results.
+
+        Pass each result through count in order to apply limits. Subclasses evaluate the whole batch at once to
+        avoid per data call overhead.
+
+        :param columns: lists of data in the order of filter arguments, e.g. keys and values
+        :param start: index of the first data
+        :return: list of passed or not
+        """
+        return [False] * len(columns[0])
+
     def get_results(self):
         """
         Get other filter results.
@@ -28,6 +77,63 @@ class BaseFilter:
         """
         return self.results
 
+    def count(self, passed) -> bool:
+        """
+        Account one filter result, raise FilterStop to stop filtering.
+
+        Filters evaluated in worker processes are replayed in order through this method.
+
+        :param passed: data passed filter or not
+        :return: passed
+        """
+        return passed
+
+    def merge_results(self, results):
+        """
+        Merge filter results from worker processes in order.
+
+        :param results: list of results
+        """
+        for res in results:
+            if res is None:
+                continue
+            if isinstance(res, list) and isinstance(self.results, list):
+                self.results.extend(res)
+            elif isinstance(res, dict) and isinstance(self.results, dict):
+                self.results.update(res)
+            elif isinstance(res, (list, dict)):
+                self.results = type(res)(res)
+            else:
+                self.results = res
+
+    def get_memo_updates(self):
+        """
+        Get memo entries added in a worker process, returned with results so they are saved by the main process.
+
+        :return: memo entries or None
+        """
+        return None
+
+    def merge_memo_updates(self, updates):
+        """
+        Merge memo entries from worker processes.
+
+        :param updates: list of memo entries
+        """
+        pass
+
+    def scope_memo(self, scope):
+        """
+        Memoize in namespaces of scope, so filters of the same class in a filter chain keep their own memo.
+
+        :param scope: e.g. spec of filter in chain
+        """
+        if getattr(self, 'memo_namespace', None):
+            self.memo_namespace = '{}|{}'.format(self.memo_namespace, scope)
+        decoder = getattr(self, 'decoder', None)
+        if decoder is not None:
+            decoder.memo_namespace = '{}|{}'.format(decoder.memo_namespace, scope)
+
     @property
     def settings(self):
         return self._settings
@@ -47,6 +153,18 @@ class OneFilter(BaseFilter):
     def filter(self, **kwargs) -> bool:
         return self.filter_one(**kwargs)
 
+    def filter_many(self, keys, values, modify_indexes=None, start=0) -> list:
+        """
+        Evaluate filter on lists of keys, values and ModifyIndex, without accounting the results.
+
+        :return: list of passed or not
+        """
+        if modify_indexes is None:
+            modify_indexes = [None] * len(keys)
+        evaluate = self.evaluate
+        return [bool(evaluate(key=key, value=value, index=start + i, modify_index=modify_index))
+                for i, (key, value, modify_index) in enumerate(zip(keys, values, modify_indexes))]
+
 
 class PairedFilter(BaseFilter):
     """
@@ -59,6 +177,21 @@ class PairedFilter(BaseFilter):
     def filter(self, **kwargs) -> bool:
         return self.filter_pair(**kwargs)
 
+    def filter_many(self, keys1, values1, keys2, values2, modify_indexes1=None, start=0) -> list:
+        """
+        Evaluate filter on lists of paired keys and values, without accounting the results.
+
+        :param modify_indexes1: ModifyIndex of the first side, None if not known
+        :return: list of passed or not
+        """
+        if modify_indexes1 is None:
+            modify_indexes1 = [None] * len(keys1)
+        evaluate = self.evaluate
+        return [bool(evaluate(key1=key1, value1=value1, key2=key2, value2=value2, index=start + i,
+                              modify_index1=modify_index1))
+                for i, (key1, value1, key2, value2, modify_index1)
+                in enumerate(zip(keys1, values1, keys2, values2, modify_indexes1))]
+
 
 class NoFilter(OneFilter):
     """
@@ -68,6 +201,9 @@ class NoFilter(OneFilter):
     def filter_one(self, key, value, index, **kwargs):
         return True
 
+    def filter_many(self, keys, values, modify_indexes=None, start=0):
+        return [True] * len(keys)
+
 
 class SkipDirectoryFilter(OneFilter):
     """
@@ -79,38 +215,153 @@ class SkipDirectoryFilter(OneFilter):
             return False
         return True
 
+    def filter_many(self, keys, values, modify_indexes=None, start=0):
+        return [not key.endswith('/') for key in keys]
+
+
+class PrefixFilter(OneFilter):
+    """
+    Filter keys starting with any of prefix.prefixes.
+    """
+
+    def __init__(self, settings, flag=None):
+        super().__init__(settings, flag)
+        prefixes = settings.get('prefix.prefixes', [])
+        self.prefixes = tuple([prefixes] if isinstance(prefixes, str) else prefixes)
+
+    def filter_one(self, key, value, index, **kwargs):
+        return key.startswith(self.prefixes)
+
+    def filter_many(self, keys, values, modify_indexes=None, start=0):
+        prefixes = self.prefixes
+        return [key.startswith(prefixes) for key in keys]
+
 
 class SearchFilter(OneFilter):
     """
     Search filter.
     """
 
-    def __init__(self, settings, flag='default'):
+    def __init__(self, settings, flag=None):
         super().__init__(settings, flag)
         self.regex = bool(settings.get('search.regex', False))
         self.fields = settings.get('search.fields', 'keys')
         self.limit = int(settings.get('search.limit', 10))
+        self.regex_backend = settings.get('search.regex_backend', 're')
+        # only the first max_value_size characters of values are searched, 0 means no cap
+        self.max_value_size = int(settings.get('search.max_value_size', 0))
+        # max seconds spent searching, 0 means no budget
+        self.time_budget = float(settings.get('search.time_budget', 0))
         self.compiled_pattern = None
         self.num = 0
+        self._deadline = None
+        # compressed or encoded values are decoded to search, memoized by ModifyIndex
+        self.decoder = ContentDecoder.from_settings(settings)
+        if self.decoder is not None and self.fields != 'keys':
+            self.with_index = True
+
+    @property
+    def cost(self):
+        if self.fields == 'keys':
+            return 5 if self.regex else 2
+        return 50 if self.regex else 10
 
     def filter_one(self, key, value, index, **kwargs):
+        return self.count(self.match(key, value, **kwargs))
+
+    def evaluate(self, key=None, value=None, **kwargs):
+        return self.match(key, value, **kwargs)
+
+    def match(self, key, value, modify_index=None, **kwargs) -> bool:
+        """
+        Key or value matches query.
+        """
         query = self.get_query()
+        self.check_budget()
         if self.fields == 'keys':
             data = key
         else:
-            data = value
-            if data is None:
+            data = self.decode(key, value, modify_index)
+            if not isinstance(data, str):
                 return False
+            if self.max_value_size:
+                data = data[:self.max_value_size]
         if self.regex:
             s = query.search(data)
-            res = True if s else False
-        else:
-            res = query in data
-        if res:
+            return True if s else False
+        return query in data
+
+    def filter_many(self, keys, values, modify_indexes=None, start=0):
+        # query and fields are resolved once per batch, time budget is checked between batches
+        query = self.get_query()
+        self.check_budget()
+        if self.fields == 'keys':
+            if self.regex:
+                search = query.search
+                return [search(key) is not None for key in keys]
+            return [query in key for key in keys]
+        if self.decoder is not None:
+            values = self.decoder.decode_many(keys, values, modify_indexes)
+        if self.max_value_size:
+            size = self.max_value_size
+            values = [value[:size] if isinstance(value, str) else None for value in values]
+        # values not decoded to text are never matched
+        if self.regex:
+            search = query.search
+            return [isinstance(value, str) and search(value) is not None for value in values]
+        return [isinstance(value, str) and query in value for value in values]
+
+    def decode(self, key, value, modify_index=None):
+        """
+        Decode compressed or encoded value if decode is enabled.
+
+        :return: decoded value, or value if not decoded
+        """
+        if self.decoder is None:
+            return value
+        return self.decoder.decode_value(key, value, modify_index)
+
+    def prepare(self, consul, root):
+        self.start_budget()
+        if self.decoder is not None:
+            self.decoder.load(consul, root)
+
+    def finish(self, consul, root):
+        if self.decoder is not None:
+            self.decoder.save(consul, root)
+
+    def get_memo_updates(self):
+        return self.decoder.memo if self.decoder is not None else None
+
+    def merge_memo_updates(self, updates):
+        if self.decoder is not None:
+            for memo in updates:
+                if memo:
+                    self.decoder.merge_memo(memo)
+
+    def start_budget(self):
+        """
+        Start time budget of search, deadline is absolute time so it is shared by worker processes.
+        """
+        self._deadline = time.time() + self.time_budget if self.time_budget > 0 else None
+
+    def check_budget(self):
+        """
+        Raise FilterStop if time budget of search is used up.
+        """
+        if self.time_budget <= 0:
+            return
+        if self._deadline is None:
+            self.start_budget()
+        elif time.time() > self._deadline:
+            raise FilterStop('Search time budget {}s is used up'.format(self.time_budget))
+
+    def count(self, passed):
+        if passed:
             self.num += 1
             if self.num > self.limit:
                 raise FilterStop('Search hit reach limit {}'.format(self.limit))
-        return res
+        return passed
 
     def get_query(self):
         query = self.compiled_pattern
@@ -120,15 +371,722 @@ class SearchFilter(OneFilter):
             if not query:
                 raise ValueError('No query specified')
             if self.regex:
-                query = re.compile(query)
+                query = self.compile_regex(query)
             self.compiled_pattern = query
         return query
 
+    def compile_regex(self, query):
+        compiled = compile_regex(query, self.regex_backend)
+        if self.time_budget > 0 and isinstance(compiled, re.Pattern):
+            # budget is checked between batches, a backtracking match in re is never interrupted
+            logging.warning('Regex {} is searched by re, time budget can not stop a catastrophic match in one value, '
+                            'install re2 or hyperscan to search in linear time'.format(query))
+        return compiled
+
+    def get_bytes_query(self):
+        """
+        Get query as utf8 bytes, or compiled bytes regex if regex is set, to search keys or values as bytes.
+        """
+        query = self.settings.get('search.query')
+        if not query:
+            raise ValueError('No query specified')
+        query = query.encode('utf8')
+        return self.compile_regex(query) if self.regex else query
+
+    def __getstate__(self):
+        # compiled regex of re2 or hyperscan can not be sent to worker processes, it is compiled again there
+        state = dict(self.__dict__)
+        state['compiled_pattern'] = None
+        return state
+
+
+class StructuredFilter(SearchFilter):
+    """
+    Structured search filter, query json or yaml values by path and predicate.
+
+    Parsed values are memoized by key and ModifyIndex in the cache, so values are parsed again only if changed.
+    Memo of keys not read in a search is dropped, so deleted keys are not kept.
+    """
+
+    memo_namespace = 'structured'
+    with_index = True
+    cost = 200
+
+    def __init__(self, settings, flag=None):
+        super().__init__(settings, flag)
+        self.memo = {}
+        self._memo_seen = set()
+        self._memo_changed = False
+
+    def match(self, key, value, modify_index=None, **kwargs):
+        if value is None:
+            return False
+        query = self.get_query()
+        parsed, obj = self.parse(key, value, modify_index)
+        return bool(parsed and query.match(obj))
+
+    def filter_many(self, keys, values, modify_indexes=None, start=0):
+        return OneFilter.filter_many(self, keys, values, modify_indexes, start)
+
+    def parse(self, key, value, modify_index=None):
+        """
+        Parse value, get from memo if key not modified.
+
+        :return: tuple of (parsed or not, parsed value)
+        """
+        if modify_index is not None:
+            self._memo_seen.add(key)
+        memo = self.memo.get(key)
+        if memo is not None and modify_index is not None and memo[0] == modify_index:
+            return memo[1], memo[2]
+        parsed, obj = parse_value(self.decode(key, value, modify_index))
+        if modify_index is not None:
+            self.memo[key] = (modify_index, parsed, obj)
+            self._memo_changed = True
+        return parsed, obj
+
+    def get_query(self):
+        query = self.compiled_pattern
+        if not query:
+            query = self.settings.get('search.query', '')
+            if not query:
+                raise ValueError('No query specified')
+            query = StructuredQuery(query)
+            self.compiled_pattern = query
+        return query
+
+    def prepare(self, consul, root):
+        super().prepare(consul, root)
+        self.memo = consul.get_memo(self.memo_namespace, root) or {}
+        self._memo_seen = set()
+        self._memo_changed = False
+
+    def finish(self, consul, root):
+        super().finish(consul, root)
+        if self._memo_changed or not self.memo.keys() <= self._memo_seen:
+            # only keep values of keys seen in this search
+            self.memo = {k: v for k, v in self.memo.items() if k in self._memo_seen}
+            consul.set_memo(self.memo_namespace, root, self.memo)
+            self._memo_changed = False
+
+    def get_memo_updates(self):
+        return super().get_memo_updates(), self.memo
+
+    def merge_memo_updates(self, updates):
+        updates = [update for update in updates if update]
+        super().merge_memo_updates([decoded for decoded, _ in updates])
+        for _, memo in updates:
+            for key, entry in memo.items():
+                self._memo_seen.add(key)
+                old = self.memo.get(key)
+                if old is None or old[0] != entry[0]:
+                    self.memo[key] = entry
+                    self._memo_changed = True
+
+    def __getstate__(self):
+        # memo is not sent to worker processes, values parsed there are merged back by merge_memo_updates
+        state = super().__getstate__()
+        state['memo'] = {}
+        state['_memo_seen'] = set()
+        return state
+
+
+class RankedSearchFilter(SearchFilter):
+    """
+    Ranked search filter, score keys, and values if fields is values, by fuzzy match with query.
+
+    Key values scoring at least min_score pass the filter, the best limit of them are kept in a bounded heap during
+    the scan, so memory is O(limit) and filtering never stops at the first limit matches. Results are the kept
+    (score, index) items, worker processes keep their own heaps which are merged in order.
+    """
+
+    def __init__(self, settings, flag=None):
+        super().__init__(settings, flag)
+        self.min_score = float(settings.get('search.min_score', 0.5))
+        self.reset()
+
+    @property
+    def cost(self):
+        return 100
+
+    def get_query(self):
+        query = self.compiled_pattern
+        if not query:
+            query = self.settings.get('search.query')
+            if not query:
+                raise ValueError('No query specified')
+            query = FuzzyScorer(query)
+            self.compiled_pattern = query
+        return query
+
+    def score(self, key, value) -> float:
+        scorer = self.get_query()
+        score = scorer.score(key)
+        if self.fields != 'keys' and value is not None and not isinstance(value, bytes):
+            if self.max_value_size:
+                value = value[:self.max_value_size]
+            score = max(score, scorer.score(value))
+        return score
+
+    def match(self, key, value, modify_index=None, **kwargs) -> bool:
+        self.check_budget()
+        return self.score(key, self.decode(key, value, modify_index)) >= self.min_score
+
+    def filter_one(self, key, value, index, modify_index=None, **kwargs):
+        self.check_budget()
+        return self.rank(self.score(key, self.decode(key, value, modify_index)), index)
+
+    def filter_many(self, keys, values, modify_indexes=None, start=0):
+        self.check_budget()
+        if self.decoder is not None and self.fields != 'keys':
+            values = self.decoder.decode_many(keys, values, modify_indexes)
+        score = self.score
+        return [self.rank(score(key, value), start + i) for i, (key, value) in enumerate(zip(keys, values))]
+
+    def rank(self, score, index) -> bool:
+        """
+        Keep key value at index in the heap if it is among the best limit.
+
+        :return: passed min score or not
+        """
+        if score < self.min_score:
+            return False
+        self.top.push(score, index)
+        return True
+
+    def count(self, passed):
+        # all key values are scored, limit is applied by the heap
+        return passed
+
+    def merge_results(self, results):
+        for res in results:
+            if res:
+                self.top.merge(res)
+
+    def ranked(self):
+        """
+        Get kept key values ranked by score.
+
+        :return: list of (score, index) sorted by score descending, index is the position in filtered key values
+        """
+        return self.top.items()
+
+    def reset(self):
+        """
+        Empty the heap of kept key values.
+        """
+        self.top = TopK(self.limit)
+        self.results = self.top.heap
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # worker processes start with an empty heap
+        state['top'] = TopK(self.limit)
+        state['results'] = state['top'].heap
+        return state
+
 
 class DiffFilter(PairedFilter):
     """
     Diff filter.
+
+    If diff.semantic is set, json or yaml values are parsed and compared by canonical form, field level changes
+    are added to results. Canonical hash of each raw value is memoized in the cache, so values seen before are
+    not parsed again to find they are the same.
     """
 
+    filter_flag = 'changes'
+    memo_namespace = 'semantic_diff'
+
+    def __init__(self, settings, flag=None):
+        super().__init__(settings, flag)
+        self.semantic = bool(settings.get('diff.semantic', False))
+        self.memo = {}
+        self._memo_seen = set()
+        self._memo_changed = False
+        # compressed or encoded values are compared decoded, memoized by raw value hash
+        self.decoder = ContentDecoder.from_settings(settings)
+
+    @property
+    def cost(self):
+        return 100 if self.semantic else 2
+
+    def filter_many(self, keys1, values1, keys2, values2, modify_indexes1=None, start=0):
+        if self.decoder is not None:
+            values1 = self.decoder.decode_many(keys1, values1)
+            values2 = self.decoder.decode_many(keys2, values2)
+        if not self.semantic:
+            return [value1 != value2 for value1, value2 in zip(values1, values2)]
+        # only values different in raw form are compared semantically
+        compare = self.compare
+        return [value1 != value2 and compare(key1, value1, key2, value2)
+                for key1, value1, key2, value2 in zip(keys1, values1, keys2, values2)]
+
     def filter_pair(self, key1, value1, key2, value2, index, **kwargs) -> bool:
-        return value1 != value2
+        if self.decoder is not None:
+            value1 = self.decoder.decode_value(key1, value1)
+            value2 = self.decoder.decode_value(key2, value2)
+        return self.compare(key1, value1, key2, value2)
+
+    def compare(self, key1, value1, key2, value2) -> bool:
+        """
+        Decoded values are different, field level changes are added to results.
+        """
+        if not self.semantic or value1 == value2:
+            return value1 != value2
+        hash1 = self.canonical_hash(value1)
+        hash2 = self.canonical_hash(value2)
+        if hash1 is not None and hash1 == hash2:
+            return False
+        if hash1 is None or hash2 is None:
+            return True
+        parsed1, obj1 = parse_value(value1)
+        parsed2, obj2 = parse_value(value2)
+        if parsed1 and parsed2:
+            if self.results is None:
+                self.results = []
+            for path, op, old, new in diff_objects(obj1, obj2):
+                # yaml values like dates are kept as in canonical json, so results are json serializable
+                old, new = canonical(old), canonical(new)
+                self.results.append({
+                    'key': key1,
+                    'value': '{} {}: {} -> {}'.format(path, op, old, new),
+                    'key2': key2,
+                    'path': path,
+                    'op': op,
+                    'old': json.loads(old),
+                    'new': json.loads(new),
+                })
+        return True
+
+    def canonical_hash(self, value):
+        """
+        Canonical hash of json or yaml value, None if value is not parsed to dict or list.
+        """
+        raw = value_hash(value)
+        if raw is None:
+            return None
+        self._memo_seen.add(raw)
+        if raw in self.memo:
+            return self.memo[raw]
+        parsed, obj = parse_value(value)
+        res = value_hash(canonical(obj)) if parsed and isinstance(obj, (dict, list)) else None
+        self.memo[raw] = res
+        self._memo_changed = True
+        return res
+
+    def prepare(self, consul, root):
+        if self.decoder is not None:
+            self.decoder.load(consul, root)
+        if self.semantic:
+            self.memo = consul.get_memo(self.memo_namespace, root) or {}
+            self._memo_seen = set()
+            self._memo_changed = False
+
+    def finish(self, consul, root):
+        if self.semantic and (self._memo_changed or len(self._memo_seen) < len(self.memo)):
+            # only keep hashes of values seen in this diff
+            self.memo = {k: v for k, v in self.memo.items() if k in self._memo_seen}
+            consul.set_memo(self.memo_namespace, root, self.memo)
+            self._memo_changed = False
+        if self.decoder is not None:
+            self.decoder.save(consul, root)
+
+
+class PairedOneFilter(PairedFilter):
+    """
+    Evaluate one data filter on the first side of paired data, to use one data filters in paired filter chains.
+    """
+
+    def __init__(self, settings, inner, flag=None):
+        super().__init__(settings, flag or inner.flag)
+        self.inner = inner
+
+    @property
+    def with_index(self):
+        return self.inner.with_index
+
+    @property
+    def cost(self):
+        return self.inner.cost
+
+    def filter_pair(self, key1, value1, key2, value2, index, modify_index1=None, **kwargs):
+        return self.inner.evaluate(key=key1, value=value1, index=index, modify_index=modify_index1)
+
+    def filter_many(self, keys1, values1, keys2, values2, modify_indexes1=None, start=0):
+        return self.inner.filter_many(keys1, values1, modify_indexes1, start=start)
+
+    def prepare(self, consul, root):
+        self.inner.prepare(consul, root)
+
+    def finish(self, consul, root):
+        self.inner.finish(consul, root)
+
+    def get_results(self):
+        return self.inner.get_results()
+
+    def get_memo_updates(self):
+        return self.inner.get_memo_updates()
+
+    def merge_memo_updates(self, updates):
+        self.inner.merge_memo_updates(updates)
+
+    def __repr__(self):
+        return repr(self.inner)
+
+
+class ChainFilter(BaseFilter):
+    """
+    Base filter composed of child filters.
+
+    Children are evaluated without accounting, the chain accounts its own result, so search limit applies to the
+    whole chain. Evaluations and hits of each child are counted, and every reorder_interval evaluations children
+    are reordered by estimated cost per decision, so cheap and decisive filters are evaluated first. Counters of
+    the top chain are memoized in the cache by root and chain spec, so later runs start from the learned order.
+    Children must not depend on each other's side effects, results of filters skipped by short circuit are not
+    collected.
+    """
+
+    filter_flag = 'chain'
+    memo_namespace = 'filter_chain'
+    reorder_interval = 256
+    # counters are halved above this number of evaluations, so order follows recent data
+    max_evaluations = 100000
+
+    def __init__(self, settings, children, flag=None, limit=None, memo_key=None):
+        super().__init__(settings, flag)
+        self.children = list(children)
+        self.order = list(range(len(self.children)))
+        self.evaluations = [0] * len(self.children)
+        self.hits = [0] * len(self.children)
+        # evaluations in this run, counters above include memoized history
+        self.run_evaluations = [0] * len(self.children)
+        self.limit = limit
+        self.memo_key = memo_key
+        self.num = 0
+        self._pending = 0
+
+    @property
+    def with_index(self):
+        return any(child.with_index for child in self.children)
+
+    @property
+    def cost(self):
+        """
+        Expected cost of one evaluation in current order.
+        """
+        return sum(self.children[i].cost * p for i, p in zip(self.order, self.reach_rates()))
+
+    def pass_rate(self, i):
+        """
+        Estimated pass rate of i-th child, smoothed so children never evaluated get 0.5.
+        """
+        return (self.hits[i] + 1) / (self.evaluations[i] + 2)
+
+    def reach_rates(self):
+        """
+        Estimated rate of evaluations reaching each child in current order.
+        """
+        return [1.0] * len(self.order)
+
+    def rank(self, i):
+        """
+        Sort key of i-th child, lower is evaluated first.
+        """
+        return self.children[i].cost
+
+    def reorder(self):
+        """
+        Reorder children of this chain and all sub chains by current counters.
+        """
+        for child in self.children:
+            if isinstance(child, ChainFilter):
+                child.reorder()
+        self.order.sort(key=self.rank)
+        self._pending = 0
+
+    def filter(self, **kwargs) -> bool:
+        return self.count(self.evaluate(**kwargs))
+
+    def evaluate(self, **kwargs) -> bool:
+        self._tick(1)
+        return self.decide(kwargs)
+
+    def filter_many(self, *columns, start=0):
+        self._tick(len(columns[0]))
+        return self.decide_many(columns, start)
+
+    def _tick(self, n):
+        self._pending += n
+        if self._pending >= self.reorder_interval:
+            # sub chains reorder themselves when evaluated
+            self.order.sort(key=self.rank)
+            self._pending = 0
+
+    def decide(self, kwargs) -> bool:
+        return False
+
+    def decide_many(self, columns, start) -> list:
+        """
+        Decide a batch, each child is evaluated at once on the data not decided yet.
+        """
+        return []
+
+    def evaluate_child(self, i, kwargs) -> bool:
+        passed = bool(self.children[i].evaluate(**kwargs))
+        self.evaluations[i] += 1
+        self.run_evaluations[i] += 1
+        if passed:
+            self.hits[i] += 1
+        return passed
+
+    def evaluate_child_many(self, i, columns, rows, start):
+        """
+        Evaluate i-th child on rows of columns.
+
+        :param rows: list of row numbers, or None for all rows
+        :return: list of passed or not of rows
+        """
+        if rows is not None:
+            columns = [None if column is None else [column[j] for j in rows] for column in columns]
+        mask = self.children[i].filter_many(*columns, start=start)
+        self.evaluations[i] += len(mask)
+        self.run_evaluations[i] += len(mask)
+        self.hits[i] += sum(mask)
+        return mask
+
+    def count(self, passed):
+        if passed and self.limit is not None:
+            self.num += 1
+            if self.num > self.limit:
+                raise FilterStop('Filter chain hit reach limit {}'.format(self.limit))
+        return passed
+
+    def total_evaluations(self):
+        """
+        Total evaluations of leaf filters under this chain in this run.
+        """
+        total = 0
+        for i, child in enumerate(self.children):
+            total += child.total_evaluations() if isinstance(child, ChainFilter) else self.run_evaluations[i]
+        return total
+
+    def get_state(self):
+        return {
+            'evaluations': self.evaluations,
+            'hits': self.hits,
+            'children': [child.get_state() if isinstance(child, ChainFilter) else None for child in self.children],
+        }
+
+    def set_state(self, state):
+        if len(state.get('evaluations', [])) != len(self.children):
+            return
+        self.evaluations = list(state['evaluations'])
+        self.hits = list(state['hits'])
+        for child, child_state in zip(self.children, state['children']):
+            if isinstance(child, ChainFilter) and child_state:
+                child.set_state(child_state)
+        for i in range(len(self.children)):
+            if self.evaluations[i] > self.max_evaluations:
+                self.evaluations[i] //= 2
+                self.hits[i] //= 2
+
+    def prepare(self, consul, root):
+        for child in self.children:
+            child.prepare(consul, root)
+        if self.memo_key:
+            state = consul.get_memo(self.memo_namespace, '{}|{}'.format(root, self.memo_key))
+            if state:
+                self.set_state(state)
+            self.reorder()
+
+    def finish(self, consul, root):
+        for child in self.children:
+            child.finish(consul, root)
+        if self.memo_key:
+            consul.set_memo(self.memo_namespace, '{}|{}'.format(root, self.memo_key), self.get_state())
+
+    def get_results(self):
+        if self.results is None:
+            self.merge_results([child.get_results() for child in self.children])
+        return self.results
+
+    def get_memo_updates(self):
+        return [child.get_memo_updates() for child in self.children]
+
+    def merge_memo_updates(self, updates):
+        for i, child in enumerate(self.children):
+            child.merge_memo_updates([update[i] for update in updates if update])
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(repr(self.children[i]) for i in self.order))
+
+
+class AndFilter(ChainFilter):
+    """
+    Pass if all children pass, stop at the first child not passed.
+    """
+
+    def reach_rates(self):
+        rates = []
+        rate = 1.0
+        for i in self.order:
+            rates.append(rate)
+            rate *= self.pass_rate(i)
+        return rates
+
+    def rank(self, i):
+        # cost per rejection
+        return self.children[i].cost / (1 - self.pass_rate(i))
+
+    def decide(self, kwargs):
+        for i in self.order:
+            if not self.evaluate_child(i, kwargs):
+                return False
+        return True
+
+    def decide_many(self, columns, start):
+        size = len(columns[0])
+        rows = None
+        for i in self.order:
+            mask = self.evaluate_child_many(i, columns, rows, start)
+            rows = [j for j, passed in zip(rows or range(size), mask) if passed]
+            if not rows:
+                break
+        res = [False] * size
+        for j in rows:
+            res[j] = True
+        return res
+
+
+class OrFilter(ChainFilter):
+    """
+    Pass if any child passes, stop at the first child passed.
+    """
+
+    def reach_rates(self):
+        rates = []
+        rate = 1.0
+        for i in self.order:
+            rates.append(rate)
+            rate *= 1 - self.pass_rate(i)
+        return rates
+
+    def rank(self, i):
+        # cost per acceptance
+        return self.children[i].cost / self.pass_rate(i)
+
+    def decide(self, kwargs):
+        for i in self.order:
+            if self.evaluate_child(i, kwargs):
+                return True
+        return False
+
+    def decide_many(self, columns, start):
+        size = len(columns[0])
+        res = [False] * size
+        rows = None
+        for i in self.order:
+            mask = self.evaluate_child_many(i, columns, rows, start)
+            rest = []
+            for j, passed in zip(rows or range(size), mask):
+                if passed:
+                    res[j] = True
+                else:
+                    rest.append(j)
+            rows = rest
+            if not rows:
+                break
+        return res
+
+
+class NotFilter(ChainFilter):
+    """
+    Pass if the only child does not pass.
+    """
+
+    def decide(self, kwargs):
+        return not self.evaluate_child(0, kwargs)
+
+    def decide_many(self, columns, start):
+        return [not passed for passed in self.evaluate_child_many(0, columns, None, start)]
+
+
+# chain leaf name: (filter class, settings section of options, option set by a scalar, fixed options)
+CHAIN_LEAVES = {
+    'skip_directory': (SkipDirectoryFilter, None, None, {}),
+    'prefix': (PrefixFilter, 'prefix', 'prefixes', {}),
+    'search': (SearchFilter, 'search', 'query', {}),
+    'key': (SearchFilter, 'search', 'query', {'fields': 'keys', 'regex': False}),
+    'key_regex': (SearchFilter, 'search', 'query', {'fields': 'keys', 'regex': True}),
+    'value': (SearchFilter, 'search', 'query', {'fields': 'values', 'regex': False}),
+    'value_regex': (SearchFilter, 'search', 'query', {'fields': 'values', 'regex': True}),
+    'structured': (StructuredFilter, 'search', 'query', {}),
+    'diff': (DiffFilter, 'diff', 'semantic', {}),
+}
+CHAIN_NODES = {
+    'and': AndFilter,
+    'or': OrFilter,
+    'not': NotFilter,
+}
+
+
+def build_filter_chain(settings, spec, paired=False, limit=None):
+    """
+    Build filter chain from spec in config file.
+
+    Spec is a leaf or a dict of one operator ``and``, ``or`` or ``not`` to a list of specs (one spec for ``not``).
+    Leaf is a name in CHAIN_LEAVES, which uses command settings like search.query, or a dict of one name to its
+    options, e.g. ``{'key_regex': '^app/'}`` or ``{'search': {'query': 'timeout', 'fields': 'values'}}``.
+
+    :param settings: command settings
+    :param spec: chain spec
+    :param paired: build chain of paired filters, one data filters are evaluated on the first side
+    :param limit: limit of passed data, FilterStop is raised over limit
+    :return: ChainFilter
+    """
+    fil = _build_chain_node(settings, spec, paired)
+    if not isinstance(fil, ChainFilter):
+        fil = AndFilter(settings, [fil])
+    fil.limit = limit
+    fil.memo_key = json.dumps(spec, sort_keys=True, default=str)
+    return fil
+
+
+def _build_chain_node(settings, spec, paired):
+    if isinstance(spec, str):
+        name, options = spec, None
+    elif isinstance(spec, dict) and len(spec) == 1:
+        name, options = next(iter(spec.items()))
+    else:
+        raise ValueError('Invalid filter chain {}'.format(spec))
+    if name in CHAIN_NODES:
+        if name == 'not':
+            specs = options if isinstance(options, list) else [options]
+            if len(specs) != 1:
+                raise ValueError('Filter chain not takes one filter, got {}'.format(options))
+        else:
+            specs = options
+            if not isinstance(specs, list) or not specs:
+                raise ValueError('Filter chain {} takes a list of filters, got {}'.format(name, options))
+        return CHAIN_NODES[name](settings, [_build_chain_node(settings, s, paired) for s in specs])
+    if name not in CHAIN_LEAVES:
+        raise ValueError('Unknown filter {} in filter chain'.format(name))
+    cls, section, option, fixed = CHAIN_LEAVES[name]
+    leaf_settings = settings
+    if section and (options is not None or fixed):
+        # leaf options override the command section, e.g. search.query or search.max_value_size of the command
+        conf = dict(settings.get(section, {}) or {}, **fixed)
+        if isinstance(options, dict):
+            conf.update(options)
+        elif options is not None:
+            conf[option] = options
+        leaf_settings = Settings(dict(settings.as_dict(), **{section: conf}))
+    fil = cls(leaf_settings)
+    # leaves of a chain share the root, each leaf memoizes under its own spec
+    fil.scope_memo(json.dumps(spec, sort_keys=True, default=str))
+    if paired and not isinstance(fil, PairedFilter):
+        return PairedOneFilter(settings, fil)
+    if not paired and isinstance(fil, PairedFilter):
+        raise ValueError('Paired filter {} can not be used in filter chain'.format(name))
+    return fil
@@ -0,0 +1,198 @@
+import os
+import mmap
+import time
+import bisect
+import struct
+
+
+MMAP_MAGIC = b'CUMMAP01'
+# magic, number of key values, expire time
+MMAP_HEADER = struct.Struct('<8sqd')
+# key values and columns are separated by this byte, so a plain query without it never matches across key values
+MMAP_SEPARATOR = b'\0'
+# columns of offset table, each column is an int64 array of count items
+MMAP_COLUMNS = ['key_offset', 'key_length', 'value_offset', 'value_length', 'index']
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf8')
+    return value
+
+
+def write_mmap_file(filepath, vals, expire_at):
+    """
+    Write key values to memory mapped cache file.
+
+    File is a header, an offset table of int64 columns and then all keys and all values, each followed by a
+    separator. File is written to a temporary file and renamed, so readers never see a partial file.
+
+    :param filepath:
+    :param vals: key values with ModifyIndex as index
+    :param expire_at: unix time the file expires
+    """
+    count = len(vals)
+    data_offset = MMAP_HEADER.size + len(MMAP_COLUMNS) * 8 * count
+    columns = {name: [] for name in MMAP_COLUMNS}
+    keys = []
+    values = []
+    pos = data_offset
+    for kv in vals:
+        key = _to_bytes(kv['key'])
+        columns['key_offset'].append(pos)
+        columns['key_length'].append(len(key))
+        columns['index'].append(kv.get('index') if kv.get('index') is not None else -1)
+        keys.append(key)
+        pos += len(key) + 1
+    for kv in vals:
+        value = _to_bytes(kv['value'])
+        columns['value_offset'].append(pos)
+        if value is None:
+            columns['value_length'].append(-1)
+            value = b''
+        else:
+            columns['value_length'].append(len(value))
+        values.append(value)
+        pos += len(value) + 1
+    dirname = os.path.dirname(filepath)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(tmp_filepath, 'wb') as fp:
+        fp.write(MMAP_HEADER.pack(MMAP_MAGIC, count, float(expire_at)))
+        for name in MMAP_COLUMNS:
+            fp.write(struct.pack('<{}q'.format(count), *columns[name]))
+        for key in keys:
+            fp.write(key)
+            fp.write(MMAP_SEPARATOR)
+        for value in values:
+            fp.write(value)
+            fp.write(MMAP_SEPARATOR)
+    os.replace(tmp_filepath, filepath)
+
+
+class MmapKvFile:
+    """
+    Read only key values in memory mapped cache file.
+
+    Processes mapping the same file share it in the OS page cache. Keys and values are scanned as bytes without
+    copying, only matched key values are decoded.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        with open(filepath, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.expire_at = MMAP_HEADER.unpack_from(self._mm, 0)
+        if magic != MMAP_MAGIC:
+            self._mm.close()
+            raise ValueError('Invalid mmap cache file {}'.format(filepath))
+        self._view = memoryview(self._mm)
+        self._table = self._view[MMAP_HEADER.size:MMAP_HEADER.size + len(MMAP_COLUMNS) * 8 * self.count].cast('q')
+        for i, name in enumerate(MMAP_COLUMNS):
+            setattr(self, '_' + name, self._table[i * self.count:(i + 1) * self.count])
+
+    @classmethod
+    def open(cls, filepath):
+        """
+        Open memory mapped cache file.
+
+        :return: MmapKvFile or None if file not exists, is invalid or expired
+        """
+        if not os.path.exists(filepath):
+            return None
+        try:
+            kvfile = cls(filepath)
+        except (OSError, ValueError, struct.error):
+            return None
+        if kvfile.expire_at < time.time():
+            kvfile.close()
+            return None
+        return kvfile
+
+    def __len__(self):
+        return self.count
+
+    def key(self, i):
+        """
+        Key of i-th key value as memoryview.
+        """
+        offset = self._key_offset[i]
+        return self._view[offset:offset + self._key_length[i]]
+
+    def value(self, i):
+        """
+        Value of i-th key value as memoryview, None if value is None.
+        """
+        length = self._value_length[i]
+        if length < 0:
+            return None
+        offset = self._value_offset[i]
+        return self._view[offset:offset + length]
+
+    def record(self, i, with_index=False):
+        """
+        Decode i-th key value to dict like ConsulKvSearch.get.
+        """
+        value = self.value(i)
+        if value is not None:
+            value = bytes(value)
+            try:
+                value = value.decode('utf8')
+            except UnicodeDecodeError:
+                pass
+        kv = {'key': bytes(self.key(i)).decode('utf8'), 'value': value}
+        if with_index:
+            kv['index'] = self._index[i] if self._index[i] >= 0 else None
+        return kv
+
+    def iter_records(self, with_index=False):
+        for i in range(self.count):
+            yield self.record(i, with_index)
+
+    def search(self, query, fields='keys', regex=False):
+        """
+        Find key values whose key or value contains query or matches regex, in order.
+
+        Plain query is found by scanning all keys or all values at once, regex is searched in each key or value.
+
+        :param query: bytes, or compiled bytes regex if regex is set
+        :param fields: keys or values
+        :param regex:
+        :return: generator of index of matched key values
+        """
+        if fields == 'keys':
+            get, offsets, lengths = self.key, self._key_offset, self._key_length
+        else:
+            get, offsets, lengths = self.value, self._value_offset, self._value_length
+        if regex:
+            for i in range(self.count):
+                data = get(i)
+                if data is not None and query.search(data):
+                    yield i
+        elif not query or MMAP_SEPARATOR in query:
+            for i in range(self.count):
+                data = get(i)
+                if data is not None and query in bytes(data):
+                    yield i
+        elif self.count:
+            pos = offsets[0]
+            end = offsets[self.count - 1] + max(lengths[self.count - 1], 0)
+            while True:
+                pos = self._mm.find(query, pos, end)
+                if pos < 0:
+                    return
+                i = bisect.bisect_right(offsets, pos) - 1
+                yield i
+                # continue from the next key value
+                pos = offsets[i] + max(lengths[i], 0) + 1
+
+    def close(self):
+        """
+        Close file, key and value memoryviews got from this file must be released before.
+        """
+        for name in MMAP_COLUMNS:
+            getattr(self, '_' + name).release()
+        self._table.release()
+        self._view.release()
+        self._mm.close()
@@ -0,0 +1,140 @@
+import re
+import heapq
+
+
+TOKEN = re.compile(r'[0-9a-z]+')
+# max tokens whose scores are memoized, cleared when full
+MEMO_MAX_TOKENS = 100000
+
+
+def tokenize(text):
+    """
+    Split text to lower case alphanumeric tokens, e.g. app/db_host -> app, db, host.
+    """
+    return TOKEN.findall(text.lower())
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Levenshtein distance between a and b, stop early if larger than max_distance.
+
+    :return: distance or max_distance + 1 if larger
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if len(a) > len(b):
+        a, b = b, a
+    previous = list(range(len(a) + 1))
+    for i, cb in enumerate(b, 1):
+        current = [i]
+        for j, ca in enumerate(a, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class FuzzyScorer:
+    """
+    Score how well text matches query.
+
+    Text containing the whole query scores above 1, higher if query covers more of text. Otherwise score is the
+    average over query tokens of the best similarity with any token of text: 1 if equal, the covered part if
+    contained and 1 - distance / length if within edit distance, so ``db_hots`` still finds ``db/host``.
+    """
+
+    def __init__(self, query, max_distance=2):
+        self.query = query.lower()
+        self.tokens = tokenize(query)
+        self.max_distance = max_distance
+        self._chars = [set(q) for q in self.tokens]
+        # best similarity of a text token with each query token, tokens repeat a lot across keys
+        self._memo = {}
+
+    def score(self, text) -> float:
+        if not text:
+            return 0.0
+        lower = text.lower()
+        if self.query and self.query in lower:
+            return 1.0 + len(self.query) / len(lower)
+        if not self.tokens:
+            return 0.0
+        best = None
+        memo = self._memo
+        for token in TOKEN.findall(lower):
+            sims = memo.get(token)
+            if sims is None:
+                sims = [self.similarity(i, token) for i in range(len(self.tokens))]
+                # most tokens are not similar to any query token, they are skipped by empty tuple
+                sims = memo[token] = sims if any(sims) else ()
+            if not sims:
+                continue
+            if best is None:
+                best = list(sims)
+            else:
+                best = [max(a, b) for a, b in zip(best, sims)]
+        if len(memo) > MEMO_MAX_TOKENS:
+            memo.clear()
+        return sum(best) / len(best) if best else 0.0
+
+    def similarity(self, i, token) -> float:
+        """
+        Similarity of token with i-th query token.
+        """
+        q = self.tokens[i]
+        if q == token:
+            return 1.0
+        if q in token:
+            return len(q) / len(token)
+        max_distance = min(self.max_distance, len(q) // 3)
+        if max_distance <= 0 or abs(len(q) - len(token)) > max_distance:
+            return 0.0
+        # each char of token not in query token takes one edit, cheap lower bound of distance
+        chars = self._chars[i]
+        if sum(c not in chars for c in token) > max_distance:
+            return 0.0
+        distance = edit_distance(q, token, max_distance)
+        if distance > max_distance:
+            return 0.0
+        return 1.0 - distance / max(len(q), len(token))
+
+
+class TopK:
+    """
+    Best k items by score in a bounded min heap, ties keep the item added first.
+    """
+
+    def __init__(self, k):
+        self.k = max(int(k), 0)
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, score, index):
+        """
+        Add item by its index.
+
+        :return: true if item is kept
+        """
+        item = (score, -index)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+            return True
+        if self.heap and item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+            return True
+        return False
+
+    def merge(self, items):
+        for score, neg_index in items:
+            self.push(score, -neg_index)
+
+    def items(self):
+        """
+        Kept items sorted by score descending.
+
+        :return: list of (score, index)
+        """
+        return [(score, -neg_index) for score, neg_index in sorted(self.heap, reverse=True)]
@@ -0,0 +1,80 @@
+import re
+import logging
+
+
+# regex backends in order of fallback, re2 and hyperscan match in linear time
+REGEX_BACKENDS = ['hyperscan', 're2', 're']
+
+
+class HyperscanPattern:
+    """
+    Regex compiled by hyperscan, only tells whether data matches like a search result.
+
+    Hyperscan scans bytes, str data is encoded as utf8.
+    """
+
+    def __init__(self, pattern):
+        import hyperscan
+        self._hyperscan = hyperscan
+        self.pattern = pattern
+        flags = hyperscan.HS_FLAG_SINGLEMATCH
+        if isinstance(pattern, str):
+            flags |= hyperscan.HS_FLAG_UTF8
+            pattern = pattern.encode('utf8')
+        self._db = hyperscan.Database()
+        self._db.compile(expressions=[pattern], ids=[0], elements=1, flags=[flags])
+
+    @staticmethod
+    def _on_match(id, start, end, flags, context):
+        # stop scanning at the first match
+        return True
+
+    def search(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        elif isinstance(data, memoryview):
+            data = data.tobytes()
+        try:
+            self._db.scan(data, match_event_handler=self._on_match)
+        except self._hyperscan.ScanTerminated:
+            return True
+        return None
+
+
+class Re2Pattern:
+    """
+    Regex compiled by re2.
+    """
+
+    def __init__(self, pattern):
+        import re2
+        self.pattern = pattern
+        self._regex = re2.compile(pattern)
+
+    def search(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return self._regex.search(data)
+
+
+def compile_regex(pattern, backend='re'):
+    """
+    Compile regex by backend, fall back to the next backend if library is missing or pattern is not supported.
+
+    Hyperscan falls back to re2 and re2 falls back to re, e.g. back references are only supported by re.
+
+    :param pattern: str or bytes pattern
+    :param backend: re, re2 or hyperscan
+    :return: compiled regex with search method, search result is truthy if data matches
+    """
+    if backend not in REGEX_BACKENDS:
+        raise ValueError('Invalid regex backend {}, must be one of {}'.format(backend, ', '.join(REGEX_BACKENDS)))
+    for name in REGEX_BACKENDS[REGEX_BACKENDS.index(backend):]:
+        if name == 're':
+            return re.compile(pattern)
+        try:
+            return HyperscanPattern(pattern) if name == 'hyperscan' else Re2Pattern(pattern)
+        except ImportError:
+            logging.warning('Regex backend {} is not installed, fall back'.format(name))
+        except Exception as e:
+            logging.warning('Regex {} is not supported by {}, fall back: {}'.format(pattern, name, e))
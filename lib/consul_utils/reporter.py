@@ -1,16 +1,107 @@
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+import itertools
+from .exceptions import ConsulException
+from .stats import Stats
+from .spill import SpillList
 
 
 OUT_ALL_KEY = 'scan'
 OUT_FILTERED_KEY = 'filtered'
 OUT_NON_FILTERED_KEY = 'non_filtered'
 OUT_FLAG_KEY = 'flags'
+OUT_AGE_KEY = 'age'
+
+
+class RecordStream:
+    """
+    Records generated by a function each time iterated.
+
+    Used as output data in place of a list, records are streamed to the reporter without being held in memory.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+
+    def __iter__(self):
+        return iter(self._func(*self._args, **self._kwargs))
+
+
+class RecordTee:
+    """
+    Records of several sections generated by one pass over a source.
+
+    Records of the section being reported are streamed, records of other sections met on the way are kept in lists
+    until their section is reported, so the source is generated once however many sections are reported.
+    """
+
+    def __init__(self, records, sections, new_list=list):
+        """
+        :param records: iterable of (record, sections of record)
+        :param sections: sections to report, records of other sections are dropped
+        :param new_list: function to create list of records kept for a section
+        """
+        self._records = iter(records)
+        self._buffers = {section: new_list() for section in sections}
+
+    def stream(self, section) -> RecordStream:
+        """
+        Records of section, streamed once.
+        """
+        return RecordStream(self._iter_section, section)
+
+    def drain(self):
+        """
+        Generate the rest of the source, records are kept for sections not reported yet.
+        """
+        for record, sections in self._records:
+            self._keep(record, sections)
+
+    def _keep(self, record, sections, skip=None):
+        for section in sections:
+            buffered = self._buffers.get(section)
+            if section != skip and buffered is not None:
+                buffered.append(record)
+
+    def _iter_section(self, section):
+        buffered = self._buffers.get(section)
+        if buffered is None:
+            return
+        # records of section are no longer kept once reported
+        self._buffers[section] = None
+        for record in buffered:
+            yield record
+        for record, sections in self._records:
+            self._keep(record, sections, skip=section)
+            if section in sections:
+                yield record
+
+
+def is_records(data) -> bool:
+    """
+    Whether data is a list of records, in memory, spilled to disk or streamed.
+    """
+    return isinstance(data, (tuple, list, RecordStream, SpillList))
 
 
 class ReporterStream:
     """
     Base class for report stream.
+
+    Lines are buffered and written in chunks of chunk_size lines.
     """
 
+    def __init__(self, chunk_size=1000):
+        self._chunk_size = max(int(chunk_size), 1)
+        self._lines = []
+        self.count = 0
+
     def open(self):
         """
         Open stream.
@@ -23,13 +114,41 @@ class ReporterStream:
 
         :param data:
         """
+        self.write(data + '\n')
+
+    def write(self, data):
+        """
+        Write text to stream.
+
+        :param data:
+        """
+        self._lines.append(data)
+        self.count += 1
+        if len(self._lines) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered lines.
+        """
+        if self._lines:
+            self._write_chunk(''.join(self._lines))
+            self._lines = []
+
+    def _write_chunk(self, chunk):
         pass
 
+    def sync(self):
+        """
+        Write buffered lines and flush them to console or file, for long running output.
+        """
+        self.flush()
+
     def close(self):
         """
         Close stream.
         """
-        pass
+        self.flush()
 
     def __enter__(self):
         return self.open()
@@ -43,29 +162,64 @@ class ConsoleStream(ReporterStream):
     Stream to console.
     """
 
-    def append(self, data):
-        print(data)
+    def __init__(self, encoding=None, chunk_size=1000):
+        super().__init__(chunk_size)
+        self._encoding = encoding
+
+    def _write_chunk(self, chunk):
+        out = sys.stdout
+        if self._encoding and hasattr(out, 'buffer'):
+            out.flush()
+            out.buffer.write(chunk.encode(self._encoding, errors='replace'))
+            out.buffer.flush()
+        else:
+            out.write(chunk)
+            out.flush()
 
 
 class FileStream(ReporterStream):
     """
-    Stream to file.
+    Stream to file, file ends with .gz or .zst will be compressed.
     """
 
-    def __init__(self, filepath, mode='w'):
+    def __init__(self, filepath, mode='w', encoding='utf8', buffer_size=1024 * 1024, chunk_size=1000):
+        super().__init__(chunk_size)
         self._filepath = filepath
         self._mode = mode
+        self._encoding = encoding
+        self._buffer_size = buffer_size
         self._fp = None
+        self._raw = None
 
     def open(self):
-        self._fp = open(self._filepath, self._mode)
+        mode = self._mode.replace('t', '').replace('b', '') + 'b'
+        if self._filepath.endswith('.gz'):
+            self._raw = gzip.open(self._filepath, mode)
+            fp = io.BufferedWriter(self._raw, buffer_size=self._buffer_size)
+        elif self._filepath.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                raise ConsulException('Package zstandard is required to write {}'.format(self._filepath))
+            self._raw = open(self._filepath, mode)
+            fp = io.BufferedWriter(zstandard.ZstdCompressor().stream_writer(self._raw), buffer_size=self._buffer_size)
+        else:
+            fp = open(self._filepath, mode, buffering=self._buffer_size)
+        self._fp = io.TextIOWrapper(fp, encoding=self._encoding, errors='replace', newline='')
         return self
 
-    def append(self, data):
-        self._fp.write(data + '\n')
+    def _write_chunk(self, chunk):
+        self._fp.write(chunk)
+
+    def sync(self):
+        self.flush()
+        self._fp.flush()
 
     def close(self):
+        self.flush()
         self._fp.close()
+        if self._raw and not self._raw.closed:
+            self._raw.close()
 
 
 class BaseReporter:
@@ -73,8 +227,9 @@ class BaseReporter:
     Base class for reporter.
     """
 
-    def __init__(self, settings):
+    def __init__(self, settings, stats=None):
         self._settings = settings
+        self.stats = stats or Stats()
 
     def trim_data(self, data):
         """
@@ -91,6 +246,8 @@ class BaseReporter:
             del data[OUT_NON_FILTERED_KEY]
         if not self.settings.get('reporter.show_flags', False):
             del data[OUT_FLAG_KEY]
+        if not self.settings.get('reporter.show_age', False):
+            data.pop(OUT_AGE_KEY, None)
         return data
 
     def format(self, data, **kwargs):
@@ -110,14 +267,38 @@ class BaseReporter:
         :return:
         """
         data = self.trim_data(data)
-        if self.settings.get('reporter.output_file'):
-            with FileStream(self.settings.get('reporter.output_file')) as stream:
-                for line in self.format(data, **kwargs):
-                    stream.append(line)
+        with self.get_stream() as stream:
+            for line in self.format(data, **kwargs):
+                stream.append(line)
+
+    def get_stream(self, filepath=None):
+        """
+        Get stream to output file or console.
+
+        :param filepath: output file, use reporter.output_file if not specified
+        :return: ReporterStream
+        """
+        filepath = filepath or self.settings.get('reporter.output_file', '')
+        encoding = self.settings.get('reporter.encoding', 'utf8')
+        chunk_size = int(self.settings.get('reporter.chunk_size', 1000))
+        if filepath:
+            buffer_size = int(self.settings.get('reporter.buffer_size', 1024 * 1024))
+            stream = FileStream(filepath, encoding=encoding, buffer_size=buffer_size, chunk_size=chunk_size)
         else:
-            with ConsoleStream() as stream:
-                for line in self.format(data, **kwargs):
-                    stream.append(line)
+            stream = ConsoleStream(encoding=encoding, chunk_size=chunk_size)
+        return stream
+
+    def counted(self, records):
+        """
+        Yield records, counted as records_written once iterated.
+        """
+        count = 0
+        try:
+            for d in records:
+                count += 1
+                yield d
+        finally:
+            self.stats.incr('records_written', count)
 
     @property
     def settings(self):
@@ -132,24 +313,38 @@ class TextReporter(BaseReporter):
     def format(self, data, **kwargs):
         if OUT_ALL_KEY in data:
             yield '\nScan:'
-            for d in data[OUT_ALL_KEY]:
+            for d in self.counted(data[OUT_ALL_KEY]):
                 yield self.to_text(d)
         if OUT_NON_FILTERED_KEY in data:
             yield '\nNon Filtered:'
-            for d in data[OUT_NON_FILTERED_KEY]:
+            for d in self.counted(data[OUT_NON_FILTERED_KEY]):
                 yield self.to_text(d)
         if OUT_FILTERED_KEY in data:
             yield '\nFiltered:'
-            for d in data[OUT_FILTERED_KEY]:
+            for d in self.counted(data[OUT_FILTERED_KEY]):
                 yield self.to_text(d)
         if OUT_FLAG_KEY in data:
             yield '\nFlags:'
-            for d in data[OUT_FLAG_KEY]:
-                yield self.to_text(d)
+            for flag, res in data[OUT_FLAG_KEY].items():
+                yield '{}:'.format(flag)
+                for d in self.counted(res if is_records(res) else [res]):
+                    yield self.to_text(d)
+        if OUT_AGE_KEY in data:
+            yield '\nAge:'
+            for d in self.counted(data[OUT_AGE_KEY]):
+                age = 'unknown' if d['value'] is None else '{}s'.format(d['value'])
+                yield '{}: {}{}'.format(d['key'], age, ', stale' if d.get('stale') else '')
 
     def to_text(self, d):
         if 'key' in d and 'value' in d:
-            return '{}: {}'.format(d['key'], d['value'])
+            text = '{}: {}'.format(d['key'], d['value'])
+            if 'root' in d:
+                # key value of one of multiple roots
+                text = '[{}] {}'.format(d['root'], text)
+            if 'score' in d:
+                # key value ranked by score
+                text = '{} (score {})'.format(text, d['score'])
+            return text
         elif isinstance(d, (tuple, list)):
             return '---> {}: {}\n<--- {}: {}'.format(d[0]['key'], d[0]['value'], d[1]['key'], d[1]['value'])
         else:
@@ -159,40 +354,181 @@ class TextReporter(BaseReporter):
 class JsonReporter(BaseReporter):
     """
     Json format reporter.
+
+    Output is the same as json.dumps of data with indent 4, but records of each section, and of filter results in
+    flags, are dumped one by one, so spilled or streamed records are never held in memory at once.
     """
 
     def format(self, data, **kwargs):
-        import json
-        yield json.dumps(data, indent=4)
+        for line in self.format_value(data, '', '', ''):
+            yield line
+
+    def format_value(self, value, prefix, end, indent):
+        """
+        Format value to json lines, nested dicts and record lists are formatted item by item.
+
+        :param value:
+        :param prefix: prefix of the first line
+        :param end: end of the last line
+        :param indent: indent of lines after the first
+        """
+        inner = indent + '    '
+        if is_records(value):
+            previous = None
+            for d in self.counted(value):
+                if previous is None:
+                    yield prefix + '['
+                else:
+                    yield previous + ','
+                previous = inner + json.dumps(d, indent=4, default=list).replace('\n', '\n' + inner)
+            if previous is None:
+                yield prefix + '[]' + end
+            else:
+                yield previous
+                yield indent + ']' + end
+        elif isinstance(value, dict) and value and all(isinstance(k, str) for k in value):
+            yield prefix + '{'
+            last = len(value) - 1
+            for i, (key, v) in enumerate(value.items()):
+                for line in self.format_value(v, inner + json.dumps(key) + ': ', '' if i == last else ',', inner):
+                    yield line
+            yield indent + '}' + end
+        else:
+            yield prefix + json.dumps(value, indent=4, default=list).replace('\n', '\n' + indent) + end
 
 
 class CsvReport(BaseReporter):
     """
     Csv format reporter.
+
+    Each row starts with the output category (scan, filtered, non_filtered or flags). If reporter.csv_split is set,
+    each output category is written to its own file with a header row instead, e.g. out.filtered.csv. Key values of
+    multiple roots have the root before key.
     """
 
+    one_header = ['key', 'value']
+    root_header = ['root', 'key', 'value']
+    paired_header = ['key1', 'value1', 'key2', 'value2']
+    flag_header = ['flag', 'key', 'value']
+
+    def report(self, data, **kwargs):
+        data = self.trim_data(data)
+        filepath = self.settings.get('reporter.output_file', '')
+        if filepath and self.settings.get('reporter.csv_split', False):
+            for section, header, rows in self.format_sections(data):
+                with self.get_stream(section_filepath(filepath, section)) as stream:
+                    writer = csv.writer(stream, lineterminator='\n')
+                    writer.writerow(header)
+                    writer.writerows(rows)
+        else:
+            with self.get_stream() as stream:
+                writer = csv.writer(stream, lineterminator='\n')
+                for row in self.format(data, **kwargs):
+                    writer.writerow(row)
+
     def format(self, data, **kwargs):
-        if OUT_ALL_KEY in data:
-            yield '\nScan:'
-            for d in data[OUT_ALL_KEY]:
-                yield self.to_csv(d)
-        if OUT_NON_FILTERED_KEY in data:
-            yield '\nNon Filtered:'
-            for d in data[OUT_NON_FILTERED_KEY]:
-                yield self.to_csv(d)
-        if OUT_FILTERED_KEY in data:
-            yield '\nFiltered:'
-            for d in data[OUT_FILTERED_KEY]:
-                yield self.to_csv(d)
+        for section, header, rows in self.format_sections(data):
+            for row in rows:
+                yield [section] + row
+
+    def format_sections(self, data):
+        """
+        Format data, yield (section, header, rows) for each output category.
+        """
+        for section in [OUT_ALL_KEY, OUT_NON_FILTERED_KEY, OUT_FILTERED_KEY]:
+            if section in data:
+                # peek the first record to choose header, records may be streamed
+                records = iter(data[section])
+                first = next(records, None)
+                if isinstance(first, (tuple, list)):
+                    header = self.paired_header
+                else:
+                    header = self.root_header if isinstance(first, dict) and 'root' in first else self.one_header
+                    if isinstance(first, dict) and 'score' in first:
+                        header = header + ['score']
+                if first is not None:
+                    records = itertools.chain([first], records)
+                yield section, header, (self.to_csv(d) for d in self.counted(records))
         if OUT_FLAG_KEY in data:
-            yield '\nFlags:'
-            for d in data[OUT_FLAG_KEY]:
-                yield self.to_csv(d)
+            yield OUT_FLAG_KEY, self.flag_header, self.flag_rows(data[OUT_FLAG_KEY])
+        if OUT_AGE_KEY in data:
+            yield OUT_AGE_KEY, self.one_header, (self.to_csv(d) for d in self.counted(data[OUT_AGE_KEY]))
+
+    def flag_rows(self, flags):
+        for flag, res in flags.items():
+            for d in self.counted(res if is_records(res) else [res]):
+                if isinstance(d, dict) and 'key' in d and 'value' in d:
+                    yield [flag, d['key'], d['value']]
+                else:
+                    yield [flag, None, d]
 
     def to_csv(self, d):
         if 'key' in d and 'value' in d:
-            return '{},{}'.format(d['key'], d['value'])
+            row = [d['root'], d['key'], d['value']] if 'root' in d else [d['key'], d['value']]
+            if 'score' in d:
+                row.append(d['score'])
+            return row
         elif isinstance(d, (tuple, list)):
-            return '{},{},{},{}'.format(d[0]['key'], d[0]['value'], d[1]['key'], d[1]['value'])
+            return [d[0]['key'], d[0]['value'], d[1]['key'], d[1]['value']]
         else:
-            return str(d)
+            return [str(d)]
+
+
+class ParquetReporter(CsvReport):
+    """
+    Parquet columnar format reporter, requires pyarrow.
+
+    Each output category is written to its own file, e.g. out.filtered.parquet, in row groups of
+    reporter.batch_size rows.
+    """
+
+    def report(self, data, **kwargs):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ConsulException('Package pyarrow is required for parquet output')
+        filepath = self.settings.get('reporter.output_file', '')
+        if not filepath:
+            raise ConsulException('Output file is required for parquet output')
+        batch_size = int(self.settings.get('reporter.batch_size', 65536))
+        data = self.trim_data(data)
+        for section, header, rows in self.format_sections(data):
+            schema = pyarrow.schema([(name, pyarrow.string()) for name in header])
+            with pyarrow.parquet.ParquetWriter(section_filepath(filepath, section), schema) as writer:
+                for batch in chunked(rows, batch_size):
+                    columns = [[to_str(row[i]) if i < len(row) else None for row in batch] for i in range(len(header))]
+                    writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=schema))
+
+
+def section_filepath(filepath, section):
+    """
+    Insert section name before file extensions, out.csv.gz -> out.filtered.csv.gz.
+    """
+    dirname, basename = os.path.split(filepath)
+    pos = basename.find('.', 1)
+    if pos < 0:
+        return os.path.join(dirname, '{}.{}'.format(basename, section))
+    return os.path.join(dirname, '{}.{}{}'.format(basename[:pos], section, basename[pos:]))
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of size items from iterable.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def to_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf8', errors='backslashreplace')
+    return str(value)
@@ -1,7 +1,46 @@
+import os
+import json
+import time
+import shutil
+import hashlib
 import logging
 import base64
+import bisect
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import consul
 from diskcache import Cache
+from .stats import Stats
+from .servers import ServerPool, parse_server
+from .mmapcache import MmapKvFile, write_mmap_file
+from .exceptions import ConsulException
+
+
+# max operations in one consul transaction
+TXN_MAX_OPS = 64
+# max keys directly under root read one by one in sharded reads, or root is read in one request
+SHARD_MAX_LEAVES = 64
+# max prefixes read at once by get_roots
+ROOTS_MAX_WORKERS = 8
+
+
+def normalize_roots(roots):
+    """
+    Minimal set of non overlapping prefixes covering roots, e.g. app/, app/web/ and db/ -> app/, db/.
+
+    Roots are prefixes of keys like consul recursive reads, so app also covers app/ and apple.
+
+    :param roots: list of roots
+    :return: sorted list of prefixes
+    """
+    prefixes = []
+    for root in sorted(set(r or '' for r in roots)):
+        # keys sorted between a prefix and a root it covers all start with the prefix
+        if prefixes and root.startswith(prefixes[-1]):
+            continue
+        prefixes.append(root)
+    return prefixes
 
 
 class ConsulKvSearch:
@@ -10,39 +49,186 @@ class ConsulKvSearch:
     """
 
     def __init__(self, host, port, scheme, token, verify=True, cert=None, root='', cache_enabled=True,
-                 cache_dir='.consul_cache', cache_ttl=600):
+                 cache_dir='.consul_cache', cache_ttl=600, memo_ttl=604800, mmap_enabled=False, stale_grace=0,
+                 lease_ttl=0, consistency='default', servers=None, server_cooldown=30, stats=None):
+        if servers and not host:
+            # the first server is the primary, which writes go to and cache is kept by
+            host, port, scheme = parse_server(servers[0], port, scheme)
         self._host = host
         self._port = port
         self._scheme = scheme
+        self._consistency = consistency or 'default'
         self._token = token
         self._verify = verify
         self._cert = cert
         self._cache_enabled = cache_enabled
         self._cache_dir = cache_dir
         self.cache_ttl = cache_ttl
+        self.memo_ttl = memo_ttl
+        self._mmap_enabled = mmap_enabled
+        self.stale_grace = stale_grace
+        self.lease_ttl = lease_ttl
         self._root = root
-        self._client = consul.Consul(host=host, port=port, token=token, scheme=scheme, verify=verify, cert=cert)
+        self.stats = stats or Stats()
+        # age in seconds of key values got by key, 0 if got from consul, None if unknown
+        self.ages = {}
+        self._refreshing = {}
+        self._refresh_lock = threading.Lock()
+        self._client = self._create_client()
+        self._client_thread = threading.get_ident()
+        self._local = threading.local()
+        self._pool = None
+        if servers:
+            self._pool = ServerPool([parse_server(s, port, scheme) for s in servers], self._create_client,
+                                    cooldown=server_cooldown, stats=self.stats)
+
+    def _create_client(self, host=None, port=None, scheme=None):
+        return consul.Consul(host=host or self._host, port=port or self._port, token=self._token,
+                             scheme=scheme or self._scheme, consistency=self._consistency, verify=self._verify,
+                             cert=self._cert)
+
+    def _kv_get(self, client=None, **kwargs):
+        """
+        Read from consul kv, by servers in turn with failover if servers are set.
+
+        :param client: client used if servers are not set, the primary client if None
+        :return: tuple of (consul index, data)
+        """
+        if self._pool is not None:
+            return self._pool.call(lambda c: c.kv.get(**kwargs))
+        return (client or self._thread_client()).kv.get(**kwargs)
+
+    def _thread_client(self):
+        """
+        Client of the current thread, requests session of the client is not shared between threads.
+        """
+        if threading.get_ident() == self._client_thread:
+            return self._client
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._create_client()
+        return client
+
+    def _get_tree(self, key, client=None):
+        """
+        Read raw key values under key, sharded by sub directories across servers if there are more than one.
+
+        Each shard is read at its own consul index, so key values of different shards may be from different
+        points in time like stale reads.
 
-    def get_cache(self, key, default=None, expire_time=False):
+        :return: raw key values sorted by key or None
+        """
+        if self._pool is None or len(self._pool) < 2:
+            return self._kv_get(client, key=key, recurse=True)[1]
+        index, children = self._kv_get(key=key, keys=True, separator='/')
+        children = children or []
+        # key itself is listed if it exists, it is read as a leaf
+        dirs = [k for k in children if k.endswith('/') and k != key]
+        leaves = [k for k in children if not k.endswith('/') or k == key]
+        if len(dirs) < 2 or len(leaves) > SHARD_MAX_LEAVES:
+            return self._kv_get(key=key, recurse=True)[1]
+        shards = [(d, True) for d in dirs] + [(k, False) for k in leaves]
+        with ThreadPoolExecutor(max_workers=min(len(self._pool) * 2, len(shards))) as executor:
+            results = list(executor.map(lambda s: self._kv_get(key=s[0], recurse=s[1])[1], shards))
+        self.stats.incr('shard_reads', len(shards))
+        vals = []
+        for res in results:
+            if isinstance(res, dict):
+                # single key is read as one key value
+                vals.append(res)
+            elif res:
+                vals.extend(res)
+        vals.sort(key=lambda val: val['Key'])
+        return vals or None
+
+    def get_cache(self, key, default=None, expire_time=False, tag=False):
         if self._cache_enabled:
-            return self.cache.get(key=self._get_cache_key(key), default=default, expire_time=expire_time)
+            return self.cache.get(key=self._get_cache_key(key), default=default, expire_time=expire_time, tag=tag)
         return None
 
-    def set_cache(self, key, value, expire):
+    def set_cache(self, key, value, expire, tag=None):
         if self._cache_enabled:
-            return self.cache.set(key=self._get_cache_key(key), value=value, expire=expire)
+            return self.cache.set(key=self._get_cache_key(key), value=value, expire=expire, tag=tag)
         return False
 
     def del_cache(self, key):
         if self._cache_enabled:
+            self._remove_mmap(self._get_cache_key(key))
             return self.cache.delete(key=self._get_cache_key(key))
         return True
 
     def clear_cache(self):
         if self._cache_enabled:
             self.cache.clear()
+            shutil.rmtree(os.path.join(self._cache_dir, 'mmap'), ignore_errors=True)
 
-    def get_key(self, key, recurse=True, raw=False, keys=False, **kwargs):
+    def get_mmap(self, key):
+        """
+        Get key values under key from memory mapped cache file, which is shared by processes reading the same key.
+
+        The file is written from cached key values, or from consul if not cached, and expires with the cache.
+
+        :param key:
+        :return: MmapKvFile or None if cache or mmap is disabled
+        """
+        if not self._cache_enabled or not self._mmap_enabled:
+            return None
+        key = key or ''
+        filepath = self._get_mmap_path(self._get_cache_key(key))
+        with self.stats.timer('cache'):
+            kvfile = MmapKvFile.open(filepath)
+        if kvfile is not None:
+            logging.info('Hit {} from mmap cache'.format(key))
+            self.stats.incr('mmap_hit')
+            return kvfile
+        self.stats.incr('mmap_miss')
+        with self.stats.timer('cache'):
+            vals, expire_at, fetched_at = self.get_cache(key=key, expire_time=True, tag=True)
+        if self._is_stale(fetched_at):
+            # stale key values are served by get and refreshed in background
+            return None
+        if vals and 'index' in vals[0]:
+            if fetched_at:
+                expire_at = fetched_at + self.cache_ttl
+            with self.stats.timer('cache'):
+                write_mmap_file(filepath, vals, expire_at or time.time() + self.cache_ttl)
+        else:
+            # mmap file is written when key values are got from consul
+            self.get(key, refresh=True)
+        with self.stats.timer('cache'):
+            return MmapKvFile.open(filepath)
+
+    def _get_mmap_path(self, cache_key):
+        return os.path.join(self._cache_dir, 'mmap', hashlib.sha1(cache_key).hexdigest() + '.kv')
+
+    def _remove_mmap(self, cache_key):
+        filepath = self._get_mmap_path(cache_key)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    def get_memo(self, namespace, root):
+        """
+        Get memoized data for key values under root, e.g. parsed values by key and ModifyIndex.
+
+        :param namespace: memo namespace
+        :param root:
+        :return: memoized data or None
+        """
+        with self.stats.timer('cache'):
+            return self.get_cache(key='memo:{}:{}'.format(namespace, root or ''))
+
+    def set_memo(self, namespace, root, value):
+        """
+        Save memoized data for key values under root.
+
+        :param namespace: memo namespace
+        :param root:
+        :param value: memoized data
+        """
+        with self.stats.timer('cache'):
+            return self.set_cache(key='memo:{}:{}'.format(namespace, root or ''), value=value, expire=self.memo_ttl)
+
+    def get_key(self, key, recurse=True, raw=False, keys=False, with_index=False, **kwargs):
         """
         Get key value from consul kv.
 
@@ -50,40 +236,269 @@ class ConsulKvSearch:
         :param recurse:
         :param raw:
         :param keys:
+        :param with_index: add ModifyIndex of each key as index
         :param kwargs:
         :return:
         """
-        index, vals = self._client.kv.get(key=key, recurse=recurse, keys=keys, **kwargs)
+        with self.stats.timer('fetch'):
+            if recurse and not keys and not kwargs:
+                vals = self._get_tree(key)
+            else:
+                index, vals = self._kv_get(key=key, recurse=recurse, keys=keys, **kwargs)
         if not raw and not keys and vals:
-            res = []
+            return self._decode(vals, with_index)
+        return vals
+
+    def watch_key(self, key, index=None, wait=None):
+        """
+        Blocking query of key values under key, returns when consul index is larger than index or wait timeout.
+
+        :param key:
+        :param index: last consul index, return immediately if None
+        :param wait: max wait time like 5m
+        :return: tuple of (consul index, key values with ModifyIndex as index)
+        """
+        with self.stats.timer('fetch'):
+            index, vals = self._kv_get(key=key, recurse=True, index=index, wait=wait)
+        return int(index), self._decode(vals, with_index=True) if vals else []
+
+    def _decode(self, vals, with_index=False, phase='decode'):
+        res = []
+        with self.stats.timer(phase):
+            nbytes = 0
             for val in vals:
+                if val['Value'] is not None:
+                    nbytes += len(val['Value'])
                 try:
                     v = val['Value'].decode('utf8') if val['Value'] is not None else None
                 except Exception as e:
                     v = val['Value']
-                res.append({'key': val['Key'], 'value': v})
-            return res
-        return vals
+                if with_index:
+                    res.append({'key': val['Key'], 'value': v, 'index': val['ModifyIndex']})
+                else:
+                    res.append({'key': val['Key'], 'value': v})
+        self.stats.incr('bytes_fetched', nbytes)
+        self.stats.incr('keys_decoded', len(res))
+        return res
 
-    def get(self, key, **kwargs):
+    def get(self, key, refresh=False, with_index=False, **kwargs):
         """
         Get key from cache, if not hit in the cache, then find in the consul.
 
         :param key:
+        :param refresh: skip cache lookup and always get from consul, cache will be updated
+        :param with_index: add ModifyIndex of each key as index
         :return:
         """
         if not key:
             key = ''
-        if self._cache_enabled:
-            vals = self.get_cache(key=key)
-            if vals:
+        if self._cache_enabled and not refresh:
+            vals = self._get_cached(key, with_index)
+            if vals is not None:
                 logging.info('Hit {} from cache'.format(key))
-                return vals
+                self.stats.incr('cache_hit')
+                return vals if with_index else self._strip_index(vals)
+            self.stats.incr('cache_miss')
+            if self.lease_ttl:
+                vals = self._get_single_flight(key, with_index, **kwargs)
+                return vals if with_index else self._strip_index(vals)
         logging.info('Do not hit cache for {} or cache disabled'.format(key))
-        vals = self.get_key(key=key, **kwargs)
-        self.set_cache(key=key, value=vals, expire=self.cache_ttl)
+        vals = self._fetch(key, **kwargs)
+        return vals if with_index else self._strip_index(vals)
+
+    def get_roots(self, roots, refresh=False, with_index=False):
+        """
+        Get key values under each of roots, overlapping roots are read once by the prefix covering them.
+
+        Prefixes are read concurrently, each through the cache like get. Key values of each root are sliced from
+        key values of its prefix, a key under overlapping roots is in the key values of each of them.
+
+        :param roots: list of roots
+        :param refresh: skip cache lookup and always get from consul
+        :param with_index: add ModifyIndex of each key as index
+        :return: list of (root, key values sorted by key) in order of roots
+        """
+        prefixes = normalize_roots(roots)
+
+        def get(prefix):
+            vals = self.get(prefix, refresh=refresh, with_index=with_index) or []
+            if any(vals[i]['key'] > vals[i + 1]['key'] for i in range(len(vals) - 1)):
+                vals = sorted(vals, key=lambda kv: kv['key'])
+            return vals
+
+        if len(prefixes) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(prefixes), ROOTS_MAX_WORKERS)) as executor:
+                fetched = list(executor.map(get, prefixes))
+        else:
+            fetched = [get(prefix) for prefix in prefixes]
+        self.stats.incr('root_reads', len(prefixes))
+        keys = [[kv['key'] for kv in vals] for vals in fetched]
+        res = []
+        for root in roots:
+            root = root or ''
+            # prefix covering root is the last prefix sorted before or equal to it
+            i = bisect.bisect_right(prefixes, root) - 1
+            start = end = bisect.bisect_left(keys[i], root)
+            while end < len(keys[i]) and keys[i][end].startswith(root):
+                end += 1
+            res.append((root, fetched[i][start:end]))
+        return res
+
+    def _get_cached(self, key, with_index=False):
+        """
+        Get key values from cache, stale key values are refreshed in background.
+
+        :return: key values with index or None if not cached
+        """
+        with self.stats.timer('cache'):
+            vals, fetched_at = self.get_cache(key=key, tag=True)
+        if not vals or (with_index and 'index' not in vals[0]):
+            return None
+        self.ages[key] = time.time() - fetched_at if fetched_at else None
+        if self._is_stale(fetched_at):
+            logging.info('Serve stale {} from cache, {:.0f}s old'.format(key, self.ages[key]))
+            self.stats.incr('cache_stale')
+            self.refresh_async(key)
+        return vals
+
+    def _fetch(self, key, **kwargs):
+        vals = self.get_key(key=key, with_index=True, **kwargs)
+        self.ages[key] = 0
+        self._save(key, vals)
         return vals
 
+    def _get_single_flight(self, key, with_index=False, **kwargs):
+        """
+        Get key values missed in cache, only the process holding the lease of key gets them from consul.
+
+        Other processes wait until key values are cached and read them from the cache. Lease expires after
+        lease_ttl if its holder died, processes still waiting by then get key values from consul.
+
+        :return: key values with index
+        """
+        deadline = time.time() + self.lease_ttl
+        delay = 0.05
+        while time.time() < deadline:
+            token = self._acquire_lease(key)
+            if token:
+                try:
+                    # cached by the previous lease holder after missed
+                    vals = self._get_cached(key, with_index)
+                    if vals is None:
+                        logging.info('Do not hit cache for {}, get it from consul'.format(key))
+                        vals = self._fetch(key, **kwargs)
+                    return vals
+                finally:
+                    self._release_lease(key, token)
+            with self.stats.timer('lease_wait'):
+                time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            vals = self._get_cached(key, with_index)
+            if vals is not None:
+                logging.info('Hit {} from cache after other process got it'.format(key))
+                self.stats.incr('lease_wait_hit')
+                return vals
+        logging.warning('Wait for {} got by other process timeout'.format(key))
+        return self._fetch(key, **kwargs)
+
+    def _acquire_lease(self, key):
+        """
+        Acquire lease of getting key from consul, shared by processes using the same cache.
+
+        :return: lease token or None if held by others
+        """
+        token = uuid.uuid4().hex
+        if self.cache.add(key=self._get_cache_key('lease:{}'.format(key)), value=token, expire=self.lease_ttl):
+            return token
+        return None
+
+    def _release_lease(self, key, token):
+        cache = self.cache
+        lease_key = self._get_cache_key('lease:{}'.format(key))
+        with cache.transact():
+            if cache.get(lease_key) == token:
+                cache.delete(lease_key)
+
+    def _save(self, key, vals, phase='cache'):
+        """
+        Cache key values got from consul now, the cache entry is kept for stale_grace after cache_ttl.
+
+        :param phase: timer phase of saving
+        """
+        now = time.time()
+        with self.stats.timer(phase):
+            self.set_cache(key=key, value=vals, expire=self.cache_ttl + self.stale_grace, tag=now)
+            if self._cache_enabled and self._mmap_enabled:
+                write_mmap_file(self._get_mmap_path(self._get_cache_key(key)), vals or [], now + self.cache_ttl)
+
+    def _is_stale(self, fetched_at):
+        return bool(self.stale_grace and fetched_at and time.time() - fetched_at > self.cache_ttl)
+
+    def refresh_async(self, key):
+        """
+        Refresh cached key values under key from consul in a background thread, if not refreshing already.
+
+        :param key:
+        :return: refresh thread
+        """
+        with self._refresh_lock:
+            thread = self._refreshing.get(key)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._refresh, args=(key,), name='refresh {}'.format(key),
+                                          daemon=True)
+                self._refreshing[key] = thread
+                thread.start()
+        return thread
+
+    def _refresh(self, key):
+        token = None
+        if self.lease_ttl:
+            token = self._acquire_lease(key)
+            if token is None:
+                logging.info('{} is being refreshed by other process'.format(key))
+                return
+        # requests session of the client is not shared with the calling thread
+        client = self._create_client()
+        try:
+            # background refresh is only timed as refresh, not as fetch, decode or cache of the command
+            with self.stats.timer('refresh'):
+                vals = self._get_tree(key, client)
+            vals = self._decode(vals, with_index=True, phase='refresh') if vals else vals
+            self._save(key, vals, phase='refresh')
+            self.stats.incr('cache_refresh')
+            logging.info('Refresh {} in background'.format(key))
+        except Exception as e:
+            logging.warning('Refresh {} in background failed: {}'.format(key, e))
+        finally:
+            if token:
+                self._release_lease(key, token)
+
+    def wait_refresh(self, timeout=None):
+        """
+        Wait for background refreshes to finish.
+
+        :param timeout: max seconds to wait, None to wait until finished
+        :return: true if all refreshes finished
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._refresh_lock:
+            threads = list(self._refreshing.values())
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - time.time(), 0))
+        return not any(thread.is_alive() for thread in threads)
+
+    def iter_key_values(self, key, with_index=False, **kwargs):
+        """
+        Iterate key values under key sorted by key.
+
+        All key values are read and sorted in memory, unlike SnapshotKvSearch it is not constant memory.
+
+        :param key:
+        :param with_index: add ModifyIndex of each key as index
+        :return: iterator of key values
+        """
+        return iter(sorted(self.get(key, with_index=with_index, **kwargs) or [], key=lambda kv: kv['key']))
+
     def put(self, key, value, **kwargs):
         """
         Put key value in consul and cache if enabled.
@@ -102,6 +517,96 @@ class ConsulKvSearch:
             self.del_cache(key=key)
         return res
 
+    def delete_many(self, keys, batch_size=TXN_MAX_OPS):
+        """
+        Delete keys in batched transactions, each transaction is applied atomically.
+
+        Cached key values of prefixes containing deleted keys are invalidated, even if a later batch failed.
+
+        :param keys: keys to delete
+        :param batch_size: operations per transaction, at most 64
+        :return: deleted keys
+        """
+        keys = list(keys)
+        batch_size = min(max(int(batch_size), 1), TXN_MAX_OPS)
+        deleted = []
+        try:
+            with self.stats.timer('delete'):
+                for start in range(0, len(keys), batch_size):
+                    batch = keys[start:start + batch_size]
+                    try:
+                        res = self._txn([{'KV': {'Verb': 'delete', 'Key': key}} for key in batch])
+                    except consul.ConsulException as e:
+                        raise ConsulException('Delete transaction failed: {}'.format(e))
+                    if isinstance(res, dict) and res.get('Errors'):
+                        raise ConsulException('Delete transaction failed: {}'.format(res['Errors']))
+                    self.stats.incr('txn_requests')
+                    deleted.extend(batch)
+        finally:
+            self.stats.incr('keys_deleted', len(deleted))
+            if deleted:
+                self.invalidate_cache(deleted)
+        return deleted
+
+    def _txn(self, payload):
+        """
+        Apply operations in one transaction.
+
+        Txn.put of python-consul does not send the ACL token, so it is sent as token param like KV requests.
+
+        :param payload: list of operations
+        :return: transaction results
+        """
+        params = [('token', self._token)] if self._token else []
+        return self._client.http.put(consul.base.CB.json(), '/v1/txn', params=params, data=json.dumps(payload))
+
+    def invalidate_cache(self, keys):
+        """
+        Delete cached key values of all prefixes that contain any of keys for this host.
+
+        :param keys: changed keys
+        :return: number of cache entries deleted
+        """
+        if not self._cache_enabled:
+            return 0
+        keys = sorted(keys)
+        host = '{}:{}:'.format(self._host, self._port)
+        removed = 0
+        with self.stats.timer('cache'):
+            cache = self.cache
+            for cache_key in list(cache.iterkeys()):
+                try:
+                    decoded = base64.b64decode(cache_key).decode('utf8')
+                except (ValueError, TypeError):
+                    continue
+                if not decoded.startswith(host):
+                    continue
+                # cache key is host:port:root:field, root and field may contain colons, so try every split
+                rest = decoded[len(host):]
+                fields = [rest[i + 1:] for i, c in enumerate(rest) if c == ':']
+                if any(self._is_prefix(keys, field) for field in fields):
+                    self._remove_mmap(cache_key)
+                    if cache.delete(cache_key):
+                        removed += 1
+        logging.info('Invalidate {} cache entries'.format(removed))
+        return removed
+
+    @staticmethod
+    def _is_prefix(sorted_keys, prefix):
+        i = bisect.bisect_left(sorted_keys, prefix)
+        return i < len(sorted_keys) and sorted_keys[i].startswith(prefix)
+
+    @staticmethod
+    def _strip_index(vals):
+        """
+        Remove ModifyIndex from key values in place, key values of each read are new objects unpickled from the
+        cache or decoded from consul or snapshot, so they are not copied.
+        """
+        if vals and 'index' in vals[0]:
+            for val in vals:
+                val.pop('index', None)
+        return vals
+
     def _get_cache_key(self, field) -> str:
         return base64.b64encode(':'.join([
             str(self._host),
@@ -0,0 +1,118 @@
+import time
+import random
+import logging
+import threading
+import consul
+from requests.exceptions import RequestException
+from .stats import Stats
+from .exceptions import ConsulException
+
+
+# read consistency modes of consul
+CONSISTENCY_MODES = ['default', 'consistent', 'stale']
+# 4xx errors of consul, raised without failover
+CLIENT_ERRORS = (consul.base.BadRequest, consul.base.ACLDisabled, consul.base.ACLPermissionDenied,
+                 consul.base.NotFound, consul.base.ClientError)
+
+
+def parse_server(address, port=8500, scheme='http'):
+    """
+    Parse server address like host, host:port or scheme://host:port.
+
+    :param address:
+    :param port: port if not in address
+    :param scheme: scheme if not in address
+    :return: tuple of (host, port, scheme)
+    """
+    address = str(address).strip()
+    if '://' in address:
+        scheme, address = address.split('://', 1)
+    address = address.rstrip('/')
+    host, sep, p = address.rpartition(':')
+    if not sep or not p.isdigit():
+        host, p = address, port
+    if not host:
+        raise ConsulException('Invalid consul server address {}'.format(address))
+    return host, int(p), scheme
+
+
+class ServerPool:
+    """
+    Consul servers or agents serving the same cluster, reads are spread across them and failed over.
+
+    Reads start from the next server in turn. A server failed with a connection or server error is marked down for
+    cooldown seconds and the read is retried on the next server. Down servers are only tried after all healthy ones
+    failed. Each thread has its own clients, as requests sessions are not shared between threads.
+    """
+
+    def __init__(self, servers, create_client, cooldown=30, stats=None):
+        """
+        :param servers: list of (host, port, scheme)
+        :param create_client: function of (host, port, scheme) to create consul client
+        :param cooldown: seconds a failed server is skipped
+        :param stats:
+        """
+        if not servers:
+            raise ConsulException('No consul servers')
+        self.servers = list(servers)
+        self.cooldown = cooldown
+        self.stats = stats or Stats()
+        self._create_client = create_client
+        self._down_until = [0] * len(self.servers)
+        self._next = random.randrange(len(self.servers))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __len__(self):
+        return len(self.servers)
+
+    def _client(self, i):
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        if i not in clients:
+            clients[i] = self._create_client(*self.servers[i])
+        return clients[i]
+
+    def _order(self):
+        """
+        Servers to try in turn, healthy ones first.
+        """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.servers)
+        now = time.time()
+        order = [(start + i) % len(self.servers) for i in range(len(self.servers))]
+        return [i for i in order if self._down_until[i] <= now] + [i for i in order if self._down_until[i] > now]
+
+    def is_healthy(self, i):
+        return self._down_until[i] <= time.time()
+
+    def mark_down(self, i):
+        self._down_until[i] = time.time() + self.cooldown
+
+    def call(self, func):
+        """
+        Call func with a consul client, failover to next server if failed.
+
+        :param func: function of consul client
+        :return: result of func
+        """
+        errors = []
+        for i in self._order():
+            try:
+                res = func(self._client(i))
+            except CLIENT_ERRORS:
+                # request or token is rejected by every server, only connection and server errors are failed over
+                raise
+            except (RequestException, consul.ConsulException) as e:
+                host, port, scheme = self.servers[i]
+                logging.warning('Consul server {}://{}:{} failed: {}'.format(scheme, host, port, e))
+                self.mark_down(i)
+                self.stats.incr('server_failover')
+                errors.append(e)
+                continue
+            self._down_until[i] = 0
+            self.stats.incr('server_reads')
+            return res
+        raise ConsulException('All {} consul servers failed, last error: {}'.format(len(self.servers), errors[-1]))
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import zlib
+import base64
+import struct
+import bisect
+import logging
+from .search import ConsulKvSearch
+from .stats import Stats
+from .exceptions import ConsulException
+
+
+SNAPSHOT_MAGIC = b'CUSNAP01'
+# index offset, index length, magic
+SNAPSHOT_FOOTER = struct.Struct('>QI8s')
+
+
+def encode_record(kv):
+    """
+    Encode key value to compact json line [key, value, ModifyIndex], undecodable value is encoded by base64.
+    """
+    value = kv['value']
+    if isinstance(value, bytes):
+        value = {'b64': base64.b64encode(value).decode('ascii')}
+    return json.dumps([kv['key'], value, kv.get('index')], ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_record(line):
+    key, value, index = json.loads(line)
+    if isinstance(value, dict):
+        value = base64.b64decode(value['b64'])
+    return {'key': key, 'value': value, 'index': index}
+
+
+class SnapshotWriter:
+    """
+    Write key values sorted by key to snapshot file.
+
+    Snapshot file is a sequence of zlib compressed blocks of json lines, followed by a compressed json index with
+    the first key, last key, offset and size of each block, and a fixed size footer pointing to the index. Key
+    values under a prefix are read by seeking to the blocks whose key range overlaps the prefix.
+    File is written to a temporary file and renamed when closed, so an interrupted save never leaves a broken
+    snapshot.
+    """
+
+    def __init__(self, filepath, root='', source='', block_size=1000, compress_level=6):
+        self._filepath = filepath
+        self._tmp_filepath = '{}.tmp'.format(filepath)
+        self._root = root or ''
+        self._source = source
+        self._block_size = max(int(block_size), 1)
+        self._compress_level = int(compress_level)
+        self._fp = None
+        self._block = []
+        self._blocks = []
+        self._last_key = None
+        self.count = 0
+
+    def open(self):
+        self._fp = open(self._tmp_filepath, 'wb')
+        self._fp.write(SNAPSHOT_MAGIC)
+        return self
+
+    def write(self, kv):
+        """
+        Write one key value, keys must be written in sorted order.
+
+        :param kv: dict of key, value and index
+        """
+        key = kv['key']
+        if self._last_key is not None and key <= self._last_key:
+            raise ConsulException('Snapshot keys must be sorted and unique, {} after {}'.format(key, self._last_key))
+        self._last_key = key
+        self._block.append((key, encode_record(kv)))
+        self.count += 1
+        if len(self._block) >= self._block_size:
+            self._write_block()
+
+    def write_many(self, vals):
+        for kv in vals:
+            self.write(kv)
+
+    def _write_block(self):
+        if not self._block:
+            return
+        data = zlib.compress('\n'.join(line for _, line in self._block).encode('utf8'), self._compress_level)
+        self._blocks.append([self._block[0][0], self._block[-1][0], self._fp.tell(), len(data), len(self._block)])
+        self._fp.write(data)
+        self._block = []
+
+    def close(self):
+        """
+        Write index and footer, then move snapshot file to its place.
+        """
+        if self._fp is None:
+            return
+        self._write_block()
+        index = {
+            'version': 1,
+            'root': self._root,
+            'source': self._source,
+            'created': int(time.time()),
+            'count': self.count,
+            'blocks': self._blocks,
+        }
+        data = zlib.compress(json.dumps(index, ensure_ascii=False).encode('utf8'), self._compress_level)
+        offset = self._fp.tell()
+        self._fp.write(data)
+        self._fp.write(SNAPSHOT_FOOTER.pack(offset, len(data), SNAPSHOT_MAGIC))
+        self._fp.close()
+        self._fp = None
+        os.replace(self._tmp_filepath, self._filepath)
+
+    def abort(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if os.path.exists(self._tmp_filepath):
+            os.remove(self._tmp_filepath)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class SnapshotReader:
+    """
+    Read key values from snapshot file written by SnapshotWriter.
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self.meta = self._read_index()
+        self._blocks = self.meta['blocks']
+        self._last_keys = [b[1] for b in self._blocks]
+
+    def _read_index(self):
+        if not os.path.exists(self._filepath):
+            raise ConsulException('Snapshot file {} not exists'.format(self._filepath))
+        with open(self._filepath, 'rb') as fp:
+            size = fp.seek(0, os.SEEK_END)
+            if size < len(SNAPSHOT_MAGIC) + SNAPSHOT_FOOTER.size:
+                raise ConsulException('Invalid snapshot file {}'.format(self._filepath))
+            fp.seek(0)
+            head = fp.read(len(SNAPSHOT_MAGIC))
+            fp.seek(-SNAPSHOT_FOOTER.size, os.SEEK_END)
+            offset, length, magic = SNAPSHOT_FOOTER.unpack(fp.read(SNAPSHOT_FOOTER.size))
+            if head != SNAPSHOT_MAGIC or magic != SNAPSHOT_MAGIC:
+                raise ConsulException('Invalid snapshot file {}'.format(self._filepath))
+            fp.seek(offset)
+            return json.loads(zlib.decompress(fp.read(length)).decode('utf8'))
+
+    def iter(self, prefix=''):
+        """
+        Iterate key values under prefix in key order, only blocks overlapping prefix are read.
+
+        :param prefix: key prefix
+        :return: generator of dict of key, value and index
+        """
+        prefix = prefix or ''
+        # first block which may contain keys >= prefix
+        start = bisect.bisect_left(self._last_keys, prefix)
+        with open(self._filepath, 'rb') as fp:
+            for first_key, last_key, offset, length, count in self._blocks[start:]:
+                if first_key > prefix and not first_key.startswith(prefix):
+                    return
+                fp.seek(offset)
+                for line in zlib.decompress(fp.read(length)).decode('utf8').split('\n'):
+                    kv = decode_record(line)
+                    if kv['key'].startswith(prefix):
+                        yield kv
+                    elif kv['key'] > prefix:
+                        return
+
+    def get(self, prefix=''):
+        """
+        Get key values under prefix.
+
+        :return: list of key values or None if no keys, like consul kv get
+        """
+        return list(self.iter(prefix)) or None
+
+
+class SnapshotKvSearch(ConsulKvSearch):
+    """
+    Read key values from snapshot file in place of consul.
+
+    Snapshot is read only and already local, key values are not cached, memoized data like parsed values is still
+    kept in the cache for this snapshot file.
+    """
+
+    def __init__(self, snapshot, root='', cache_enabled=True, cache_dir='.consul_cache', cache_ttl=600,
+                 memo_ttl=604800, stats=None, **kwargs):
+        super().__init__(host=os.path.abspath(snapshot), port='snapshot', scheme=None, token=None, root=root,
+                         cache_enabled=cache_enabled, cache_dir=cache_dir, cache_ttl=cache_ttl, memo_ttl=memo_ttl,
+                         stats=stats or Stats())
+        self._reader = SnapshotReader(snapshot)
+
+    @property
+    def reader(self):
+        return self._reader
+
+    def get_key(self, key, recurse=True, raw=False, keys=False, with_index=False, **kwargs):
+        with self.stats.timer('snapshot'):
+            if recurse:
+                vals = self._reader.get(key)
+            else:
+                vals = [kv for kv in self._reader.iter(key) if kv['key'] == key] or None
+        if vals is None:
+            return None
+        self.stats.incr('keys_decoded', len(vals))
+        if keys:
+            return [kv['key'] for kv in vals]
+        return vals if with_index else self._strip_index(vals)
+
+    def get(self, key, refresh=False, with_index=False, **kwargs):
+        logging.info('Read {} from snapshot {}'.format(key, self._host))
+        # key values are as old as the snapshot
+        self.ages[key or ''] = time.time() - self._reader.meta.get('created', time.time())
+        return self.get_key(key=key or '', with_index=with_index, **kwargs)
+
+    def iter_key_values(self, key, with_index=False, **kwargs):
+        self.ages[key or ''] = time.time() - self._reader.meta.get('created', time.time())
+        # snapshot is sorted, key values are read block by block
+        for kv in self._reader.iter(key or ''):
+            yield kv if with_index else {'key': kv['key'], 'value': kv['value']}
+
+    def get_mmap(self, key):
+        # snapshot is already a local file
+        return None
+
+    def watch_key(self, key, index=None, wait=None):
+        raise ConsulException('Snapshot {} can not be watched'.format(self._host))
+
+    def put(self, key, value, **kwargs):
+        raise ConsulException('Snapshot {} is read only'.format(self._host))
+
+    def delete(self, key, recurse=None, **kwargs):
+        raise ConsulException('Snapshot {} is read only'.format(self._host))
+
+    def delete_many(self, keys, batch_size=64):
+        raise ConsulException('Snapshot {} is read only'.format(self._host))
@@ -0,0 +1,166 @@
+import sys
+import pickle
+import tempfile
+from .stats import Stats
+
+
+# size suffixes of memory budget, e.g. 512M
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# records pickled together, a spilled list is read back one chunk at a time
+SPILL_CHUNK_SIZE = 1000
+
+
+def parse_size(size):
+    """
+    Parse size in bytes like 536870912, 512M or 1.5G.
+
+    :return: bytes
+    :raise ValueError: if size is invalid
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = str(size).strip().upper().rstrip('B')
+    unit = 1
+    if text and text[-1] in SIZE_UNITS:
+        unit = SIZE_UNITS[text[-1]]
+        text = text[:-1]
+    try:
+        return int(float(text) * unit)
+    except ValueError:
+        raise ValueError('Invalid size {}, must be bytes or a number with K, M or G'.format(size))
+
+
+def record_size(record):
+    """
+    Estimated memory of a key value or a pair of key values, with key and value strings.
+    """
+    if isinstance(record, dict):
+        return sys.getsizeof(record) + sum(sys.getsizeof(v) for v in record.values())
+    if isinstance(record, tuple):
+        return sys.getsizeof(record) + sum(record_size(r) for r in record)
+    return sys.getsizeof(record)
+
+
+class MemoryBudget:
+    """
+    Memory budget shared by result lists of a command.
+
+    When records held by all lists exceed the budget, the largest lists spill their records to temporary files until
+    half of the budget is used, so spilling is not repeated for each appended record.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, stats=None):
+        """
+        :param max_bytes: max bytes of records held in memory
+        :param spill_dir: directory of temporary files, system temp directory if not set
+        :param stats:
+        """
+        if max_bytes <= 0:
+            raise ValueError('Invalid memory budget {}, must be positive'.format(max_bytes))
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir or None
+        self.stats = stats or Stats()
+        self.used = 0
+        self.lists = []
+
+    def new_list(self):
+        lst = SpillList(self)
+        self.lists.append(lst)
+        return lst
+
+    def add(self, size):
+        self.used += size
+        if self.used > self.max_bytes:
+            self.spill()
+
+    def spill(self):
+        for lst in sorted(self.lists, key=lambda lst: -lst.buffered_size):
+            if self.used <= self.max_bytes // 2:
+                break
+            lst.spill()
+
+    def close(self):
+        """
+        Close all lists and remove their temporary files.
+        """
+        for lst in self.lists:
+            lst.close()
+        self.lists = []
+        self.used = 0
+
+
+class SpillList:
+    """
+    Append only list of records spilled to a temporary file when memory budget is exceeded.
+
+    Records are iterated in the order appended, spilled records are read back from file one chunk at a time, so
+    results larger than memory are streamed to the reporter. The list may be iterated more than once.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._buffer = []
+        self.buffered_size = 0
+        self._count = 0
+        self._fp = None
+        # (offset, length) of pickled chunks in file
+        self._chunks = []
+
+    def __len__(self):
+        return self._count
+
+    def append(self, record):
+        self._buffer.append(record)
+        self._count += 1
+        size = record_size(record)
+        self.buffered_size += size
+        self.budget.add(size)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    @property
+    def spilled(self) -> bool:
+        return bool(self._chunks)
+
+    def spill(self):
+        """
+        Write records in memory to the temporary file.
+        """
+        if not self._buffer:
+            return
+        if self._fp is None:
+            self._fp = tempfile.TemporaryFile(prefix='consul_utils_spill_', dir=self.budget.spill_dir)
+        self._fp.seek(0, 2)
+        offset = self._fp.tell()
+        written = 0
+        for start in range(0, len(self._buffer), SPILL_CHUNK_SIZE):
+            data = pickle.dumps(self._buffer[start:start + SPILL_CHUNK_SIZE], protocol=pickle.HIGHEST_PROTOCOL)
+            self._fp.write(data)
+            self._chunks.append((offset + written, len(data)))
+            written += len(data)
+        self.budget.stats.incr('records_spilled', len(self._buffer))
+        self.budget.stats.incr('spill_bytes', written)
+        self.budget.used -= self.buffered_size
+        self._buffer = []
+        self.buffered_size = 0
+
+    def __iter__(self):
+        for offset, length in list(self._chunks):
+            # seek before each read, the file may be read by other iterators in between
+            self._fp.seek(offset)
+            for record in pickle.loads(self._fp.read(length)):
+                yield record
+        for record in list(self._buffer):
+            yield record
+
+    def close(self):
+        self.budget.used -= self.buffered_size
+        self.buffered_size = 0
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._buffer = []
+        self._chunks = []
+        self._count = 0
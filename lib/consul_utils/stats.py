@@ -0,0 +1,80 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Stats:
+    """
+    Phase timers and counters collected during command run.
+
+    Timers and counters are updated under a lock, they are shared by background refresh and reader threads.
+    """
+
+    def __init__(self, command=''):
+        self.command = command
+        self.timers = OrderedDict()
+        self.counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        Time a phase, elapsed seconds are added if the same phase is timed more than once.
+
+        :param phase: phase name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timers[phase] = self.timers.get(phase, 0) + elapsed
+
+    def incr(self, name, value=1):
+        """
+        Increase counter.
+
+        :param name: counter name
+        :param value:
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name, default=0):
+        return self.counters.get(name, default)
+
+    def to_dict(self):
+        return {
+            'command': self.command,
+            'timers': {k: round(v, 6) for k, v in self.timers.items()},
+            'counters': dict(self.counters),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4)
+
+    def to_prometheus(self, prefix='consul_utils'):
+        """
+        Format stats in prometheus text exposition format.
+        """
+        lines = []
+        label = '{{command="{}"'.format(self.command)
+        if self.timers:
+            lines.append('# TYPE {}_phase_seconds gauge'.format(prefix))
+            for phase, seconds in self.timers.items():
+                lines.append('{}_phase_seconds{},phase="{}"}} {:.6f}'.format(prefix, label, phase, seconds))
+        for name, value in self.counters.items():
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total{}}} {}'.format(prefix, name, label, value))
+        return '\n'.join(lines)
+
+    def format(self, fmt='json'):
+        """
+        Format stats by json or prometheus.
+        """
+        if fmt == 'prometheus':
+            return self.to_prometheus()
+        return self.to_json()
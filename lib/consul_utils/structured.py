@@ -0,0 +1,209 @@
+import re
+import json
+import hashlib
+import yaml
+
+
+PATH_TOKEN = re.compile(r'\[(\*|-?\d+)\]|\.?([^.\[\]]+)')
+EXPRESSION = re.compile(r'^\s*(?P<path>[^=!<>~\s]*)\s*(?:(?P<op>==|!=|>=|<=|=~|>|<)\s*(?P<value>.*?))?\s*$')
+
+
+def parse_value(value):
+    """
+    Parse json or yaml value.
+
+    :param value: value string
+    :return: tuple of (parsed or not, parsed value)
+    """
+    if value is None:
+        return False, None
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf8')
+        except UnicodeDecodeError:
+            return False, None
+    try:
+        return True, json.loads(value)
+    except ValueError:
+        pass
+    try:
+        return True, yaml.safe_load(value)
+    except yaml.YAMLError:
+        return False, None
+
+
+def parse_literal(text):
+    """
+    Parse literal in expression, json literal or bare string.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        if len(text) >= 2 and text[0] == text[-1] and text[0] in '\'"':
+            return text[1:-1]
+        return text
+
+
+def parse_path(path):
+    """
+    Parse path like $.servers[0].port, servers.*.port or servers[*].port to tokens.
+
+    :return: list of tokens, str for dict key, int for list index, '*' for all items
+    """
+    path = path.strip()
+    if path.startswith('$'):
+        path = path[1:]
+    tokens = []
+    pos = 0
+    while pos < len(path):
+        m = PATH_TOKEN.match(path, pos)
+        if not m or m.end() == pos:
+            raise ValueError('Invalid path {}'.format(path))
+        if m.group(1) is not None:
+            tokens.append('*' if m.group(1) == '*' else int(m.group(1)))
+        else:
+            tokens.append(m.group(2))
+        pos = m.end()
+    return tokens
+
+
+def resolve(obj, tokens):
+    """
+    Yield all values in obj matched by path tokens.
+    """
+    if not tokens:
+        yield obj
+        return
+    token, rest = tokens[0], tokens[1:]
+    if token == '*':
+        if isinstance(obj, dict):
+            items = obj.values()
+        elif isinstance(obj, list):
+            items = obj
+        else:
+            return
+        for item in items:
+            yield from resolve(item, rest)
+    elif isinstance(obj, dict):
+        if token in obj:
+            yield from resolve(obj[token], rest)
+    elif isinstance(obj, list):
+        if isinstance(token, str) and token.lstrip('-').isdigit():
+            token = int(token)
+        if isinstance(token, int) and -len(obj) <= token < len(obj):
+            yield from resolve(obj[token], rest)
+
+
+class StructuredQuery:
+    """
+    Path and predicate query over parsed json or yaml values.
+
+    Query is a path optionally followed by an operator (==, !=, >, >=, <, <=, =~) and a json literal, e.g.
+    ``timeout_ms > 5000``, ``servers[*].host =~ ^db`` or ``features.beta``. Query without operator matches
+    if the path exists. Query matches if any value resolved by the path matches.
+    """
+
+    def __init__(self, expression):
+        m = EXPRESSION.match(expression)
+        if not m:
+            raise ValueError('Invalid structured query {}'.format(expression))
+        self.expression = expression
+        self.tokens = parse_path(m.group('path'))
+        self.op = m.group('op')
+        self.value = None
+        if self.op == '=~':
+            self.value = re.compile(m.group('value'))
+        elif self.op:
+            self.value = parse_literal(m.group('value'))
+
+    def match(self, obj) -> bool:
+        for v in resolve(obj, self.tokens):
+            if self.op is None or self.compare(v):
+                return True
+        return False
+
+    def compare(self, v) -> bool:
+        op = self.op
+        if op == '=~':
+            return v is not None and self.value.search(v if isinstance(v, str) else json.dumps(v)) is not None
+        left, right = self._coerce(v, self.value)
+        if op == '==':
+            return left == right
+        if op == '!=':
+            return left != right
+        try:
+            if op == '>':
+                return left > right
+            if op == '>=':
+                return left >= right
+            if op == '<':
+                return left < right
+            if op == '<=':
+                return left <= right
+        except TypeError:
+            return False
+        return False
+
+    @staticmethod
+    def _coerce(left, right):
+        """
+        Compare numbers stored as strings with number literals.
+        """
+        if isinstance(right, (int, float)) and not isinstance(right, bool) and isinstance(left, str):
+            try:
+                return float(left), right
+            except ValueError:
+                return left, right
+        return left, right
+
+    def __repr__(self):
+        return self.expression
+
+
+def canonical(obj):
+    """
+    Canonical json string of parsed value, keys are sorted.
+    """
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+def value_hash(value):
+    """
+    Hash of raw value.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return hashlib.sha1(value).hexdigest()
+
+
+def diff_objects(obj1, obj2, path='$'):
+    """
+    Field level changes between two parsed values.
+
+    :return: list of (path, op, old value, new value), op is added, removed or changed
+    """
+    changes = []
+    if isinstance(obj1, dict) and isinstance(obj2, dict):
+        for k in obj1:
+            sub = '{}.{}'.format(path, k)
+            if k not in obj2:
+                changes.append((sub, 'removed', obj1[k], None))
+            else:
+                changes.extend(diff_objects(obj1[k], obj2[k], sub))
+        for k in obj2:
+            if k not in obj1:
+                changes.append(('{}.{}'.format(path, k), 'added', None, obj2[k]))
+    elif isinstance(obj1, list) and isinstance(obj2, list):
+        for i in range(max(len(obj1), len(obj2))):
+            sub = '{}[{}]'.format(path, i)
+            if i >= len(obj2):
+                changes.append((sub, 'removed', obj1[i], None))
+            elif i >= len(obj1):
+                changes.append((sub, 'added', None, obj2[i]))
+            else:
+                changes.extend(diff_objects(obj1[i], obj2[i], sub))
+    elif obj1 != obj2 or type(obj1) != type(obj2):
+        changes.append((path, 'changed', obj1, obj2))
+    return changes
@@ -0,0 +1,115 @@
+import heapq
+
+
+def value_size(value):
+    """
+    Size of value in bytes.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode('utf8'))
+    return len(value)
+
+
+class PrefixSummary:
+    """
+    Key count, value bytes and largest keys under one prefix.
+    """
+
+    def __init__(self, prefix, depth, top=3, sizes=True):
+        self.prefix = prefix
+        self.depth = depth
+        self.sizes = sizes
+        self.keys = 0
+        self.bytes = 0
+        self._top = top if sizes else 0
+        self._largest = []
+
+    def add(self, key, size):
+        self.keys += 1
+        self.bytes += size
+        if self._top <= 0:
+            return
+        # min heap of the top largest keys
+        if len(self._largest) < self._top:
+            heapq.heappush(self._largest, (size, key))
+        elif size > self._largest[0][0]:
+            heapq.heapreplace(self._largest, (size, key))
+
+    @property
+    def largest(self):
+        """
+        Largest keys, list of (size, key) sorted by size descending.
+        """
+        return sorted(self._largest, key=lambda x: (-x[0], x[1]))
+
+    def to_dict(self):
+        largest = self.largest
+        if not self.sizes:
+            return {'key': self.prefix, 'value': 'keys: {}'.format(self.keys), 'depth': self.depth, 'keys': self.keys}
+        value = 'keys: {}, bytes: {}'.format(self.keys, self.bytes)
+        if largest:
+            value += ', largest: {}'.format(', '.join('{} ({})'.format(k, s) for s, k in largest))
+        return {
+            'key': self.prefix,
+            'value': value,
+            'depth': self.depth,
+            'keys': self.keys,
+            'bytes': self.bytes,
+            'largest': [{'key': k, 'bytes': s} for s, k in largest],
+        }
+
+
+class KeyTree:
+    """
+    Aggregate key count, value bytes and largest keys per prefix up to depth, in one pass over keys.
+
+    Prefixes are split by '/' relative to root, root is depth 0, its direct sub directories are depth 1.
+    If sizes is not set, only keys are counted.
+    """
+
+    def __init__(self, root='', depth=2, top=3, sizes=True):
+        self.root = root or ''
+        self.depth = int(depth)
+        self.top = int(top)
+        self.sizes = sizes
+        self.nodes = {self.root: PrefixSummary(self.root, 0, self.top, self.sizes)}
+
+    @property
+    def count(self):
+        return self.nodes[self.root].keys
+
+    def add(self, key, size=0):
+        """
+        Add one key to the root and every prefix of key up to depth.
+
+        :param key: full key under root
+        :param size: value size in bytes
+        """
+        self.nodes[self.root].add(key, size)
+        rel = key[len(self.root):]
+        pos = rel.find('/')
+        level = 1
+        while pos >= 0 and level <= self.depth:
+            prefix = self.root + rel[:pos + 1]
+            node = self.nodes.get(prefix)
+            if node is None:
+                node = self.nodes[prefix] = PrefixSummary(prefix, level, self.top, self.sizes)
+            node.add(key, size)
+            pos = rel.find('/', pos + 1)
+            level += 1
+
+    def summaries(self, sort='prefix'):
+        """
+        Get prefix summaries.
+
+        :param sort: prefix, keys or bytes, keys and bytes are sorted descending
+        :return: list of PrefixSummary
+        """
+        nodes = sorted(self.nodes.values(), key=lambda n: n.prefix)
+        if sort == 'keys':
+            nodes.sort(key=lambda n: -n.keys)
+        elif sort == 'bytes':
+            nodes.sort(key=lambda n: -n.bytes)
+        return nodes
@@ -6,9 +6,16 @@ sys.path.insert(0, os.path.abspath('lib'))
 import pytest
 import random
 from hsettings import Settings
+from concurrent.futures import ProcessPoolExecutor
+from consul_utils import commands
 from consul_utils.search import ConsulKvSearch
-from consul_utils.commands import CopyCommand
-from consul_utils.reporter import OUT_FILTERED_KEY, OUT_FLAG_KEY
+from consul_utils.commands import CopyCommand, SearchCommand, DiffCommand, DeleteCommand, ExportChangesCommand, \
+    join_key_values, merge_key_values, key_changes, filter_chunk
+from consul_utils.checkpoint import CopyCheckpoint
+from consul_utils.snapshot import SnapshotWriter, SnapshotKvSearch
+from consul_utils.exceptions import ConsulException
+from consul_utils.reporter import OUT_FILTERED_KEY, OUT_NON_FILTERED_KEY, OUT_FLAG_KEY
+from consul_utils.filters import SearchFilter
 
 
 class TestCommand:
@@ -85,3 +92,218 @@ class TestCommand:
         # delete keys
         consul.delete(key=copy_source, recurse=True)
         consul.delete(key=copy_target, recurse=True)
+
+    def test_copy_delta(self, settings):
+        copy_source = 'test_copy_source_{}/source/'.format(random.randint(100, 999))
+        copy_target = 'test_copy_target_{}/target/'.format(random.randint(100, 999))
+        consul = ConsulKvSearch(**dict(settings.get('consul')))
+        for key, val in {'a1': 'a', 'b1': 'b', 'c1': 'c'}.items():
+            consul.put(key=copy_source + key, value=val)
+        for key, val in {'a1': 'a', 'b1': 'bb', 'e1': 'e'}.items():
+            consul.put(key=copy_target + key, value=val)
+        settings.set('copy.delta', True)
+        settings.set('copy.delete_extra', True)
+        args = {
+            'root': copy_source,
+            'target_root': copy_target,
+            'clear_cache': True
+        }
+        cmd = CopyCommand(settings=settings, args=args)
+        res = cmd.run()
+        settings.set('copy.delta', False)
+        settings.set('copy.delete_extra', False)
+        assert sorted([d['key'] for d in res[OUT_FLAG_KEY][CopyCommand.COPY_FLAG]]) == [copy_target + 'b1', copy_target + 'c1']
+        assert [d['key'] for d in res[OUT_FLAG_KEY][CopyCommand.SKIP_FLAG]] == [copy_target + 'a1']
+        assert [d['key'] for d in res[OUT_FLAG_KEY][CopyCommand.DELETE_FLAG]] == [copy_target + 'e1']
+        assert consul.get_key(key=copy_target + 'b1') == [{'key': copy_target + 'b1', 'value': 'b'}]
+        assert consul.get_key(key=copy_target + 'e1') is None
+        consul.delete(key=copy_source, recurse=True)
+        consul.delete(key=copy_target, recurse=True)
+
+    def test_delete(self, settings, tmpdir):
+        root = 'test_delete_{}/'.format(random.randint(100, 999))
+        consul = ConsulKvSearch(**dict(settings.get('consul')))
+        for i in range(100):
+            consul.put(key='{}stale/k{:03d}'.format(root, i), value='old')
+        consul.put(key=root + 'live/a', value='new')
+        consul.put(key=root + 'live/b', value='new')
+        assert len(consul.get(root)) == 102
+        # search limit does not apply, all keys found are deleted unless limit is given
+        settings.set('search', {'query': '/stale/', 'fields': 'keys', 'limit': 10, 'regex': False})
+        settings.set('delete.dry_run', True)
+        res = DeleteCommand(settings=settings, args={'root': root, 'limit': 5}).run()
+        assert len(res[OUT_FLAG_KEY][DeleteCommand.DRY_RUN_FLAG]) == 5
+        settings.set('delete.limit', 0)
+        res = DeleteCommand(settings=settings, args={'root': root}).run()
+        assert len(res[OUT_FLAG_KEY][DeleteCommand.DRY_RUN_FLAG]) == 100
+        assert len(consul.get_key(root)) == 102
+        settings.set('delete.dry_run', False)
+        settings.set('search.limit', 10)
+        res = DeleteCommand(settings=settings, args={'root': root}).run()
+        assert len(res[OUT_FLAG_KEY][DeleteCommand.DELETE_FLAG]) == 100
+        # cached key values under root are invalidated
+        assert [d['key'] for d in consul.get(root)] == [root + 'live/a', root + 'live/b']
+        keys_file = str(tmpdir.join('keys.txt'))
+        with open(keys_file, 'w') as fp:
+            fp.write('{}live/a\nother/a\n'.format(root))
+        settings.set('delete.keys_file', keys_file)
+        res = DeleteCommand(settings=settings, args={'root': root}).run()
+        settings.set('delete.keys_file', '')
+        settings.set('search', {})
+        assert [d['key'] for d in res[OUT_FLAG_KEY][DeleteCommand.DELETE_FLAG]] == [root + 'live/a']
+        assert [d['key'] for d in consul.get(root)] == [root + 'live/b']
+        # acl token is sent on each transaction
+        client = ConsulKvSearch(**dict(settings.get('consul'), token='delete-token'))
+        txn_params = []
+        put = client._client.http.put
+
+        def token_put(callback, path, params=None, data=''):
+            txn_params.append((path, params))
+            return put(callback, path, params=params, data=data)
+
+        client._client.http.put = token_put
+        assert client.delete_many([root + 'live/b'], batch_size=1) == [root + 'live/b']
+        assert txn_params == [('/v1/txn', [('token', 'delete-token')])]
+        consul.delete(key=root, recurse=True)
+
+    def test_export_changes(self, settings):
+        state = {'r/a': 1, 'r/b': 2, 'r/c': 3}
+        vals = [{'key': 'r/a', 'value': '1', 'index': 1}, {'key': 'r/b', 'value': 'x', 'index': 5},
+                {'key': 'r/d', 'value': b'\xff', 'index': 4}]
+        events, new_state = key_changes(state, vals, 6)
+        assert events == [
+            {'op': 'created', 'key': 'r/d', 'index': 4, 'value': '\\xff'},
+            {'op': 'updated', 'key': 'r/b', 'index': 5, 'value': 'x'},
+            {'op': 'deleted', 'key': 'r/c', 'index': 6},
+        ]
+        assert new_state == {'r/a': 1, 'r/b': 5, 'r/d': 4}
+        root = 'test_export_{}/'.format(random.randint(100, 999))
+        consul = ConsulKvSearch(**dict(settings.get('consul')))
+        consul.put(key=root + 'a', value='1')
+        consul.put(key=root + 'b', value='2')
+        settings.set('export.once', True)
+        # no saved state, start from current key values
+        assert ExportChangesCommand(settings=settings, args={'root': root}).run()[OUT_FILTERED_KEY] == []
+        consul.put(key=root + 'a', value='11')
+        consul.put(key=root + 'c', value='3')
+        consul.delete(key=root + 'b')
+        events = ExportChangesCommand(settings=settings, args={'root': root}).run()[OUT_FILTERED_KEY]
+        settings.set('export.once', False)
+        assert [(e['op'], e['key'], e.get('value')) for e in events] == [
+            ('updated', root + 'a', '11'), ('created', root + 'c', '3'), ('deleted', root + 'b', None)]
+        consul.delete(key=root, recurse=True)
+
+    def test_single_root_mmap(self, settings):
+        root = 'test_roots_{}/'.format(random.randint(100, 999))
+        consul_conf = dict(settings.get('consul'))
+        consul = ConsulKvSearch(**consul_conf)
+        consul.put(key=root + 'a/k1', value='needle')
+        consul.put(key=root + 'b/k2', value='needle')
+        settings.set('cache.mmap', True)
+        settings.set('search', {'query': 'needle', 'fields': 'values', 'limit': 10})
+        try:
+            # all key values are in a memory mapped file too, one root in roots never searches them
+            SearchCommand(settings=settings, args={}).run()
+            for _ in range(2):
+                cmd = SearchCommand(settings=settings, args={'roots': root + 'a/'})
+                res = cmd.run()
+                assert [d['key'] for d in res[OUT_FILTERED_KEY]] == [root + 'a/k1']
+            assert cmd.stats.get('mmap_hit') == 1
+            settings.set('delete.dry_run', True)
+            res = DeleteCommand(settings=settings, args={'roots': root + 'a/'}).run()
+            assert [d['key'] for d in res[OUT_FLAG_KEY][DeleteCommand.DRY_RUN_FLAG]] == [root + 'a/k1']
+        finally:
+            settings.set('cache.mmap', False)
+            settings.set('search', {})
+            settings.set('delete.dry_run', False)
+            settings.set('consul', consul_conf)
+        consul.delete(key=root, recurse=True)
+
+    def test_join_key_values(self):
+        vals1 = [{'key': 'r1/a', 'value': '1'}, {'key': 'r1/b', 'value': '2'}, {'key': 'r1/c', 'value': '3'}]
+        vals2 = [{'key': 'r2/b', 'value': '2'}, {'key': 'r2/c', 'value': '4'}, {'key': 'r2/d', 'value': '5'}]
+        only1, only2, both = join_key_values(vals1, 'r1/', vals2, 'r2/')
+        assert only1 == [vals1[0]]
+        assert only2 == [vals2[2]]
+        assert both == [(vals1[1], vals2[0]), (vals1[2], vals2[1])]
+
+    def test_merge_key_values(self, tmpdir):
+        vals1 = [{'key': 'r1/a', 'value': '1'}, {'key': 'r1/b', 'value': '2'}, {'key': 'r1/c', 'value': '3'}]
+        vals2 = [{'key': 'r2/b', 'value': '2'}, {'key': 'r2/c', 'value': '4'}, {'key': 'r2/d', 'value': '5'}]
+        assert list(merge_key_values(iter(vals1), 'r1/', iter(vals2), 'r2/')) == [
+            (vals1[0], None), (vals1[1], vals2[0]), (vals1[2], vals2[1]), (None, vals2[2])]
+        assert list(merge_key_values([], 'r1/', vals2[:1], 'r2/')) == [(None, vals2[0])]
+        for vals, root in [(vals1, 'r1/'), (vals2, 'r2/')]:
+            with SnapshotWriter(str(tmpdir.join(root[:2] + '.snap')), root=root) as writer:
+                writer.write_many(vals)
+        args = {
+            'snapshot1': str(tmpdir.join('r1.snap')),
+            'snapshot2': str(tmpdir.join('r2.snap')),
+            'root1': 'r1/',
+            'root2': 'r2/',
+            'stream': True,
+        }
+        settings = Settings({'log': {'log_level': 'ERROR', 'log_formatter': '%(message)s'}, 'cache': {'cache_enabled': False},
+                             'reporter': {'show_no_filtered': True}})
+        fetches = []
+        iter_key_values = SnapshotKvSearch.iter_key_values
+
+        def counted(client, key, *args, **kwargs):
+            fetches.append(key)
+            return iter_key_values(client, key, *args, **kwargs)
+
+        SnapshotKvSearch.iter_key_values = counted
+        try:
+            res = DiffCommand(settings=settings, args=args).run()
+            # both sections come from one merge of both sides
+            assert [(kv1['key'], kv2['key']) for kv1, kv2 in res[OUT_NON_FILTERED_KEY]] == [('r1/b', 'r2/b')]
+            assert [(kv1['key'], kv2['key']) for kv1, kv2 in res[OUT_FILTERED_KEY]] == [('a', None), ('r1/c', 'r2/c'), (None, 'd')]
+            assert fetches == ['r1/', 'r2/']
+        finally:
+            SnapshotKvSearch.iter_key_values = iter_key_values
+
+    def test_copy_checkpoint(self, tmpdir):
+        filepath = str(tmpdir.join('copy.ckpt'))
+        checkpoint = CopyCheckpoint(filepath, 'source/', 'target/', flush_every=2)
+        assert checkpoint.load() == {}
+        with checkpoint.open():
+            checkpoint.done('source/a', 1)
+            checkpoint.done('source/b', 2)
+        with open(filepath, 'a') as fp:
+            fp.write('["source/c", 3')
+        assert checkpoint.load() == {'source/a': 1, 'source/b': 2}
+        with checkpoint.open(resume=True):
+            checkpoint.done('source/c', 3)
+        assert checkpoint.load() == {'source/a': 1, 'source/b': 2, 'source/c': 3}
+        with pytest.raises(ConsulException):
+            CopyCheckpoint(filepath, 'source/', 'other/').load()
+        checkpoint.remove()
+        assert checkpoint.load() == {}
+
+    def test_parallel_filter(self, monkeypatch):
+        vals = [{'key': 'test/{}'.format(i), 'value': 'v{}'.format(i % 7)} for i in range(100)]
+        conf = {'search': {'regex': True, 'fields': 'values', 'limit': 10, 'query': r'^v[35]$'}}
+        mask, res, _ = filter_chunk(SearchFilter(settings=Settings(conf)), [(v['key'], v['value'], None) for v in vals], 0)
+        assert len(mask) == 38 and sum(mask) == 10
+        results = {}
+        for workers in [1, 2]:
+            settings = Settings(dict(conf, filter={'workers': workers, 'chunk_size': 7, 'parallel_min_size': 0},
+                                     log={'log_level': 'ERROR', 'log_formatter': '%(message)s'}))
+            cmd = SearchCommand(settings=settings, args={})
+            cmd.filter = SearchFilter(settings)
+            assert cmd.get_workers(len(vals)) == workers
+            results[workers] = [[d['key'] for d in res] for res in cmd.filter_values(vals)]
+        assert results[1] == results[2]
+        assert len(results[2][0]) == 10
+        # chunks are submitted in a window, chunks after the filter stopped are never submitted
+        submitted = []
+
+        class CountingExecutor(ProcessPoolExecutor):
+            def submit(self, *args, **kwargs):
+                submitted.append(args[-1])
+                return super().submit(*args, **kwargs)
+
+        monkeypatch.setattr(commands, 'ProcessPoolExecutor', CountingExecutor)
+        cmd.filter = SearchFilter(settings)
+        assert [[d['key'] for d in res] for res in cmd.filter_values(vals)] == results[2]
+        assert 0 < len(submitted) < len(range(0, len(vals), 7))
@@ -3,10 +3,34 @@ import sys
 
 
 sys.path.insert(0, os.path.abspath('lib'))
+import csv
+import json
+import time
+import threading
+import re
+import gzip
+import zlib
+import base64
+import pickle
 import pytest
+import consul
 from hsettings import Settings
-from consul_utils.search import ConsulKvSearch
-from consul_utils.filters import OneFilter, PairedFilter, SkipDirectoryFilter, SearchFilter, DiffFilter
+from consul_utils.search import ConsulKvSearch, normalize_roots
+from consul_utils.servers import ServerPool, parse_server
+from consul_utils.regex import compile_regex
+from consul_utils.ranking import TopK, edit_distance
+from consul_utils.decoders import ContentDecoder
+from consul_utils.spill import MemoryBudget, parse_size
+from consul_utils.filters import OneFilter, PairedFilter, SkipDirectoryFilter, SearchFilter, StructuredFilter, \
+    DiffFilter, NoFilter, AndFilter, RankedSearchFilter, build_filter_chain
+from consul_utils.structured import StructuredQuery
+from consul_utils.reporter import OUT_ALL_KEY, OUT_FILTERED_KEY, OUT_NON_FILTERED_KEY, OUT_FLAG_KEY, FileStream, \
+    CsvReport, ParquetReporter, JsonReporter, TextReporter
+from consul_utils.stats import Stats
+from consul_utils.snapshot import SnapshotWriter, SnapshotReader, SnapshotKvSearch
+from consul_utils.exceptions import ConsulException, FilterStop
+from consul_utils.tree import KeyTree, value_size
+from consul_utils.mmapcache import MmapKvFile, write_mmap_file
 
 
 class TestSearch:
@@ -65,11 +89,103 @@ class TestSearch:
         assert res == [{'key': key, 'value': val}]
         res = search.get(key=key)
         assert res == [{'key': key, 'value': val}]
+        # index is stripped from key values of the read, not from the cache
+        assert search.get(key=key) == res and search.get(key=key, with_index=True)[0]['index'] > 0
         res = search.delete(key=key)
         assert res is True
         res = search.get(key=key)
         assert res is None
 
+    def test_stale_while_revalidate(self, config):
+        search = ConsulKvSearch(**dict(config, cache_ttl=60, stale_grace=600))
+        key = 'test/stale/'
+        search.put(key='test/stale/a', value='v1')
+        assert search.get(key=key, refresh=True) == [{'key': 'test/stale/a', 'value': 'v1'}]
+        assert search.ages[key] == 0
+        vals, fetched_at = search.get_cache(key=key, tag=True)
+        # cached 2 minutes ago, expired but in grace window
+        search.set_cache(key=key, value=vals, expire=600, tag=fetched_at - 120)
+        search.put(key='test/stale/a', value='v2')
+        assert search.get(key=key) == [{'key': 'test/stale/a', 'value': 'v1'}]
+        assert search.ages[key] >= 120 and search.stats.get('cache_stale') == 1
+        cache_seconds = search.stats.timers['cache']
+        assert search.wait_refresh(timeout=10)
+        # background refresh is timed as refresh only
+        assert search.stats.timers['cache'] == cache_seconds and search.stats.timers['refresh'] > 0
+        assert search.get(key=key) == [{'key': 'test/stale/a', 'value': 'v2'}]
+        assert search.ages[key] < 60 and search.stats.get('cache_refresh') == 1
+        search.delete(key=key, recurse=True)
+
+    def test_single_flight(self, config):
+        holder = ConsulKvSearch(**dict(config, lease_ttl=10))
+        waiter = ConsulKvSearch(**dict(config, lease_ttl=10))
+        key = 'test/lease/'
+        holder.put(key='test/lease/a', value='v1')
+        holder.del_cache(key=key)
+        token = holder._acquire_lease(key)
+        assert token and waiter._acquire_lease(key) is None
+        timer = threading.Timer(0.3, lambda: (holder.get(key=key, refresh=True), holder._release_lease(key, token)))
+        timer.start()
+        # waiter reads key values got by the lease holder
+        assert waiter.get(key=key) == [{'key': 'test/lease/a', 'value': 'v1'}]
+        timer.join()
+        assert waiter.stats.get('lease_wait_hit') == 1 and waiter.stats.get('keys_decoded') == 0
+        token = waiter._acquire_lease(key)
+        assert token
+        waiter._release_lease(key, token)
+        holder.delete(key=key, recurse=True)
+
+    def test_server_pool(self, config):
+        client = ConsulKvSearch(**dict(config, cache_enabled=False))
+        for i in range(6):
+            client.put(key='test/pool/d{}/k{}'.format(i % 3, i), value='v{}'.format(i))
+        client.put(key='test/pool/top', value='t')
+        address = '{}:{}'.format(config['host'], config['port'])
+        # dead server is failed over, key values are read in shards by sub directories
+        pooled = ConsulKvSearch(**dict(config, host='', cache_enabled=False, consistency='stale',
+                                       servers=['127.0.0.1:1', address]))
+        assert pooled.get(key='test/pool/') == client.get(key='test/pool/')
+        assert pooled.stats.get('server_failover') >= 1 and pooled.stats.get('shard_reads') == 4
+        # client errors are raised without failover, server errors are failed over
+        pool = ServerPool([('a', 1, 'http'), ('b', 2, 'http')], lambda host, port, scheme: host)
+        calls = []
+
+        def fail(host, error):
+            calls.append(host)
+            raise error
+
+        with pytest.raises(consul.base.ClientError):
+            pool.call(lambda host: fail(host, consul.base.ClientError('409 conflict')))
+        assert len(calls) == 1 and pool.stats.get('server_failover') == 0
+        calls = []
+        assert pool.call(lambda host: host if calls else fail(host, consul.ConsulException('500 error'))) != calls[0]
+        with pytest.raises(ConsulException):
+            pool.call(lambda host: fail(host, consul.Timeout()))
+        assert len(calls) == 3 and pool.stats.get('server_failover') == 3
+        assert parse_server('https://consul1:8501') == ('consul1', 8501, 'https')
+        assert parse_server('consul2', 8500, 'http') == ('consul2', 8500, 'http')
+        client.delete(key='test/pool/', recurse=True)
+
+    def test_get_roots(self, config):
+        assert normalize_roots(['app/web/', 'app/', 'db/', 'app/web/a', 'apple']) == ['app/', 'apple', 'db/']
+        assert normalize_roots(['app/', '']) == ['']
+        search = ConsulKvSearch(**config)
+        for key in ['test/roots/app/web/a', 'test/roots/app/db/a', 'test/roots/apple', 'test/roots/db/x']:
+            search.put(key=key, value='v')
+        search.del_cache('test/roots/app/')
+        search.del_cache('test/roots/db/')
+        roots = ['test/roots/app/web/', 'test/roots/db/', 'test/roots/app/', 'test/roots/none/']
+        res = search.get_roots(roots)
+        assert [(root, [kv['key'] for kv in vals]) for root, vals in res] == [
+            ('test/roots/app/web/', ['test/roots/app/web/a']),
+            ('test/roots/db/', ['test/roots/db/x']),
+            ('test/roots/app/', ['test/roots/app/db/a', 'test/roots/app/web/a']),
+            ('test/roots/none/', []),
+        ]
+        # overlapping roots are read once
+        assert search.stats.get('root_reads') == 3 and search.stats.get('cache_miss') == 3
+        search.delete(key='test/roots/', recurse=True)
+
 
 class TestFilter:
 
@@ -182,3 +298,465 @@ class TestFilter:
         for t in test_data:
             res = fil.filter(**t)
             assert res is t['assert']
+
+    def test_structured_filter(self):
+        obj = {'server': {'timeout_ms': 6000, 'hosts': ['db1', 'web1']}, 'port': '8080', 'beta': False}
+        test_data = [
+            ('server.timeout_ms > 5000', True),
+            ('$.server.timeout_ms <= 5000', False),
+            ('server.hosts[*] =~ ^db', True),
+            ('server.hosts[1] == "web1"', True),
+            ('server.hosts.0 == db1', True),
+            ('port >= 8000', True),
+            ('beta == false', True),
+            ('beta', True),
+            ('missing', False),
+            ('*.timeout_ms != 6000', False),
+        ]
+        for expression, expected in test_data:
+            assert StructuredQuery(expression).match(obj) is expected, expression
+        conf = {
+            'search': {
+                'limit': 10,
+                'query': 'timeout_ms > 5000'
+            }
+        }
+        fil = StructuredFilter(settings=Settings(conf))
+        test_data = [
+            {'key': 'a', 'value': '{"timeout_ms": 6000}', 'index': 0, 'modify_index': 10, 'assert': True},
+            {'key': 'b', 'value': 'timeout_ms: 100', 'index': 1, 'modify_index': 11, 'assert': False},
+            {'key': 'c', 'value': 'timeout_ms: [', 'index': 2, 'modify_index': 12, 'assert': False},
+            {'key': 'd', 'value': None, 'index': 3, 'modify_index': 13, 'assert': False},
+        ]
+        for t in test_data:
+            res = fil.filter(**t)
+            assert res is t['assert']
+        assert fil.memo['a'] == (10, True, {'timeout_ms': 6000})
+        assert fil.memo['c'][:2] == (12, False)
+        # memoized value is used if not modified
+        fil.memo['b'] = (11, True, {'timeout_ms': 9000})
+        assert fil.filter(key='b', value='timeout_ms: 100', index=1, modify_index=11) is True
+        assert fil.filter(key='b', value='timeout_ms: 100', index=1, modify_index=14) is False
+        # values parsed in worker processes are merged, memo of keys not seen in a search is dropped
+        worker = pickle.loads(pickle.dumps(fil))
+        assert worker.memo == {} and worker.filter(key='e', value='timeout_ms: 7000', index=4, modify_index=15)
+        fil.merge_memo_updates([worker.get_memo_updates()])
+        assert fil.memo['e'][0] == 15
+        saved = {}
+
+        class Memo:
+            def get_memo(self, namespace, root):
+                return saved.get((namespace, root))
+
+            def set_memo(self, namespace, root, value):
+                saved[(namespace, root)] = value
+
+        fil.finish(Memo(), 'root/')
+        assert sorted(saved[('structured', 'root/')]) == ['a', 'b', 'c', 'e']
+        fil.prepare(Memo(), 'root/')
+        fil.match(key='a', value='{"timeout_ms": 6000}', modify_index=10)
+        fil.finish(Memo(), 'root/')
+        assert list(saved[('structured', 'root/')]) == ['a']
+
+    def test_semantic_diff_filter(self):
+        fil = DiffFilter(settings=Settings({'diff': {'semantic': True}}))
+        test_data = [
+            {'key1': 'a/1', 'value1': '{"a": 1, "b": [1, 2]}', 'key2': 'b/1', 'value2': '{"b":[1,2],"a":1}', 'index': 0, 'assert': False},
+            {'key1': 'a/2', 'value1': '{"a": 1}', 'key2': 'b/2', 'value2': 'a: 1', 'index': 1, 'assert': False},
+            {'key1': 'a/3', 'value1': '{"a": 1, "b": 2}', 'key2': 'b/3', 'value2': '{"a": 2, "c": 3}', 'index': 2, 'assert': True},
+            {'key1': 'a/4', 'value1': 'plain', 'key2': 'b/4', 'value2': 'plain', 'index': 3, 'assert': False},
+            {'key1': 'a/5', 'value1': '{"a": [1]}', 'key2': 'b/5', 'value2': '{"a": [1, 2]}', 'index': 4, 'assert': True},
+        ]
+        for t in test_data:
+            res = fil.filter(**t)
+            assert res is t['assert']
+        changes = [(r['key'], r['path'], r['op']) for r in fil.get_results()]
+        assert changes == [
+            ('a/3', '$.a', 'changed'),
+            ('a/3', '$.b', 'removed'),
+            ('a/3', '$.c', 'added'),
+            ('a/5', '$.a[1]', 'added'),
+        ]
+        # canonical hash is memoized by raw value
+        assert len(fil.memo) == 8
+        fil.memo[list(fil.memo)[0]] = 'changed'
+        assert fil.filter(**test_data[0]) is True
+        # yaml dates are kept json serializable
+        fil = DiffFilter(settings=Settings({'diff': {'semantic': True}}))
+        assert fil.filter_many(['a'], ['d: 2024-01-01'], ['b'], ['d: 2024-01-02']) == [True]
+        res = fil.get_results()
+        assert [(r['old'], r['new']) for r in res] == [('2024-01-01', '2024-01-02')]
+        assert json.loads(json.dumps(res))[0]['value'] == '$.d changed: "2024-01-01" -> "2024-01-02"'
+
+    def test_filter_chain(self):
+        spec = {'and': [
+            {'value_regex': r'timeout \d{5}'},
+            'skip_directory',
+            {'not': {'key': 'tmp/'}},
+            {'or': [{'prefix': 'app/a/'}, {'key_regex': '^app/b/k1'}]},
+        ]}
+        fil = build_filter_chain(Settings(), spec, limit=100)
+        assert isinstance(fil, AndFilter) and fil.limit == 100
+        vals = [{'key': 'app/{}/{}k{}'.format(d, t, i), 'value': 'timeout {}'.format(i * 1000)}
+                for d in 'abc' for t in ('', 'tmp/') for i in range(20)]
+        vals.append({'key': 'app/a/dir/', 'value': 'timeout 99999'})
+        expected = [v['key'] for v in vals if v['key'] in {
+            'app/a/k{}'.format(i) for i in range(10, 20)} | {'app/b/k{}'.format(i) for i in range(10, 20)}]
+        fil.reorder_interval = 16
+        passed = [v['key'] for v in vals if fil.filter(key=v['key'], value=v['value'], index=0)]
+        assert passed == expected
+        # cheap key filters are moved before the value regex
+        assert fil.order[-1] == 0
+        assert fil.total_evaluations() < 4 * len(vals)
+        state = fil.get_state()
+        fil2 = build_filter_chain(Settings(), spec)
+        fil2.set_state(state)
+        fil2.reorder()
+        assert fil2.order == fil.order and fil2.total_evaluations() == 0
+        with pytest.raises(FilterStop):
+            fil3 = build_filter_chain(Settings(), spec, limit=1)
+            for v in vals:
+                fil3.filter(key=v['key'], value=v['value'], index=0)
+        # search leaf without options uses command settings
+        fil = build_filter_chain(Settings({'search': {'query': 'k1', 'limit': 1}}), {'not': 'search'})
+        assert [v['key'] for v in vals[:12] if fil.filter(key=v['key'], value=v['value'], index=0)] == \
+            ['app/a/k0', 'app/a/k2', 'app/a/k3', 'app/a/k4', 'app/a/k5', 'app/a/k6', 'app/a/k7', 'app/a/k8', 'app/a/k9']
+        # leaves with fixed or own options inherit the command section
+        fil = build_filter_chain(Settings({'search': {'query': 'k1$'}}), {'and': ['key_regex']})
+        assert [v['key'] for v in vals[:12] if fil.filter(key=v['key'], value=v['value'], index=0)] == ['app/a/k1']
+        fil = build_filter_chain(Settings({'search': {'max_value_size': 8}}),
+                                 {'or': [{'value': 'x'}, {'value': '000'}]})
+        assert [fil.filter(key='k', value=v, index=0) for v in ['timeout 1000', 'v 1000']] == [False, True]
+        # one data filters are evaluated on the first side in paired chains
+        fil = build_filter_chain(Settings(), {'and': ['skip_directory', 'diff']}, paired=True)
+        assert fil.filter(key1='a', value1='1', key2='b', value2='2', index=0) is True
+        assert fil.filter(key1='a/', value1='1', key2='b/', value2='2', index=1) is False
+        assert fil.filter(key1='a', value1='1', key2='b', value2='1', index=2) is False
+        # leaves keep their own memo, ModifyIndex of the first side reaches one data leaves
+        fil = build_filter_chain(Settings(), {'and': [{'structured': 'port > 8000'}, {'structured': 'port < 9000'}]},
+                                 paired=True)
+        leaves = [child.inner for child in fil.children]
+        assert leaves[0].memo_namespace != leaves[1].memo_namespace
+        assert fil.filter_many(['a'], ['{"port": 8080}'], ['a'], ['{}'], [7]) == [True]
+        assert leaves[0].memo['a'][0] == 7 and leaves[1].memo['a'][0] == 7
+        with pytest.raises(ValueError):
+            build_filter_chain(Settings(), {'xor': ['skip_directory']})
+        with pytest.raises(ValueError):
+            build_filter_chain(Settings(), {'and': ['diff']})
+
+    def test_filter_many(self):
+        vals = [{'key': 'app/{}/k{}{}'.format(d, i, '/' if i % 5 == 0 else ''), 'value': 'v{} {}'.format(i, d)}
+                for d in 'ab' for i in range(30)]
+        vals.append({'key': 'app/none', 'value': None})
+        vals.append({'key': 'app/json', 'value': '{"port": 8080}'})
+        keys = [v['key'] for v in vals]
+        values = [v['value'] for v in vals]
+        filters = [SkipDirectoryFilter(Settings()), NoFilter(Settings()),
+                   build_filter_chain(Settings(), {'or': [{'key_regex': '/k1'}, {'not': {'value': 'a'}}]})]
+        for search in [{'fields': 'keys', 'query': 'k1'}, {'fields': 'keys', 'query': r'/k\d$', 'regex': True},
+                       {'fields': 'values', 'query': ' b'}, {'fields': 'values', 'query': r'^v2', 'regex': True}]:
+            filters.append(SearchFilter(Settings({'search': search})))
+        filters.append(StructuredFilter(Settings({'search': {'query': 'port > 8000'}})))
+        for fil in filters:
+            mask = fil.filter_many(keys, values, start=0)
+            assert mask == [fil.evaluate(key=k, value=v, index=i) for i, (k, v) in enumerate(zip(keys, values))], fil
+            assert any(mask) and not all(mask) or isinstance(fil, NoFilter)
+        values2 = ['{"a": 1, "b": 2}', '{"b":2,"a":1}', 'x', None, 'y']
+        values1 = ['{"a": 1, "b": 2}', '{"a": 1, "b": 2}', 'x', 'z', None]
+        for semantic in [False, True]:
+            fil = DiffFilter(Settings({'diff': {'semantic': semantic}}))
+            assert fil.filter_many(['k'] * 5, values1, ['k'] * 5, values2) == [False, not semantic, False, True, True]
+
+    def test_regex_backend(self, caplog):
+        # backends missing or not supporting the pattern fall back to re
+        for backend in ['re', 're2', 'hyperscan']:
+            assert compile_regex(r'time.*\d{5}', backend).search('timeout: 30000')
+            assert not compile_regex(r'time.*\d{5}', backend).search('timeout: 300')
+            assert compile_regex(rb'(a)\1', backend).search(memoryview(b'xaa'))
+        with pytest.raises(ValueError):
+            compile_regex('a', 'pcre')
+        keys = ['k1', 'k2', 'k3']
+        values = ['a' * 100 + 'needle', 'needle', None]
+        fil = SearchFilter(Settings({'search': {'fields': 'values', 'query': 'needle', 'regex': True,
+                                                'regex_backend': 're2', 'max_value_size': 50}}))
+        assert fil.filter_many(keys, values) == [False, True, False]
+        assert pickle.loads(pickle.dumps(fil)).evaluate(key='k2', value='needle')
+        fil = SearchFilter(Settings({'search': {'fields': 'values', 'query': 'needle', 'time_budget': 0.1}}))
+        fil.start_budget()
+        assert fil.filter_many(keys, values) == [True, True, False]
+        time.sleep(0.15)
+        with pytest.raises(FilterStop):
+            fil.filter_many(keys, values)
+        # time budget can not interrupt a backtracking match in re
+        caplog.set_level('WARNING')
+        fil = SearchFilter(Settings({'search': {'fields': 'values', 'query': '(a+)+$', 'regex': True,
+                                                'regex_backend': 're', 'time_budget': 1}}))
+        fil.get_query()
+        assert 'time budget can not stop' in caplog.text
+
+    def test_ranked_search(self):
+        assert edit_distance('databse', 'database', 2) == 1 and edit_distance('abc', 'xyz', 1) == 2
+        keys = ['app/cache/redis_port', 'app/db/database_host', 'app/db/host', 'app/web/hosts', 'app/db/user']
+        values = ['6379', 'db1', 'db2', '["w1"]', 'database admin']
+        fil = RankedSearchFilter(Settings({'search': {'query': 'databse_host', 'limit': 2, 'min_score': 0.4}}))
+        mask = fil.filter_many(keys, values)
+        assert mask == [False, True, True, True, False]
+        assert fil.ranked() == [(fil.score(keys[1], None), 1), (0.5, 2)]
+        # worker processes keep their own heaps, merged in order
+        worker = pickle.loads(pickle.dumps(fil))
+        assert worker.ranked() == []
+        worker.filter_many(keys[3:], values[3:], start=3)
+        fil.reset()
+        fil.filter_many(keys[:3], values[:3])
+        fil.merge_results([worker.get_results()])
+        assert [i for _, i in fil.ranked()] == [1, 2]
+        fil = RankedSearchFilter(Settings({'search': {'query': 'database', 'fields': 'values', 'limit': 1}}))
+        fil.filter_many(keys, values)
+        assert [i for _, i in fil.ranked()] == [4]
+        top = TopK(2)
+        for i, score in enumerate([0.5, 0.9, 0.5, 0.9]):
+            top.push(score, i)
+        assert top.items() == [(0.9, 1), (0.9, 3)]
+
+    def test_content_decoder(self):
+        payload = '{"db": {"host": "db-secret-1"}}'
+        gz = gzip.compress(payload.encode('utf8'))
+        zl = zlib.compress(payload.encode('utf8'))
+        b64 = base64.b64encode(gz).decode('ascii')
+        decoder = ContentDecoder(prefixes=[('raw/', ['base64'])])
+        assert decoder.decode('a', gz) == payload and decoder.decode('a', zl) == payload
+        assert decoder.decode('a', b64) == payload
+        assert decoder.decode('raw/x', base64.b64encode(b'plain text').decode('ascii')) == 'plain text'
+        assert decoder.decode('a', 'plain value') is None and decoder.decode('a', b'\x1f\x8bcorrupted') is None
+        try:
+            import zstandard
+            assert decoder.decode('a', zstandard.ZstdCompressor().compress(payload.encode('utf8'))) == payload
+        except ImportError:
+            pass
+        # decoded once per ModifyIndex
+        assert decoder.decode_value('a', gz, 5) == payload and decoder.decoded == 1
+        assert decoder.decode_value('a', gz, 5) == payload and decoder.decoded == 1
+        assert decoder.decode_value('a', zl, 6) == payload and decoder.decoded == 2
+        assert pickle.loads(pickle.dumps(decoder)).memo == {}
+        # entries decoded in worker processes are merged, memo is capped and unused entries are dropped when saved
+        worker = pickle.loads(pickle.dumps(decoder))
+        assert worker.decode_value('b', gz, 7) == payload
+        decoder.merge_memo(worker.memo)
+        assert sorted(decoder.memo) == ['a', 'b'] and decoder.decoded == 2
+        saved = {}
+
+        class Memo:
+            def get_memo(self, namespace, root):
+                return saved.get((namespace, root))
+
+            def set_memo(self, namespace, root, value):
+                saved[(namespace, root)] = value
+
+        decoder.save(Memo(), 'root/')
+        decoder.load(Memo(), 'root/')
+        assert decoder.decode_value('b', gz, 7) == payload and decoder.decoded == 2
+        decoder.save(Memo(), 'root/')
+        assert list(saved[('decoded', 'root/')]) == ['b']
+        capped = ContentDecoder(memo_max_total=len(payload))
+        capped.decode_many(['a', 'b'], [gz, zl], [1, 2])
+        assert list(capped.memo) == ['a']
+        with pytest.raises(ValueError):
+            ContentDecoder(prefixes=[('raw/', ['rot13'])])
+        keys, values = ['a', 'b', 'c'], [gz, b64, 'db-secret-2']
+        conf = {'search': {'query': 'db-secret', 'fields': 'values'}}
+        assert SearchFilter(Settings(conf)).filter_many(keys, values) == [False, False, True]
+        conf['decode'] = {'enabled': True}
+        fil = SearchFilter(Settings(conf))
+        assert fil.filter_many(keys, values, [1, 2, 3]) == [True, True, True]
+        assert fil.decoder.decoded == 2
+        assert DiffFilter(Settings({})).filter_many(['a'], [gz], ['a'], [zl]) == [True]
+        assert DiffFilter(Settings({'decode': {'enabled': True}})).filter_many(['a'], [gz], ['a'], [zl]) == [False]
+
+
+class TestReporter:
+
+    def test_file_stream(self, tmpdir):
+        lines = ['line {}'.format(i) for i in range(2500)] + ['中文']
+        for name in ['out.txt', 'out.txt.gz']:
+            filepath = str(tmpdir.join(name))
+            with FileStream(filepath, encoding='utf8', chunk_size=1000) as stream:
+                for line in lines:
+                    stream.append(line)
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(filepath, 'rb') as fp:
+                assert fp.read().decode('utf8') == '\n'.join(lines) + '\n'
+
+    def test_csv_reporter(self, tmpdir):
+        data = {
+            OUT_ALL_KEY: [],
+            OUT_FILTERED_KEY: [{'key': 'a,b', 'value': 'line1\nline2, "quoted"'}, {'key': 'c', 'value': None}],
+            OUT_NON_FILTERED_KEY: [],
+            OUT_FLAG_KEY: {'copy': [{'key': 'd', 'value': 'e'}]}
+        }
+        filepath = str(tmpdir.join('out.csv'))
+        conf = {'reporter': {'output_file': filepath, 'show_flags': True}}
+        CsvReport(Settings(conf)).report(dict(data))
+        with open(filepath, newline='') as fp:
+            rows = list(csv.reader(fp))
+        assert rows == [
+            ['filtered', 'a,b', 'line1\nline2, "quoted"'],
+            ['filtered', 'c', ''],
+            ['flags', 'copy', 'd', 'e'],
+        ]
+        conf['reporter']['csv_split'] = True
+        CsvReport(Settings(conf)).report(dict(data))
+        with open(str(tmpdir.join('out.filtered.csv')), newline='') as fp:
+            rows = list(csv.reader(fp))
+        assert rows == [['key', 'value'], ['a,b', 'line1\nline2, "quoted"'], ['c', '']]
+        assert tmpdir.join('out.flags.csv').check()
+        assert not tmpdir.join('out.scan.csv').check()
+        # key values of multiple roots are labelled by root
+        data[OUT_FILTERED_KEY] = [{'key': 'app/a', 'value': '1', 'root': 'app/'}]
+        CsvReport(Settings(conf)).report(dict(data))
+        with open(str(tmpdir.join('out.filtered.csv')), newline='') as fp:
+            assert list(csv.reader(fp)) == [['root', 'key', 'value'], ['app/', 'app/a', '1']]
+        # ranked key values keep their score
+        data[OUT_FILTERED_KEY] = [{'key': 'app/a', 'value': '1', 'score': 0.9}]
+        CsvReport(Settings(conf)).report(dict(data))
+        with open(str(tmpdir.join('out.filtered.csv')), newline='') as fp:
+            assert list(csv.reader(fp)) == [['key', 'value', 'score'], ['app/a', '1', '0.9']]
+        assert TextReporter(Settings(conf)).to_text(data[OUT_FILTERED_KEY][0]) == 'app/a: 1 (score 0.9)'
+
+    def test_spill_list(self, tmpdir):
+        assert parse_size('512M') == 512 * 1024 * 1024 and parse_size(1000) == 1000
+        budget = MemoryBudget(parse_size('16K'), spill_dir=str(tmpdir))
+        filtered = budget.new_list()
+        flagged = budget.new_list()
+        records = [{'key': 'app/{}'.format(i), 'value': 'line1\nline2 {}'.format(i)} for i in range(500)]
+        for i, d in enumerate(records):
+            filtered.append(d)
+            if i % 100 == 0:
+                flagged.append((d, {'key': None, 'value': None}))
+        assert filtered.spilled and len(filtered) == 500 and budget.used <= budget.max_bytes
+        assert budget.stats.get('records_spilled') > 0
+        # spilled records stream back in order, more than once
+        assert list(filtered) == records and list(filtered) == records
+        assert [pair[0] for pair in flagged] == records[::100]
+        data = {OUT_ALL_KEY: [], OUT_FILTERED_KEY: filtered, OUT_NON_FILTERED_KEY: [], OUT_FLAG_KEY: {'flag': flagged}}
+        expected = {OUT_FILTERED_KEY: records, OUT_FLAG_KEY: {'flag': [list(pair) for pair in flagged]}}
+        filepath = str(tmpdir.join('out.json'))
+        reporter = JsonReporter(Settings({'reporter': {'output_file': filepath, 'show_flags': True}}))
+        reporter.report(dict(data))
+        with open(filepath, encoding='utf8') as fp:
+            assert fp.read() == json.dumps(expected, indent=4) + '\n'
+        # records are counted, not lines
+        assert reporter.stats.get('records_written') == 505
+        reporter = TextReporter(Settings({'reporter': {'output_file': filepath, 'show_flags': True}}))
+        reporter.report(dict(data))
+        assert reporter.stats.get('records_written') == 505
+        budget.close()
+        assert len(filtered) == 0 and budget.used == 0
+
+    def test_parquet_reporter(self, tmpdir):
+        parquet = pytest.importorskip('pyarrow.parquet')
+        data = {
+            OUT_ALL_KEY: [],
+            OUT_FILTERED_KEY: [({'key': 'a', 'value': '1'}, {'key': 'b', 'value': b'\xff'})],
+            OUT_NON_FILTERED_KEY: [],
+            OUT_FLAG_KEY: {}
+        }
+        filepath = str(tmpdir.join('out.parquet'))
+        ParquetReporter(Settings({'reporter': {'output_file': filepath}})).report(data)
+        table = parquet.read_table(str(tmpdir.join('out.filtered.parquet')))
+        assert table.to_pydict() == {'key1': ['a'], 'value1': ['1'], 'key2': ['b'], 'value2': ['\\xff']}
+
+
+class TestStats:
+
+    def test_stats(self):
+        stats = Stats(command='test')
+        with stats.timer('fetch'):
+            stats.incr('bytes_fetched', 10)
+        with stats.timer('fetch'):
+            stats.incr('bytes_fetched', 5)
+        stats.incr('cache_hit')
+        assert stats.get('bytes_fetched') == 15
+        assert stats.get('cache_miss') == 0
+        assert list(stats.to_dict()['timers']) == ['fetch']
+        prom = stats.to_prometheus()
+        assert 'consul_utils_phase_seconds{command="test",phase="fetch"}' in prom
+        assert 'consul_utils_bytes_fetched_total{command="test"} 15' in prom
+        assert 'consul_utils_cache_hit_total{command="test"} 1' in prom
+        # counters and timers are updated by many threads
+        threads = [threading.Thread(target=lambda: [stats.incr('shard_reads') for _ in range(1000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert stats.get('shard_reads') == 4000
+
+
+class TestTree:
+
+    def test_key_tree(self):
+        tree = KeyTree('app/', depth=1, top=2)
+        for key, value in [('app/a/x/1', 'aaa'), ('app/a/x/2', '\u00e9'), ('app/a/y', None), ('app/b/1', b'bbbbb'), ('app/c', 'c')]:
+            tree.add(key, value_size(value))
+        assert tree.count == 5
+        assert sorted(tree.nodes) == ['app/', 'app/a/', 'app/b/']
+        root = tree.nodes['app/'].to_dict()
+        assert root['keys'] == 5 and root['bytes'] == 11
+        assert root['largest'] == [{'key': 'app/b/1', 'bytes': 5}, {'key': 'app/a/x/1', 'bytes': 3}]
+        assert [n.prefix for n in tree.summaries('bytes')] == ['app/', 'app/a/', 'app/b/']
+        assert tree.nodes['app/a/'].keys == 3 and tree.nodes['app/a/'].bytes == 5
+        tree = KeyTree('app/', depth=3, sizes=False)
+        tree.add('app/a/x/1')
+        assert sorted(tree.nodes) == ['app/', 'app/a/', 'app/a/x/']
+        assert tree.nodes['app/a/x/'].to_dict() == {'key': 'app/a/x/', 'value': 'keys: 1', 'depth': 2, 'keys': 1}
+
+
+class TestSnapshot:
+
+    def test_snapshot(self, tmpdir):
+        filepath = str(tmpdir.join('test.snap'))
+        vals = [{'key': 'app/{}/k{:03d}'.format(d, i), 'value': 'v{}'.format(i), 'index': i} for d in 'abc' for i in range(50)]
+        vals.append({'key': 'app/d/bin', 'value': b'\xff\x00', 'index': 1})
+        vals.append({'key': 'app/d/dir/', 'value': None, 'index': 2})
+        with SnapshotWriter(filepath, root='app/', source='test', block_size=7) as writer:
+            writer.write_many(vals)
+        assert not tmpdir.join('test.snap.tmp').check()
+        reader = SnapshotReader(filepath)
+        assert reader.meta['root'] == 'app/' and reader.meta['count'] == len(vals)
+        assert list(reader.iter()) == vals
+        assert reader.get('app/b/') == vals[50:100]
+        assert reader.get('app/a/k04') == vals[40:50]
+        assert reader.get('app/d/') == vals[150:]
+        assert reader.get('app/e/') is None
+        consul = SnapshotKvSearch(filepath, cache_enabled=False)
+        assert consul.get('app/c/k049') == [{'key': 'app/c/k049', 'value': 'v49'}]
+        assert consul.get_key('app/a/k00', recurse=False) is None
+        with pytest.raises(ConsulException):
+            consul.put('app/a/k000', 'v')
+        with pytest.raises(ConsulException):
+            with SnapshotWriter(filepath) as writer:
+                writer.write_many(reversed(vals))
+        assert SnapshotReader(filepath).meta['count'] == len(vals)
+
+
+class TestMmapCache:
+
+    def test_mmap_kv_file(self, tmpdir):
+        filepath = str(tmpdir.join('mmap', 'test.kv'))
+        vals = [{'key': 'app/k{:02d}'.format(i), 'value': 'value {} é'.format(i), 'index': i} for i in range(20)]
+        vals.append({'key': 'app/bin', 'value': b'\xff\x00value', 'index': 20})
+        vals.append({'key': 'app/dir/', 'value': None, 'index': None})
+        write_mmap_file(filepath, vals, time.time() + 60)
+        kvfile = MmapKvFile.open(filepath)
+        assert len(kvfile) == len(vals)
+        assert list(kvfile.iter_records(with_index=True)) == vals
+        assert list(kvfile.search(b'k1', 'keys')) == list(range(10, 20))
+        assert list(kvfile.search('value 1 é'.encode('utf8'), 'values')) == [1]
+        assert list(kvfile.search(b'value', 'values')) == list(range(21))
+        assert list(kvfile.search(re.compile(b'^value'), 'values', regex=True)) == list(range(20))
+        assert list(kvfile.search(re.compile(b'/$'), 'keys', regex=True)) == [21]
+        assert list(kvfile.search(b'\x00value', 'values')) == [20]
+        assert list(kvfile.search(b'nomatch', 'keys')) == []
+        kvfile.close()
+        write_mmap_file(filepath, vals, time.time() - 1)
+        assert MmapKvFile.open(filepath) is None
+        assert MmapKvFile.open(str(tmpdir.join('none.kv'))) is None